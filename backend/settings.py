@@ -15,6 +15,8 @@ from pathlib import Path
 from datetime import timedelta
 
 import os
+import sys
+import dj_database_url
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -47,6 +49,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'shop_app',
     'rest_framework',
     'core',
@@ -54,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "shop_app.metrics.MetricsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -89,23 +93,95 @@ WSGI_APPLICATION = 'backend.wsgi.app'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-#DATABASES = {
-#    'default': {
-#        'ENGINE': 'django.db.backends.sqlite3',
-#        'NAME': BASE_DIR / 'db.sqlite3',
-#    }
-#}
+# The database is DATABASE_URL (deployments point it at Supabase), or a local
+# SQLite file without one. Test runs ignore DATABASE_URL, so they never touch
+# the deployed database; set TEST_DATABASE_URL to run them on Postgres.
+TESTING = sys.argv[1:2] == ["test"]
+DATABASE_URL = os.getenv("TEST_DATABASE_URL" if TESTING else "DATABASE_URL")
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'postgres',
-        'USER': 'postgres.iwwigvjhajyioqwlioxo',
-        'PASSWORD': 'dYJyPUEqQdvl9f4v',
-        'HOST': 'aws-0-ap-southeast-1.pooler.supabase.com',
-        'PORT': '6543'
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+if DATABASE_URL:
+    DATABASES["default"] = dj_database_url.parse(DATABASE_URL)
+
+# Read replicas, as a comma separated list of database URLs. They become the
+# aliases replica_1, replica_2... that shop_app.routers.ReplicaRouter sends
+# catalog reads to. Test runs read them from the test database of "default".
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+for number, url in enumerate(DATABASE_REPLICA_URLS, 1):
+    DATABASES[f"replica_{number}"] = {**dj_database_url.parse(url), "TEST": {"MIRROR": "default"}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = ["shop_app.routers.ReplicaRouter"]
+# How long after a catalog write its readers stay on the primary, to cover
+# replication lag.
+REPLICA_PIN_SECONDS = float(os.getenv("REPLICA_PIN_SECONDS", "5"))
+
+# Connection reuse. By default a connection is kept open for DB_CONN_MAX_AGE
+# seconds and checked before it is reused, so requests skip the TCP, TLS and
+# auth round trips to the database. DB_POOL_MAX_SIZE > 0 switches Postgres
+# databases to a psycopg pool per process instead (which requires
+# DB_CONN_MAX_AGE to be 0).
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "0"))
+for database in DATABASES.values():
+    postgres = database["ENGINE"] == "django.db.backends.postgresql"
+    pooled = postgres and DB_POOL_MAX_SIZE > 0
+    database["CONN_HEALTH_CHECKS"] = True
+    database["CONN_MAX_AGE"] = 0 if pooled else int(os.getenv("DB_CONN_MAX_AGE", "60"))
+    if pooled:
+        database.setdefault("OPTIONS", {})["pool"] = {
+            "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+            "max_size": DB_POOL_MAX_SIZE,
+            "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        }
+
+    # Supabase's port 6543 is PgBouncer in transaction mode: consecutive
+    # transactions may run on different server connections, so nothing may
+    # outlive a transaction there - no server-side cursors, no prepared statements.
+    pgbouncer = os.getenv("DB_PGBOUNCER", "true" if str(database.get("PORT")) == "6543" else "false")
+    if postgres and pgbouncer.lower() in ("1", "true", "yes"):
+        database["DISABLE_SERVER_SIDE_CURSORS"] = True
+        database.setdefault("OPTIONS", {})["prepare_threshold"] = None
+
+
+# Cache
+# The "catalog" alias holds cached catalog responses, keyed on version stamps
+# kept in the database (shop_app.models.CacheVersion), so a write invalidates
+# the entries of every process. LocMemCache is a per-process LRU bounded by
+# MAX_ENTRIES and TIMEOUT; point CATALOG_CACHE_BACKEND at a shared backend
+# (Redis, memcached) to share the cached responses between workers as well.
+
+CATALOG_CACHE_ALIAS = "catalog"
+# The "users" alias holds the users ClaimsJWTAuthentication loads, for
+# USER_CACHE_TIMEOUT seconds. It is meant to be per process: saving a user
+# forgets them in the process that saved them, other processes notice when the
+# entry expires.
+USER_CACHE_ALIAS = "users"
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    CATALOG_CACHE_ALIAS: {
+        "BACKEND": os.getenv("CATALOG_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CATALOG_CACHE_LOCATION", "catalog"),
+        "TIMEOUT": int(os.getenv("CATALOG_CACHE_TIMEOUT", "300")),
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.getenv("CATALOG_CACHE_MAX_ENTRIES", "2000")),
+        },
+    },
+    USER_CACHE_ALIAS: {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "users",
+        "TIMEOUT": int(os.getenv("USER_CACHE_TIMEOUT", "60")),
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000")),
+        },
+    },
+}
 
 
 # Password validation
@@ -148,6 +224,11 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = 'img/'
 MEDIA_ROOT = BASE_DIR/"media"
 
+# Product image derivatives, see shop_app/thumbnails.py
+THUMBNAIL_DIR = "img/thumbs"
+THUMBNAIL_WIDTHS = (160, 320, 640)
+THUMBNAIL_QUALITY = 80
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -158,15 +239,45 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.ClaimsJWTAuthentication',
     )
 }
 
+# Request instrumentation (shop_app.metrics): the fraction of requests measured,
+# 0 to turn it off, and the bearer token /metrics requires; /metrics is closed
+# while it is unset.
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0.05"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 SIMPLE_JWT = {
-    "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60)
+    "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
+    "TOKEN_OBTAIN_SERIALIZER": "core.authentication.ClaimsTokenObtainPairSerializer",
 }
 
 FLUTTERWAVE_SECRET_KEY = "FLWSECK_TEST-825d260605a1fb0170d7af0cc15520f5-X"
+FLUTTERWAVE_BASE_URL = os.getenv("FLUTTERWAVE_BASE_URL", "https://api.flutterwave.com/v3")
+FLUTTERWAVE_CONNECT_TIMEOUT = 3.05
+FLUTTERWAVE_READ_TIMEOUT = 10
+FLUTTERWAVE_MAX_RETRIES = 3
+FLUTTERWAVE_POOL_SIZE = 20
+# Connections per event loop of the async client used by the views in shop_app.async_views
+FLUTTERWAVE_ASYNC_POOL_SIZE = 200
+FLUTTERWAVE_BREAKER_THRESHOLD = 5
+FLUTTERWAVE_BREAKER_RESET = 30
+
+# Payment verification jobs, run by `manage.py run_payment_worker`
+PAYMENT_JOB_MAX_ATTEMPTS = 6
+PAYMENT_JOB_BACKOFF = 5
+PAYMENT_JOB_MAX_BACKOFF = 300
+PAYMENT_JOB_LEASE = 120
+
+# Responses to requests carrying an Idempotency-Key header are kept this many
+# seconds; run purge_idempotency_keys periodically to drop expired ones.
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# A request still running holds its key this long; a retry arriving after that
+# assumes the worker died and runs the view again. Keep it above the slowest
+# checkout (gateway timeouts included).
+IDEMPOTENCY_LEASE = 60
 
 
 
@@ -0,0 +1,100 @@
+"""JWT authentication that serves ``request.user`` from the token's claims.
+
+Access tokens carry the user's id and, when issued by
+``ClaimsTokenObtainPairSerializer``, their username, so
+``ClaimsJWTAuthentication`` builds the user from them without a database
+round trip. The other fields of that user are deferred and loaded together on
+first access, from a short-lived per-process cache or else the database.
+
+That load is also where a deleted or deactivated user is turned away, so
+endpoints that only use the claims keep serving such a user until their access
+token expires - the usual trade-off of stateless JWTs.
+"""
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+
+USERNAME_CLAIM = "username"
+
+
+def get_user_cache():
+    return caches[settings.USER_CACHE_ALIAS]
+
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+
+def forget_user(user_id):
+    get_user_cache().delete(user_key(user_id))
+
+
+def user_values(user_id):
+    """Return the field values of a user, or ``None`` when there is no such user."""
+    cache = get_user_cache()
+    values = cache.get(user_key(user_id))
+    if values is None:
+        User = get_user_model()
+        values = User._base_manager.filter(**{api_settings.USER_ID_FIELD: user_id}).values(
+            *(field.attname for field in User._meta.concrete_fields)).first()
+        if values is not None:
+            cache.set(user_key(user_id), values)
+    return values
+
+
+def claims_user(user_id, username=None):
+    """A user with only the id and username loaded; see ``_load_deferred``."""
+    User = get_user_model()
+    loaded = {api_settings.USER_ID_FIELD: user_id}
+    if username is not None:
+        loaded[User.USERNAME_FIELD] = username
+    fields = [field.attname for field in User._meta.concrete_fields if field.attname in loaded]
+    user = User.from_db(DEFAULT_DB_ALIAS, fields, [loaded[name] for name in fields])
+    # Reading a deferred field calls refresh_from_db(fields=[that field]).
+    user.refresh_from_db = partial(_load_deferred, user, user_id)
+    return user
+
+
+def _load_deferred(user, user_id, using=None, fields=None, from_queryset=None):
+    del user.refresh_from_db
+    values = user_values(user_id)
+    if values is None:
+        raise AuthenticationFailed(_("User not found"), code="user_not_found")
+    if api_settings.CHECK_USER_IS_ACTIVE and not values["is_active"]:
+        raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+    deferred = user.get_deferred_fields()
+    for name in deferred:
+        setattr(user, name, values[name])
+    if fields is None or not set(fields) <= deferred:
+        user.refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            # Comparing against the password hash needs the stored user.
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        # Tokens issued before the username claim existed load it on first use.
+        return claims_user(user_id, validated_token.get(USERNAME_CLAIM))
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token[USERNAME_CLAIM] = user.get_username()
+        return token
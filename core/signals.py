@@ -0,0 +1,10 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import forget_user
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, **kwargs):
+    forget_user(instance.pk)
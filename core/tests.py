@@ -1,3 +1,58 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from shop_app.models import Product, Review
+
+from .authentication import get_user_cache
+
+
+class ClaimsJWTAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username="claims", password="s3cret-pass",
+                                                        email="claims@example.com")
+
+    def setUp(self):
+        get_user_cache().clear()
+        access = self.client.post("/token/", {"username": "claims", "password": "s3cret-pass"}).json()["access"]
+        self.api = APIClient()
+        self.api.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+
+    def get(self, path, queries):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.api.get(path)
+        self.assertEqual(len(captured), queries, [query["sql"] for query in captured.captured_queries])
+        return response
+
+    def test_claims_need_no_query(self):
+        self.assertEqual(self.get("/get_username", 0).json(), {"username": "claims"})
+
+    def test_full_user_is_loaded_once_and_cached(self):
+        self.assertEqual(self.get("/user_info", 1).json()["email"], "claims@example.com")
+        self.get("/user_info", 0)
+
+        self.user.email = "new@example.com"
+        self.user.save()
+        self.assertEqual(self.get("/user_info", 1).json()["email"], "new@example.com")
+
+    def test_token_without_username_claim(self):
+        self.api.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+        self.assertEqual(self.get("/get_username", 1).json(), {"username": "claims"})
+
+    def test_inactive_user_is_rejected_when_loaded(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.api.get("/user_info").status_code, 401)
 
-# Create your tests here.
+    def test_writes_reference_the_user(self):
+        product = Product.objects.create(name="Claims tee", price=Decimal("10.00"), image="img/test.jpg")
+        response = self.api.post(f"/product_detail/{product.slug}/add_review/", {"body": "Good", "rating": 5},
+                                 format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Review.objects.get().reviewer, self.user)
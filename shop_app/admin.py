@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Product, Cart, CartItem, Review
+from django.utils import timezone
+from .models import Product, Cart, CartItem, Review, PaymentJob
+from .search import matching_products
 
 
 @admin.register(Product)
@@ -9,6 +11,12 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ("name",)  
     readonly_fields = ("slug",) 
 
+    def get_search_results(self, request, queryset, search_term):
+        # Served by the product search index instead of a scanning icontains.
+        if not search_term:
+            return queryset, False
+        return matching_products(queryset, search_term), False
+
     def get_form(self, request, obj=None, **kwargs):
         form = super().get_form(request, obj, **kwargs)
         if not obj:  
@@ -34,3 +42,15 @@ class ReviewAdmin(admin.ModelAdmin):
     list_display = ("reviewer", "product", "rating", "created")
     list_filter = ("rating", "created")  
     search_fields = ("reviewer__username", "product__name") 
+
+
+@admin.register(PaymentJob)
+class PaymentJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "transaction", "status", "attempts", "run_after", "modified_at")
+    list_filter = ("status", "kind")
+    search_fields = ("transaction__ref",)
+    actions = ("requeue",)
+
+    @admin.action(description="Requeue selected jobs")
+    def requeue(self, request, queryset):
+        queryset.update(status=PaymentJob.QUEUED, attempts=0, run_after=timezone.now(), locked_by="")
@@ -0,0 +1,133 @@
+"""Native async versions of the gateway-bound and read-heavy endpoints.
+
+Under ASGI (``backend.asgi``) these views await the payment gateways and the
+database instead of parking a worker thread on them, so one process can hold
+hundreds of slow checkouts in flight. They answer with the same payloads as
+their sync counterparts in ``shop_app.views``. DRF has no async views, so
+authentication, method checks and JSON parsing are done by ``async_api``.
+"""
+import json
+from functools import wraps
+
+import paypalrestsdk
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed
+
+from core.authentication import ClaimsJWTAuthentication
+
+from .cache import get_cache, record, view_key
+from .carts import checkout_amount, pending_transaction
+from .gateways import (CircuitOpenError, GatewayError, flutterwave_payment_payload, get_async_flutterwave_client,
+                       paypal_payment_payload)
+from .idempotency import idempotent
+from .jobs import payment_state
+from . import metrics
+from .models import Cart, Product, Transaction
+from .serializers import ProductSerializer
+from .views import BASE_URL, PAYMENT_MESSAGES
+
+
+def _authenticate(request):
+    result = ClaimsJWTAuthentication().authenticate(request)
+    return result[0] if result else AnonymousUser()
+
+
+def async_api(methods, authenticated=False):
+    """The parts of ``api_view`` the async views need.
+
+    Rejects other methods with 405, resolves ``request.user`` from the JWT
+    bearer token (401 when it is invalid, or missing and ``authenticated``)
+    and exposes the JSON body as ``request.data``.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+            try:
+                request.user = await sync_to_async(_authenticate)(request)
+            except AuthenticationFailed as e:
+                return JsonResponse({"detail": str(e.detail)}, status=401)
+            if authenticated and not request.user.is_authenticated:
+                return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+            try:
+                request.data = json.loads(request.body or b"{}")
+            except ValueError:
+                return JsonResponse({"detail": "JSON parse error."}, status=400)
+            return await view(request, *args, **kwargs)
+        # Like DRF's views: bearer tokens are not sent by browsers on their own.
+        return csrf_exempt(wrapper)
+    return decorator
+
+
+@async_api(["GET"])
+async def product_detail(request, slug):
+    cache = get_cache()
+    key = await sync_to_async(view_key)("product_detail", slug, request.GET)
+    data = await cache.aget(key)
+    if data is not None:
+        record("product_detail", "hits")
+        return JsonResponse(data, headers={"X-Cache": "HIT"})
+
+    record("product_detail", "misses")
+    try:
+        product = await Product.objects.aget(slug=slug)
+    except Product.DoesNotExist:
+        return JsonResponse({"error": "Product not found."}, status=404)
+    data = ProductSerializer(product).data
+    await cache.aset(key, data)
+    return JsonResponse(data, headers={"X-Cache": "MISS"})
+
+
+@async_api(["POST"], authenticated=True)
+@idempotent("initiate_payment")
+async def initiate_payment(request):
+    try:
+        cart = await Cart.objects.aget(cart_code=request.data.get("cart_code"))
+    except Cart.DoesNotExist:
+        return JsonResponse({"error": "Cart not found."}, status=404)
+    total_amount = await sync_to_async(checkout_amount)(cart)
+    payment = await sync_to_async(pending_transaction)(cart, total_amount, request.user, "NGN")
+    # The payload reads the user's email and phone, which may not be loaded yet.
+    payload = await sync_to_async(flutterwave_payment_payload)(payment, request.user, f"{BASE_URL}/payment-status/")
+    try:
+        response = await get_async_flutterwave_client().initiate_payment(payload)
+        return JsonResponse(response.json(), status=response.status_code)
+    except CircuitOpenError as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    except (GatewayError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=502)
+
+
+@async_api(["POST"], authenticated=True)
+@idempotent("initiate_paypal_payment")
+async def initiate_paypal_payment(request):
+    try:
+        cart = await Cart.objects.aget(cart_code=request.data.get("cart_code"))
+    except Cart.DoesNotExist:
+        return JsonResponse({"error": "Cart not found."}, status=404)
+    total_amount = await sync_to_async(checkout_amount)(cart)
+    payment = await sync_to_async(pending_transaction)(cart, total_amount, request.user)
+    paypal_payment = paypalrestsdk.Payment(paypal_payment_payload(payment.ref, total_amount, BASE_URL))
+    # paypalrestsdk only speaks blocking HTTP; run it off the event loop
+    # without tying up the thread that serializes ORM access.
+    with metrics.timer("gateway"):
+        created = await sync_to_async(paypal_payment.create, thread_sensitive=False)()
+    if created:
+        for link in paypal_payment.links:
+            if link.rel == "approval_url":
+                return JsonResponse({"approval_url": str(link.href)})
+    return JsonResponse({"error": paypal_payment.error}, status=400)
+
+
+@async_api(["GET"])
+async def payment_status(request, ref):
+    try:
+        payment = await Transaction.objects.aget(ref=ref)
+    except Transaction.DoesNotExist:
+        return JsonResponse({'error': 'Transaction not found.'}, status=404)
+    state = await sync_to_async(payment_state)(payment)
+    return JsonResponse({'ref': ref, 'status': state, **PAYMENT_MESSAGES[state]})
@@ -0,0 +1,208 @@
+import statistics
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from .carts import CHECKOUT_TAX, checkout_amount, pending_transaction
+from .models import Cart, CartItem, Product, Review, Transaction
+
+
+def without_response_cache():
+    caches = dict(settings.CACHES)
+    caches[settings.CATALOG_CACHE_ALIAS] = {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}
+    return override_settings(CACHES=caches)
+
+
+@contextmanager
+def benchmark_database(verbosity=0, response_cache=False):
+    """Run the block against a throwaway test database, never the configured one.
+
+    The catalog response cache is disabled unless ``response_cache`` is set,
+    so repeated requests measure the full request path.
+    """
+    old_name = connection.settings_dict["NAME"]
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        if response_cache:
+            yield
+        else:
+            with without_response_cache():
+                yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        teardown_test_environment()
+
+
+STYLES = ["Classic", "Vintage", "Slim", "Oversized", "Casual", "Formal", "Summer", "Winter", "Sporty", "Relaxed"]
+MATERIALS = ["Cotton", "Linen", "Denim", "Leather", "Wool", "Silk", "Suede", "Canvas", "Velvet", "Cashmere"]
+GARMENTS = ["Shirt", "Dress", "Jacket", "Trousers", "Sneakers", "Sweater", "Skirt", "Blazer", "Hoodie", "Scarf",
+            "Sandals", "Coat"]
+
+
+def review_targets(count, products):
+    """``(product index, rating)`` of each of the ``count`` reviews ``seed_reviews`` spreads over ``products``."""
+    return ((i * 31 % products, i % 5 + 1) for i in range(count))
+
+
+def seed_products(count, batch_size=5000, reviews=0):
+    """Create ``count`` products.
+
+    ``reviews`` is how many reviews ``seed_reviews`` will add next; their
+    rating aggregates are stored with the products right away. Updating every
+    row afterwards, as ``rebuild_rating_aggregates`` does, rewrites the search
+    index too and takes minutes for a million products.
+    """
+    sizes = [code for code, _ in Product.SIZES]
+    colors = [code for code, _ in Product.COLORS]
+    stars = [0] * (5 * count)
+    for index, rating in review_targets(reviews, count):
+        stars[5 * index + rating - 1] += 1
+
+    def product(i):
+        counts = stars[5 * i:5 * i + 5]
+        rating_count = sum(counts)
+        rating_sum = sum(star * n for star, n in enumerate(counts, 1))
+        return Product(
+            name=f"{STYLES[i % 10]} {MATERIALS[i // 10 % 10]} {GARMENTS[i // 100 % 12]} {i}",
+            slug=f"bench-product-{i}",
+            image="img/bench.jpg",
+            description=(f"A {colors[i % len(colors)].lower()} {MATERIALS[i // 7 % 10].lower()} piece, "
+                         f"synthetic product number {i} used for benchmarking."),
+            price=Decimal(i % 500) + Decimal("0.99"),
+            size=sizes[i % len(sizes)],
+            color=colors[i % len(colors)],
+            popularity=(i * 7919) % 1000,
+            rating_count=rating_count,
+            rating_sum=rating_sum,
+            rating_average=rating_sum / rating_count if rating_count else 0,
+            **{f"rating_{star}": n for star, n in enumerate(counts, 1)},
+        )
+
+    for start in range(0, count, batch_size):
+        Product.objects.bulk_create([product(i) for i in range(start, min(start + batch_size, count))])
+
+
+def seed_reviews(count, batch_size=5000):
+    reviewer, _ = get_user_model().objects.get_or_create(username="bench-reviewer")
+    product_ids = list(Product.objects.order_by("id").values_list("id", flat=True))
+    if not product_ids:
+        return
+    targets = review_targets(count, len(product_ids))
+    for start in range(0, count, batch_size):
+        Review.objects.bulk_create([
+            Review(product_id=product_ids[index], reviewer=reviewer, body=f"Synthetic review {i}.", rating=rating)
+            for i, (index, rating) in zip(range(start, min(start + batch_size, count)), targets)
+        ])
+
+
+def seed_users(count, batch_size=5000):
+    """Create ``count`` users without a usable password and return their ids."""
+    User = get_user_model()
+    for start in range(0, count, batch_size):
+        User.objects.bulk_create([
+            User(username=f"bench-user-{i}", email=f"bench-user-{i}@example.com", password=make_password(None))
+            for i in range(start, min(start + batch_size, count))
+        ])
+    return list(User.objects.filter(username__startswith="bench-user-").order_by("id").values_list("id", flat=True))
+
+
+def seed_carts(count, user_ids, items_per_cart=3, batch_size=2000):
+    """Create ``count`` carts of ``items_per_cart`` distinct products, spread over ``user_ids``.
+
+    Cart ``i`` belongs to ``user_ids[i % len(user_ids)]``, and each user's
+    carts alternate between open and paid for (with a completed transaction),
+    so every user with two carts or more has both a cart and an order history.
+    Cart codes are ``cart0000000``, ``cart0000001``...
+    """
+    product_ids = list(Product.objects.order_by("id").values_list("id", flat=True))
+    for start in range(0, count, batch_size):
+        carts = Cart.objects.bulk_create([
+            Cart(cart_code=f"cart{i:07d}", user_id=user_ids[i % len(user_ids)],
+                 paid=i // len(user_ids) % 2 == 1)
+            for i in range(start, min(start + batch_size, count))
+        ])
+        # Not every backend returns primary keys from a bulk insert.
+        carts = list(Cart.objects.filter(cart_code__in=[cart.cart_code for cart in carts]).order_by("id"))
+        items = [
+            CartItem(cart=cart, product_id=product_ids[(i * items_per_cart + k) % len(product_ids)], quantity=k + 1)
+            for i, cart in enumerate(carts, start)
+            for k in range(items_per_cart)
+        ]
+        CartItem.objects.bulk_create(items)
+        prices = dict(Product.objects.filter(id__in={item.product_id for item in items}).values_list("id", "price"))
+        amounts = {}
+        for item in items:
+            amounts[item.cart_id] = amounts.get(item.cart_id, CHECKOUT_TAX) + prices[item.product_id] * item.quantity
+        Transaction.objects.bulk_create([
+            Transaction(ref=f"bench-order-{cart.cart_code}", cart=cart, user_id=cart.user_id,
+                        amount=amounts[cart.pk], status="completed")
+            for cart in carts if cart.paid
+        ])
+
+
+def seed_checkouts(count, user):
+    """Create ``count`` one-item carts of ``user``, each with its pending transaction opened.
+
+    Checking them out again only reads from the database, so a concurrent
+    benchmark measures the gateway round trip rather than write contention.
+    """
+    product = Product.objects.order_by("id").first() or Product.objects.create(
+        name="Bench checkout product", slug="bench-checkout-product", image="img/bench.jpg", price=Decimal("25.00"),
+    )
+    # cart_code holds 11 characters.
+    carts = Cart.objects.bulk_create([Cart(cart_code=f"bench{i:06d}", user=user) for i in range(count)])
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=1) for cart in carts])
+    for cart in carts:
+        pending_transaction(cart, checkout_amount(cart), user)
+    return [cart.cart_code for cart in carts]
+
+
+def summarize(timings):
+    """Latency percentiles in milliseconds of a list of durations in seconds."""
+    timings = sorted(timing * 1000 for timing in timings)
+    if not timings:
+        return {}
+
+    def percentile(fraction):
+        return round(timings[min(len(timings) - 1, int(fraction * len(timings)))], 2)
+    return {"p50_ms": percentile(0.50), "p95_ms": percentile(0.95), "p99_ms": percentile(0.99),
+            "max_ms": round(timings[-1], 2)}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(client, path, data=None, repeat=5):
+    """Issue ``repeat`` GETs and return latency percentiles, payload size and query count."""
+    client = client or Client()
+    timings = []
+    for _ in range(repeat):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            response = client.get(path, data)
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "path": path,
+        "params": data or {},
+        "status": response.status_code,
+        "bytes": len(response.content),
+        "queries": counter.count,
+        "p50_ms": round(statistics.median(timings), 2),
+        "max_ms": round(timings[-1], 2),
+    }
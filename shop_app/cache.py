@@ -0,0 +1,154 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import BigIntegerField, F, Value
+from django.db.models.functions import Greatest
+from rest_framework.response import Response
+
+from .models import CacheVersion
+
+
+EPOCH_KEY = "version:epoch"
+CATALOG_KEY = "version:catalog"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def product_key(slug):
+    return f"version:product:{slug}"
+
+
+def get_versions(*keys):
+    """Return the current version stamp of each key, creating missing ones.
+
+    Stamps are nanosecond timestamps rather than counters, so the replica
+    router can tell how recent a write is. They live in the database rather
+    than in the catalog cache: with a per-process cache a write would only
+    reach the process that handled it, and every other one would keep serving
+    (and answering 304 for) what it cached before.
+    """
+    versions = dict(CacheVersion.objects.filter(key__in=keys).values_list("key", "stamp"))
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time_ns()
+        CacheVersion.objects.bulk_create([CacheVersion(key=key, stamp=now) for key in missing],
+                                         ignore_conflicts=True)
+        # Another process may have created some of them first.
+        versions.update(CacheVersion.objects.filter(key__in=missing).values_list("key", "stamp"))
+    return [versions[key] for key in keys]
+
+
+def bump(*keys):
+    # Never move a stamp backwards, even from a host whose clock is behind.
+    now = time.time_ns()
+    updated = CacheVersion.objects.filter(key__in=keys).update(
+        stamp=Greatest(F("stamp") + 1, Value(now, BigIntegerField())))
+    if updated < len(set(keys)):
+        CacheVersion.objects.bulk_create([CacheVersion(key=key, stamp=now) for key in keys], ignore_conflicts=True)
+
+
+def request_versions(request, slug=None):
+    """``get_versions`` of a catalog view's keys, read once per request.
+
+    The conditional-GET check, the response cache and the replica router of a
+    view all depend on the same stamps, so they share one query.
+    """
+    request = getattr(request, "_request", request)
+    if not hasattr(request, "_catalog_versions"):
+        request._catalog_versions = get_versions(*version_keys(slug))
+    return request._catalog_versions
+
+
+def invalidate_product(slug):
+    keys = [CATALOG_KEY]
+    if slug:
+        keys.append(product_key(slug))
+    bump(*keys)
+
+
+def invalidate_all():
+    bump(EPOCH_KEY)
+
+
+def normalize_params(query_params, allowed):
+    """Reduce query params to a canonical, order-independent tuple.
+
+    Parameters outside ``allowed`` are dropped so cache busters do not fragment
+    the cache, and comma separated ``fields`` lists are sorted.
+    """
+    normalized = []
+    for name in sorted(allowed):
+        value = query_params.get(name)
+        if value is None or value == "":
+            continue
+        if name == "fields":
+            value = ",".join(sorted({field.strip() for field in value.split(",") if field.strip()}))
+        normalized.append((name, value.strip()))
+    return tuple(normalized)
+
+
+def response_key(namespace, versions, params):
+    digest = hashlib.sha1(repr((versions, params)).encode()).hexdigest()
+    return f"response:{namespace}:{digest}"
+
+
+def version_keys(slug=None):
+    """The version keys of a product's detail views, or of the listings."""
+    return [EPOCH_KEY, product_key(slug) if slug else CATALOG_KEY]
+
+
+def view_key(namespace, slug, query_params, params=(), versions=None):
+    if versions is None:
+        versions = get_versions(*version_keys(slug))
+    return response_key(namespace, versions, (slug, normalize_params(query_params, params)))
+
+
+def record(namespace, outcome):
+    with _stats_lock:
+        _stats[(namespace, outcome)] += 1
+
+
+def cache_stats():
+    with _stats_lock:
+        stats = {}
+        for (namespace, outcome), count in _stats.items():
+            stats.setdefault(namespace, {"hits": 0, "misses": 0})[outcome] = count
+        return stats
+
+
+def cache_response(namespace, params=()):
+    """Cache the ``data`` of successful responses of a read-only catalog view.
+
+    Listings are keyed on the catalog version, detail views (those taking a
+    ``slug``) on that product's version; both also carry the global epoch.
+    The versions are bumped by the signal handlers in ``shop_app.signals``.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            slug = kwargs.get("slug")
+            key = view_key(namespace, slug, request.query_params, params, request_versions(request, slug))
+            cache = get_cache()
+            data = cache.get(key)
+            if data is not None:
+                record(namespace, "hits")
+                return Response(data, headers={"X-Cache": "HIT"})
+
+            record(namespace, "misses")
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data)
+                response["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,260 @@
+import uuid
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product, Transaction
+
+
+MAX_OPERATIONS = 500
+CHECKOUT_TAX = Decimal("4.00")
+
+
+class CartOperationError(Exception):
+    def __init__(self, message, index=None):
+        super().__init__(message)
+        self.index = index
+
+
+def cart_totals(cart):
+    """Return ``sum_total``, ``num_of_items`` and ``num_of_product`` of a cart.
+
+    The result is memoized on the cart instance, so the serializers and the
+    payment views of one request share a single computation. When the items
+    are already prefetched they are summed in place; otherwise one aggregate
+    query does the work in the database.
+    """
+    if getattr(cart, "_totals", None) is None:
+        prefetched = getattr(cart, "_prefetched_objects_cache", {})
+        if "items" in prefetched:
+            items = prefetched["items"]
+            cart._totals = {
+                "sum_total": sum((item.product.price * item.quantity for item in items), Decimal("0.00")),
+                "num_of_items": sum(item.quantity for item in items),
+                "num_of_product": len({item.product_id for item in items}),
+            }
+        else:
+            cart._totals = CartItem.objects.filter(cart=cart).aggregate(
+                sum_total=Coalesce(
+                    Sum(F("quantity") * F("product__price"), output_field=DecimalField(max_digits=12, decimal_places=2)),
+                    Value(Decimal("0.00")),
+                ),
+                num_of_items=Coalesce(Sum("quantity"), 0),
+                num_of_product=Count("product", distinct=True),
+            )
+    return cart._totals
+
+
+def checkout_amount(cart):
+    return cart_totals(cart)["sum_total"] + CHECKOUT_TAX
+
+
+def pending_transaction(cart, amount, user=None, currency="NGN"):
+    """Return the cart's pending transaction, opening one when there is none.
+
+    A cart has at most one pending transaction (a partial unique constraint
+    enforces it), so a repeated checkout reuses the same reference instead of
+    piling up orphans. If the amount changed since, the stale transaction is
+    marked ``superseded`` and a fresh one replaces it.
+    """
+    with transaction.atomic():
+        payment = Transaction.objects.select_for_update().filter(cart=cart, status="pending").first()
+        if payment is not None:
+            if payment.amount == amount and payment.currency == currency:
+                return payment
+            payment.status = "superseded"
+            payment.save(update_fields=["status", "modified_at"])
+        try:
+            with transaction.atomic():
+                return Transaction.objects.create(ref=str(uuid.uuid4()), cart=cart, amount=amount,
+                                                  currency=currency, user=user, status="pending")
+        except IntegrityError:
+            # A concurrent checkout of the same cart won the race.
+            pass
+    return Transaction.objects.get(cart=cart, status="pending")
+
+
+def touch_cart(cart_id):
+    Cart.objects.filter(pk=cart_id).update(modified_at=timezone.now())
+
+
+def add_to_cart(cart_code, product_id, quantity=1):
+    """Add ``quantity`` of a product to a cart and return the resulting item.
+
+    The ``(cart, product)`` unique constraint makes ``get_or_create`` safe
+    against concurrent first adds, and the increment of an existing item is a
+    single ``UPDATE ... SET quantity = quantity + n`` so concurrent adds from
+    several tabs all count.
+    """
+    if quantity < 1:
+        raise CartOperationError("quantity must be at least 1.")
+    with transaction.atomic():
+        cart, _ = Cart.objects.get_or_create(cart_code=cart_code)
+        if cart.paid:
+            raise CartOperationError("Cart has already been paid for.")
+        product = Product.objects.get(id=product_id)
+        item, created = CartItem.objects.get_or_create(cart=cart, product=product, defaults={"quantity": quantity})
+        if not created:
+            CartItem.objects.filter(pk=item.pk).update(quantity=F("quantity") + quantity)
+            item.refresh_from_db(fields=["quantity"])
+            touch_cart(cart.pk)
+    return item
+
+
+def change_quantity(item_id, delta):
+    """Atomically add ``delta`` (which may be negative) to an item's quantity.
+
+    An item whose quantity would drop to zero or below is removed; ``None`` is
+    returned in that case.
+    """
+    with transaction.atomic():
+        updated = CartItem.objects.filter(pk=item_id, quantity__gt=-delta).update(quantity=F("quantity") + delta)
+        if updated:
+            item = CartItem.objects.select_related("product").get(pk=item_id)
+            touch_cart(item.cart_id)
+            return item
+        item = CartItem.objects.filter(pk=item_id).first()
+        if item is None:
+            raise CartItem.DoesNotExist("CartItem matching query does not exist.")
+        item.delete()
+    return None
+
+
+def set_quantity(item_id, quantity):
+    if quantity < 0:
+        raise CartOperationError("quantity must not be negative.")
+    if quantity == 0:
+        item = CartItem.objects.get(pk=item_id)
+        item.delete()
+        return None
+    with transaction.atomic():
+        if not CartItem.objects.filter(pk=item_id).update(quantity=quantity):
+            raise CartItem.DoesNotExist("CartItem matching query does not exist.")
+        item = CartItem.objects.select_related("product").get(pk=item_id)
+        touch_cart(item.cart_id)
+    return item
+
+
+def merge_carts(cart_code, user):
+    """Attach the anonymous cart ``cart_code`` to ``user`` at login.
+
+    Items of the user's other unpaid carts are folded into it (quantities of
+    the same product are summed) and those carts are deleted, so the client
+    can keep using the cart code it already has. Carts with a pending
+    transaction are left alone.
+    """
+    with transaction.atomic():
+        cart = Cart.objects.select_for_update().get(cart_code=cart_code, paid=False)
+        if cart.user_id not in (None, user.pk):
+            raise CartOperationError("Cart belongs to another user.")
+        # A cart with a payment in progress stays as it is: deleting it would
+        # cascade to the transaction its gateway callback has to find.
+        others = list(Cart.objects.select_for_update().filter(user=user, paid=False).exclude(pk=cart.pk)
+                      .exclude(transactions__status="pending"))
+
+        items = {item.product_id: item for item in CartItem.objects.select_for_update().filter(cart=cart)}
+        moved, updated = [], []
+        for item in CartItem.objects.select_for_update().filter(cart__in=others).order_by("id"):
+            if item.product_id in items:
+                items[item.product_id].quantity += item.quantity
+                updated.append(items[item.product_id])
+            else:
+                items[item.product_id] = item
+                moved.append(item.pk)
+
+        if moved:
+            CartItem.objects.filter(pk__in=moved).update(cart=cart)
+        if updated:
+            CartItem.objects.bulk_update(list({item.pk: item for item in updated}.values()), ["quantity"])
+        if others:
+            Cart.objects.filter(pk__in=[other.pk for other in others]).delete()
+        cart.user = user
+        cart.save(update_fields=["user", "modified_at"])
+    return cart
+
+
+def _quantity(operation, index, minimum):
+    try:
+        quantity = int(operation.get("quantity", 1))
+    except (TypeError, ValueError):
+        raise CartOperationError("quantity must be an integer.", index)
+    if quantity < minimum:
+        raise CartOperationError(f"quantity must be at least {minimum}.", index)
+    return quantity
+
+
+def apply_cart_operations(cart_code, operations):
+    """Apply a list of add/update/remove operations to one cart atomically.
+
+    Operations are folded in memory in order and written back with one
+    ``bulk_create``, one ``bulk_update`` and one ``delete``, so the number of
+    queries does not depend on how many operations the client sends. Any
+    invalid operation rolls the whole batch back.
+    """
+    if not cart_code:
+        raise CartOperationError("cart_code is required.")
+    if not isinstance(operations, list) or not operations:
+        raise CartOperationError("operations must be a non-empty list.")
+    if len(operations) > MAX_OPERATIONS:
+        raise CartOperationError(f"At most {MAX_OPERATIONS} operations are allowed per request.")
+
+    with transaction.atomic():
+        cart, _ = Cart.objects.select_for_update().get_or_create(cart_code=cart_code)
+        if cart.paid:
+            raise CartOperationError("Cart has already been paid for.")
+
+        existing = {item.product_id: item for item in CartItem.objects.select_for_update().filter(cart=cart)}
+        by_item_id = {item.id: item.product_id for item in existing.values()}
+        original_quantities = {product_id: item.quantity for product_id, item in existing.items()}
+        requested = {operation.get("product_id") for operation in operations
+                     if isinstance(operation, dict) and operation.get("op") == "add"}
+        known_products = set(Product.objects.filter(id__in=requested).values_list("id", flat=True))
+
+        items = dict(existing)
+        for index, operation in enumerate(operations):
+            if not isinstance(operation, dict):
+                raise CartOperationError("Each operation must be an object.", index)
+            op = operation.get("op")
+            product_id = operation.get("product_id")
+            if product_id is None and "item_id" in operation:
+                product_id = by_item_id.get(operation["item_id"])
+                if product_id is None:
+                    raise CartOperationError("Cart item not found.", index)
+
+            if op == "add":
+                if product_id not in known_products:
+                    raise CartOperationError("Product not found.", index)
+                quantity = _quantity(operation, index, minimum=1)
+                if product_id in items:
+                    items[product_id].quantity += quantity
+                else:
+                    items[product_id] = CartItem(cart=cart, product_id=product_id, quantity=quantity)
+            elif op == "update":
+                if product_id not in items:
+                    raise CartOperationError("Product is not in the cart.", index)
+                quantity = _quantity(operation, index, minimum=0)
+                if quantity == 0:
+                    del items[product_id]
+                else:
+                    items[product_id].quantity = quantity
+            elif op == "remove":
+                items.pop(product_id, None)
+            else:
+                raise CartOperationError("op must be one of add, update or remove.", index)
+
+        removed = [item.id for product_id, item in existing.items() if product_id not in items]
+        created = [item for item in items.values() if item.pk is None]
+        updated = [item for product_id, item in items.items()
+                   if item.pk is not None and item.quantity != original_quantities[product_id]]
+
+        if removed:
+            CartItem.objects.filter(id__in=removed).delete()
+        if created:
+            CartItem.objects.bulk_create(created)
+        if updated:
+            CartItem.objects.bulk_update(updated, ["quantity"])
+        cart.save(update_fields=["modified_at"])
+    return cart
@@ -0,0 +1,274 @@
+"""Streaming CSV and JSON Lines import and export of the product catalog.
+
+Files are read and written one record at a time and imported in batches, so
+memory stays bounded by the batch size however large the catalog is.
+Imports are upserts keyed on ``slug``: rows naming an existing slug update
+that product's columns present in the file, other rows create products (rows
+without a slug get one allocated). ``image`` is either a storage name such as
+``img/tee.jpg`` or an http(s) URL, which is downloaded into ``IMAGE_DIR``.
+"""
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlparse
+
+import requests
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import validate_slug
+from django.db import DatabaseError, transaction
+
+from .models import Product
+
+
+FIELDS = ["slug", "name", "description", "price", "size", "color", "popularity", "image"]
+FORMATS = ("csv", "jsonl")
+IMAGE_DIR = "img/imports"
+IMAGE_TIMEOUT = 15
+MAX_NAME_LENGTH = Product._meta.get_field("name").max_length
+MAX_PRICE = Decimal(10) ** (Product._meta.get_field("price").max_digits - Product._meta.get_field("price").decimal_places)
+
+
+class RowError(ValueError):
+    pass
+
+
+def detect_format(path, format=None):
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension in ("jsonl", "ndjson"):
+        return "jsonl"
+    if extension == "csv":
+        return "csv"
+    raise ValueError(f"Cannot tell the format of {path!r}; pass one of {', '.join(FORMATS)}.")
+
+
+def read_rows(file, format):
+    """Yield ``(line, row)`` for every record of an open text file.
+
+    ``row`` is a dict, or ``None`` for a JSON line that is not an object.
+    """
+    if format == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line, text in enumerate(file, 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError:
+            row = None
+        yield line, row if isinstance(row, dict) else None
+
+
+def clean_row(row):
+    """Return the model field values of the ``FIELDS`` present in ``row``."""
+    if row is None:
+        raise RowError("Not a JSON object.")
+    values = {}
+    for name in FIELDS:
+        if name not in row:
+            continue
+        value = row[name]
+        value = "" if value is None else str(value).strip()
+        if name == "slug":
+            if value:
+                try:
+                    validate_slug(value)
+                except ValidationError:
+                    raise RowError(f"Invalid slug {value!r}.") from None
+            value = value or None
+        elif name == "description":
+            value = value or None
+        elif name == "name":
+            if not value or len(value) > MAX_NAME_LENGTH:
+                raise RowError(f"name must be 1 to {MAX_NAME_LENGTH} characters long.")
+        elif name == "price":
+            try:
+                value = Decimal(value).quantize(Decimal("0.01"))
+            except InvalidOperation:
+                raise RowError(f"Invalid price {value!r}.") from None
+            # NaN survives quantize() but cannot be compared.
+            if not value.is_finite() or not 0 <= value < MAX_PRICE:
+                raise RowError(f"Invalid price {row[name]!r}.")
+        elif name in ("size", "color"):
+            choices = dict(Product.SIZES if name == "size" else Product.COLORS)
+            if value and value not in choices:
+                raise RowError(f"{name} must be one of {', '.join(choices)}.")
+            value = value or None
+        elif name == "popularity":
+            try:
+                value = int(value or 0)
+            except ValueError:
+                raise RowError(f"Invalid popularity {value!r}.") from None
+        values[name] = value
+    return values
+
+
+def is_url(image):
+    return urlparse(image).scheme in ("http", "https")
+
+
+class ImageFetcher:
+    """Download image URLs into storage on a pool of threads.
+
+    Files are named after the URL, so a re-run of an interrupted import does
+    not download the images it already stored.
+    """
+
+    def __init__(self, workers=8, storage=default_storage, timeout=IMAGE_TIMEOUT):
+        self.storage = storage
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+
+    def name_for(self, url):
+        extension = os.path.splitext(urlparse(url).path)[1].lower() or ".jpg"
+        return f"{IMAGE_DIR}/{hashlib.sha1(url.encode()).hexdigest()[:20]}{extension}"
+
+    def fetch(self, url):
+        """Return ``(storage name, None)`` or ``(None, error)``."""
+        name = self.name_for(url)
+        if self.storage.exists(name):
+            return name, None
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        try:
+            response = session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            return None, f"Could not fetch image {url}: {e}"
+        return self.storage.save(name, ContentFile(response.content)), None
+
+    def fetch_all(self, urls):
+        urls = list(dict.fromkeys(urls))
+        return dict(zip(urls, self.pool.map(self.fetch, urls)))
+
+    def close(self):
+        self.pool.shutdown()
+
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def rate(self):
+        return self.rows / max(time.perf_counter() - self.started, 1e-9)
+
+
+def import_catalog(rows, batch_size=1000, image_workers=8, on_error=None):
+    """Upsert ``(line, row)`` pairs from ``read_rows`` in batches.
+
+    Yields the running ``ImportStats`` after every batch. Rows that fail
+    validation are skipped and passed to ``on_error(line, message)``.
+    """
+    stats = ImportStats()
+    fetcher = ImageFetcher(workers=image_workers)
+    batch = []
+    try:
+        for line, row in rows:
+            batch.append((line, row))
+            if len(batch) >= batch_size:
+                _import_batch(batch, fetcher, stats, on_error)
+                batch = []
+                yield stats
+        if batch:
+            _import_batch(batch, fetcher, stats, on_error)
+            yield stats
+    finally:
+        fetcher.close()
+
+
+def _import_batch(batch, fetcher, stats, on_error):
+    def fail(line, message):
+        stats.failed += 1
+        if on_error:
+            on_error(line, message)
+
+    stats.rows += len(batch)
+    cleaned = {}
+    for line, row in batch:
+        try:
+            values = clean_row(row)
+        except RowError as e:
+            fail(line, str(e))
+            continue
+        # A slug repeated within the batch: the last row wins, as it would
+        # across batches.
+        cleaned[values.get("slug") or f"line:{line}"] = (line, values)
+
+    existing = Product.objects.in_bulk([key for key in cleaned if not key.startswith("line:")], field_name="slug")
+    images = fetcher.fetch_all(values["image"] for _, values in cleaned.values() if is_url(values.get("image", "")))
+
+    created, updated = [], {}
+    lines = []
+    for key, (line, values) in cleaned.items():
+        if key not in existing and not (values.get("name") and "price" in values):
+            fail(line, "New products need a name and a price.")
+            continue
+        if values.get("image") in images:
+            values["image"], error = images[values["image"]]
+            if error:
+                fail(line, error)
+                continue
+        lines.append(line)
+        if key not in existing:
+            created.append(Product(**values))
+            continue
+        # Only the columns present in the file change; a row with nothing but
+        # the slug of an existing product leaves it as is.
+        product = existing[key]
+        columns = tuple(sorted(column for column in values if column != "slug"))
+        for column in columns:
+            setattr(product, column, values[column])
+        updated.setdefault(columns, []).append(product)
+
+    try:
+        with transaction.atomic():
+            if created:
+                Product.objects.bulk_create(created)
+            for columns, products in updated.items():
+                if columns:
+                    Product.objects.bulk_update(products, columns)
+    except DatabaseError as e:
+        # A slug created concurrently, a value the database rejects...
+        for line in lines:
+            fail(line, f"Batch failed: {e}")
+        return
+    stats.created += len(created)
+    stats.updated += sum(len(products) for products in updated.values())
+
+
+def export_catalog(file, format, queryset=None, chunk_size=2000):
+    """Write the products of ``queryset`` to an open text file; return how many."""
+    queryset = Product.objects.all() if queryset is None else queryset
+    rows = queryset.order_by("id").values(*FIELDS).iterator(chunk_size=chunk_size)
+    count = 0
+    if format == "csv":
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({name: "" if value is None else value for name, value in row.items()})
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+            count += 1
+    return count
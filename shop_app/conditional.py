@@ -0,0 +1,60 @@
+import hashlib
+from datetime import datetime, timezone
+
+from django.views.decorators.http import condition
+
+from .cache import request_versions
+from .models import Cart
+
+
+def _digest(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def _versioned_at(versions):
+    return datetime.fromtimestamp(max(versions) / 1e9, tz=timezone.utc)
+
+
+# The validators come from the shared version stamps, so a process that did not
+# handle a write still stops answering 304 for what the write changed.
+
+def catalog_etag(request, slug=None):
+    return _digest(request.path, sorted(request.GET.lists()), request_versions(request, slug))
+
+
+def catalog_last_modified(request, slug=None):
+    return _versioned_at(request_versions(request, slug))
+
+
+def unpaid_cart(request):
+    """Return the unpaid cart named by ``?cart_code=``, loading it once per request.
+
+    The conditional-GET check and the view share the row, so serving a fresh
+    body costs no extra query and a 304 costs exactly one.
+    """
+    request = getattr(request, "_request", request)
+    if not hasattr(request, "_unpaid_cart"):
+        request._unpaid_cart = Cart.objects.filter(cart_code=request.GET.get("cart_code"), paid=False).first()
+    return request._unpaid_cart
+
+
+# Cart payloads carry the products' current prices and the totals computed
+# from them, so a catalog change revalidates carts too.
+
+def cart_etag(request):
+    cart = unpaid_cart(request)
+    if cart is None:
+        return None
+    return _digest(request.path, cart.id, cart.modified_at, request_versions(request))
+
+
+def cart_last_modified(request):
+    cart = unpaid_cart(request)
+    if cart is None:
+        return None
+    catalog_modified = _versioned_at(request_versions(request))
+    return max(cart.modified_at, catalog_modified) if cart.modified_at else catalog_modified
+
+
+catalog_condition = condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified)
+cart_condition = condition(etag_func=cart_etag, last_modified_func=cart_last_modified)
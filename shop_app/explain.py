@@ -0,0 +1,26 @@
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+PG_SEQ_SCAN_RE = re.compile(r"Seq Scan on (\w+)")
+# SQLite reports a scan that uses an index as "SCAN t USING [COVERING] INDEX i".
+SQLITE_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+
+
+def explain(sql, using=DEFAULT_DB_ALIAS):
+    """Return the query plan of ``sql`` (with its parameters inlined) as lines of text."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}")
+        return [str(row[-1]) for row in cursor.fetchall()]
+
+
+def sequential_scans(plan, using=DEFAULT_DB_ALIAS):
+    """Return the tables a plan from ``explain`` reads in full."""
+    vendor = connections[using].vendor
+    if vendor == "postgresql":
+        return [match.group(1) for line in plan for match in PG_SEQ_SCAN_RE.finditer(line)]
+    if vendor == "sqlite":
+        return [match.group(1) for line in plan if (match := SQLITE_SCAN_RE.match(line.strip()))]
+    return []
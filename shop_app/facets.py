@@ -0,0 +1,92 @@
+"""Facet counts for the catalog filters.
+
+``size`` and ``color`` take the values of ``Product.SIZES`` and
+``Product.COLORS``; ``price`` takes the key of one of ``PRICE_BUCKETS``.
+Counts are disjunctive: the counts of a facet apply the selections of the
+other facets but not its own, so picking a size still shows how many
+products every other size has.
+"""
+from decimal import Decimal
+
+from django.db.models import Case, CharField, Count, Value, When
+
+from .models import Product
+
+
+class InvalidFacet(ValueError):
+    pass
+
+
+# (key, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = [
+    ("0-25", None, Decimal("25")),
+    ("25-50", Decimal("25"), Decimal("50")),
+    ("50-100", Decimal("50"), Decimal("100")),
+    ("100-200", Decimal("100"), Decimal("200")),
+    ("200+", Decimal("200"), None),
+]
+
+PRICE_KEYS = [key for key, _, _ in PRICE_BUCKETS]
+
+FACETS = ("size", "color", "price")
+
+
+def price_bucket():
+    """Annotate each product with the key of its price bucket."""
+    whens = [When(price__lt=high, then=Value(key)) for key, _, high in PRICE_BUCKETS if high is not None]
+    return Case(*whens, default=Value(PRICE_BUCKETS[-1][0]), output_field=CharField())
+
+
+def selected_facets(query_params):
+    """Return ``{facet: value or None}`` for the facets selected in ``query_params``."""
+    selected = {facet: query_params.get(facet) or None for facet in FACETS}
+    if selected["price"] is not None and selected["price"] not in PRICE_KEYS:
+        raise InvalidFacet(f"price must be one of {', '.join(PRICE_KEYS)}.")
+    return selected
+
+
+def filter_facets(queryset, selected):
+    if selected["size"]:
+        queryset = queryset.filter(size=selected["size"])
+    if selected["color"]:
+        queryset = queryset.filter(color=selected["color"])
+    if selected["price"]:
+        _, low, high = next(bucket for bucket in PRICE_BUCKETS if bucket[0] == selected["price"])
+        if low is not None:
+            queryset = queryset.filter(price__gte=low)
+        if high is not None:
+            queryset = queryset.filter(price__lt=high)
+    return queryset
+
+
+def facet_counts(queryset, selected):
+    """Count the products of ``queryset`` per facet value in one grouped query.
+
+    ``queryset`` carries the filters that are not facets (``min_rating``);
+    the facet selections are applied to the grouped rows here.
+    """
+    groups = (queryset.annotate(price_bucket=price_bucket()).order_by()
+              .values_list("size", "color", "price_bucket").annotate(count=Count("id")))
+    choices = {
+        "size": Product.SIZES,
+        "color": Product.COLORS,
+        "price": [(key, key) for key in PRICE_KEYS],
+    }
+    counts = {facet: dict.fromkeys(dict(choices[facet]), 0) for facet in FACETS}
+    total = 0
+    for size, color, bucket, count in groups:
+        values = {"size": size, "color": color, "price": bucket}
+        misses = [facet for facet in FACETS if selected[facet] and values[facet] != selected[facet]]
+        if not misses:
+            total += count
+        for facet in FACETS:
+            if misses in ([], [facet]) and values[facet] in counts[facet]:
+                counts[facet][values[facet]] += count
+
+    result = {"total": total}
+    for facet in FACETS:
+        result[facet] = [
+            {"value": value, "label": label, "count": counts[facet][value], "selected": value == selected[facet]}
+            for value, label in choices[facet]
+        ]
+    return result
@@ -0,0 +1,304 @@
+import asyncio
+import itertools
+import math
+import threading
+import time
+import weakref
+from functools import lru_cache
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+
+class GatewayError(Exception):
+    pass
+
+
+class CircuitOpenError(GatewayError):
+    pass
+
+
+class CircuitBreaker:
+    """Stop calling a gateway after ``failure_threshold`` consecutive failures.
+
+    While open, calls fail immediately for ``reset_timeout`` seconds; then a
+    single trial call is let through (half-open) and its outcome either closes
+    the circuit or opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        """Raise ``CircuitOpenError`` or return whether this call is the trial."""
+        with self.lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.trial_running):
+                raise CircuitOpenError("Payment gateway is unavailable, try again shortly.")
+            if state == "half-open":
+                self.trial_running = True
+                return True
+            return False
+
+    def end_trial(self):
+        # Runs after every trial, however it ended, so an unexpected exception
+        # (a bad payload, a cancelled task) cannot hold the circuit half-open
+        # with no call allowed through.
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def flutterwave_payment_payload(payment, user, redirect_url):
+    return {
+        "tx_ref": payment.ref,
+        "amount": str(payment.amount),
+        "currency": payment.currency,
+        "redirect_url": redirect_url,
+        "customer": {
+            "email": user.email,
+            "name": user.username,
+            "phonenumber": user.phone
+        },
+        "customizations": {
+            "title": "Ventura Payment"
+        }
+    }
+
+
+def paypal_payment_payload(tx_ref, amount, base_url):
+    return {
+        "intent": "sale",
+        "payer": {
+            "payment_method": "paypal"
+        },
+        "redirect_urls": {
+            "return_url": f"{base_url}/payment-status?paymentStatus=success&ref={tx_ref}",
+            "cancel_url": f"{base_url}/payment-status?paymentStatus=cancel"
+        },
+        "transactions": [{
+            "item_list": {
+                "items": [{
+                    "name": "Cart Items",
+                    "sku": "cart",
+                    "price": str(amount),
+                    "currency": "USD",
+                    "quantity": 1
+                }]
+            },
+            "amount": {
+                "total": str(amount),
+                "currency": "USD"
+            },
+            "description": "Payment for cart items."
+        }]
+    }
+
+
+class FlutterwaveClient:
+    """Flutterwave v3 API client sharing one pooled keep-alive session.
+
+    Every call has connect/read timeouts. Only the idempotent verification
+    GET is retried (with exponential backoff); creating a payment is never
+    replayed automatically.
+    """
+
+    def __init__(self, base_url, secret_key, connect_timeout=3.05, read_timeout=10, max_retries=3,
+                 backoff_factor=0.3, pool_size=10, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {secret_key}"
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        trial = self.breaker.before_call()
+        try:
+            return self._request(method, path, **kwargs)
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    def _request(self, method, path, **kwargs):
+        try:
+            with metrics.timer("gateway"):
+                response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise GatewayError(f"Payment gateway request failed: {e}") from e
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def initiate_payment(self, payload):
+        return self.request("POST", "/payments", json=payload)
+
+    def verify_transaction(self, transaction_id):
+        response = self.request("GET", f"/transactions/{transaction_id}/verify")
+        try:
+            return response.json()
+        except ValueError as e:
+            raise GatewayError("Payment gateway returned an invalid response.") from e
+
+
+class AsyncFlutterwaveClient:
+    """Asynchronous counterpart of ``FlutterwaveClient`` for async views.
+
+    It keeps the same timeouts and retry policy (only the verification GET is
+    retried, with exponential backoff) on an ``httpx`` connection pool, so a
+    slow gateway holds an event loop slot instead of a worker thread.
+    """
+
+    shard_size = 25
+
+    def __init__(self, base_url, secret_key, connect_timeout=3.05, read_timeout=10, max_retries=3,
+                 backoff_factor=0.3, pool_size=100, breaker=None):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker or CircuitBreaker()
+        # httpcore scans its whole pool for every request, which turns
+        # quadratic with hundreds of requests in flight; several small pools
+        # used in turn keep those scans short.
+        shards = max(1, math.ceil(pool_size / self.shard_size))
+        limits = httpx.Limits(max_connections=math.ceil(pool_size / shards),
+                              max_keepalive_connections=math.ceil(pool_size / shards))
+        self.clients = [
+            httpx.AsyncClient(
+                base_url=base_url.rstrip("/"),
+                headers={"Authorization": f"Bearer {secret_key}"},
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=limits,
+            )
+            for _ in range(shards)
+        ]
+        self._clients = itertools.cycle(self.clients)
+
+    async def request(self, method, path, **kwargs):
+        trial = self.breaker.before_call()
+        try:
+            return await self._request(method, path, **kwargs)
+        finally:
+            if trial:
+                self.breaker.end_trial()
+
+    async def _request(self, method, path, **kwargs):
+        retries = self.max_retries if method == "GET" else 0
+        with metrics.timer("gateway"):
+            for attempt in range(retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+                try:
+                    response = await next(self._clients).request(method, path, **kwargs)
+                except httpx.HTTPError as e:
+                    if attempt < retries:
+                        continue
+                    self.breaker.record_failure()
+                    raise GatewayError(f"Payment gateway request failed: {e}") from e
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    break
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def initiate_payment(self, payload):
+        return await self.request("POST", "/payments", json=payload)
+
+    async def verify_transaction(self, transaction_id):
+        response = await self.request("GET", f"/transactions/{transaction_id}/verify")
+        try:
+            return response.json()
+        except ValueError as e:
+            raise GatewayError("Payment gateway returned an invalid response.") from e
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+@lru_cache(maxsize=None)
+def get_flutterwave_client():
+    return FlutterwaveClient(
+        settings.FLUTTERWAVE_BASE_URL,
+        settings.FLUTTERWAVE_SECRET_KEY,
+        connect_timeout=settings.FLUTTERWAVE_CONNECT_TIMEOUT,
+        read_timeout=settings.FLUTTERWAVE_READ_TIMEOUT,
+        max_retries=settings.FLUTTERWAVE_MAX_RETRIES,
+        pool_size=settings.FLUTTERWAVE_POOL_SIZE,
+        breaker=CircuitBreaker(settings.FLUTTERWAVE_BREAKER_THRESHOLD, settings.FLUTTERWAVE_BREAKER_RESET),
+    )
+
+
+def get_async_flutterwave_client():
+    """Return the async client of the running event loop.
+
+    ``httpx`` pools are bound to the loop they were opened on, so there is one
+    client per loop; all of them share the circuit breaker of the sync client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncFlutterwaveClient(
+            settings.FLUTTERWAVE_BASE_URL,
+            settings.FLUTTERWAVE_SECRET_KEY,
+            connect_timeout=settings.FLUTTERWAVE_CONNECT_TIMEOUT,
+            read_timeout=settings.FLUTTERWAVE_READ_TIMEOUT,
+            max_retries=settings.FLUTTERWAVE_MAX_RETRIES,
+            pool_size=settings.FLUTTERWAVE_ASYNC_POOL_SIZE,
+            breaker=get_flutterwave_client().breaker,
+        )
+    return client
+
+
+@receiver(setting_changed)
+def reset_clients(setting, **kwargs):
+    if setting.startswith("FLUTTERWAVE_"):
+        get_flutterwave_client.cache_clear()
+        _async_clients.clear()
@@ -0,0 +1,144 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def request_fingerprint(request):
+    """Hash a request's payload; the scope already identifies the endpoint."""
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    query = json.dumps(sorted(request.GET.lists()))
+    return hashlib.sha256(f"{query}|{body}".encode()).hexdigest()
+
+
+def key_owner(request):
+    user = getattr(request, "user", None)
+    return f"user:{user.pk}" if user is not None and user.is_authenticated else "anonymous"
+
+
+def purge_expired(now=None):
+    return IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()[0]
+
+
+def _claim(scope, owner, key, fingerprint):
+    """Insert a placeholder row for the key, or return the row already there.
+
+    The placeholder only leases the key for ``IDEMPOTENCY_LEASE`` seconds, so a
+    worker that dies mid-request does not block retries for the whole TTL:
+    once the lease has run out the row counts as expired and is taken over.
+    """
+    now = timezone.now()
+    IdempotencyKey.objects.filter(scope=scope, owner=owner, key=key, expires_at__lte=now).delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                scope=scope, owner=owner, key=key, request_hash=fingerprint,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_LEASE),
+            ), True
+    except IntegrityError:
+        return IdempotencyKey.objects.get(scope=scope, owner=owner, key=key), False
+
+
+def _conflict(record, fingerprint):
+    """Return ``(data, status, headers)`` to answer a repeated key with."""
+    if record.request_hash != fingerprint:
+        return {"error": f"{HEADER} was already used for a different request."}, 422, None
+    if record.status_code is None:
+        return {"error": "A request with this Idempotency-Key is still in progress."}, 409, None
+    return record.response, record.status_code, {"Idempotent-Replayed": "true"}
+
+
+def _finish(record, status_code, data):
+    # Filter on the primary key: if the lease ran out and a retry took the key
+    # over, this request's row is gone and the retry's must be left alone.
+    if status_code >= 500:
+        record.delete()
+    else:
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            status_code=status_code, response=data,
+            expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+        )
+
+
+def idempotent(scope):
+    """Replay the stored response when a request repeats its ``Idempotency-Key``.
+
+    The first request with a key runs the view and its response is stored for
+    ``IDEMPOTENCY_KEY_TTL`` seconds; retries with the same key and payload get
+    that response back (flagged with ``Idempotent-Replayed``) without running
+    the view again. Reusing a key for a different payload is rejected with 422
+    and a retry that races the original request gets 409 until the original
+    request's ``IDEMPOTENCY_LEASE`` runs out. Server errors are
+    not stored, so the client may retry them with the same key. Requests
+    without the header are not affected.
+
+    Apply it below ``api_view`` so ``request.user`` and ``request.data`` are
+    available. Coroutine views (see ``shop_app.async_views``) are supported
+    too and share the keys of the sync view with the same ``scope``.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            return _async_idempotent(scope, view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return Response({"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters."}, status=400)
+
+            fingerprint = request_fingerprint(request)
+            record, created = _claim(scope, key_owner(request), key, fingerprint)
+            if not created:
+                data, status_code, headers = _conflict(record, fingerprint)
+                return Response(data, status=status_code, headers=headers)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+            _finish(record, response.status_code, response.data)
+            return response
+        return wrapper
+    return decorator
+
+
+def _async_idempotent(scope, view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return await view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters."}, status=400)
+
+        fingerprint = request_fingerprint(request)
+        record, created = await sync_to_async(_claim)(scope, key_owner(request), key, fingerprint)
+        if not created:
+            data, status_code, headers = _conflict(record, fingerprint)
+            return JsonResponse(data, status=status_code, headers=headers, safe=False)
+
+        try:
+            response = await view(request, *args, **kwargs)
+        except Exception:
+            await record.adelete()
+            raise
+        await sync_to_async(_finish)(record, response.status_code, json.loads(response.content))
+        return response
+    return wrapper
@@ -0,0 +1,146 @@
+import logging
+import uuid
+from datetime import timedelta
+
+import paypalrestsdk
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .gateways import GatewayError, get_flutterwave_client
+from .models import PaymentJob, Transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    pass
+
+
+def enqueue_verification(kind, payment, payload, user=None):
+    """Queue a verification job unless one is already waiting for this transaction."""
+    active = payment.jobs.filter(status__in=(PaymentJob.QUEUED, PaymentJob.RUNNING)).first()
+    if active is not None:
+        return active
+    return PaymentJob.objects.create(kind=kind, transaction=payment, payload=payload, user=user)
+
+
+def payment_state(payment):
+    """Summarize a transaction for status polling: pending, completed or failed."""
+    if payment.status in ("completed", "failed"):
+        return payment.status
+    latest = payment.jobs.order_by("-id").first()
+    if latest is not None and latest.status == PaymentJob.DEAD:
+        return "failed"
+    return "pending"
+
+
+def complete_payment(payment, user=None):
+    with transaction.atomic():
+        Transaction.objects.filter(pk=payment.pk).update(status="completed", modified_at=timezone.now())
+        cart = payment.cart
+        cart.paid = True
+        if user is not None:
+            cart.user = user
+        cart.save()
+
+
+def verify_flutterwave(job):
+    payment = job.transaction
+    try:
+        response_data = get_flutterwave_client().verify_transaction(job.payload["transaction_id"])
+    except GatewayError as e:
+        raise RetryableError(str(e)) from e
+    if response_data.get("status") != "success":
+        raise RetryableError(response_data.get("message") or "Flutterwave could not verify the transaction.")
+
+    data = response_data["data"]
+    if (data["status"] == "successful"
+            and float(data["amount"]) == float(payment.amount)
+            and data["currency"] == payment.currency):
+        complete_payment(payment, job.user)
+    else:
+        Transaction.objects.filter(pk=payment.pk).update(status="failed", modified_at=timezone.now())
+
+
+def verify_paypal(job):
+    try:
+        paypalrestsdk.Payment.find(job.payload["payment_id"])
+    except paypalrestsdk.ResourceNotFound:
+        Transaction.objects.filter(pk=job.transaction_id).update(status="failed", modified_at=timezone.now())
+        return
+    except Exception as e:
+        raise RetryableError(str(e)) from e
+    complete_payment(job.transaction, job.user)
+
+
+HANDLERS = {
+    PaymentJob.FLUTTERWAVE: verify_flutterwave,
+    PaymentJob.PAYPAL: verify_paypal,
+}
+
+
+def claim_jobs(limit):
+    """Atomically take up to ``limit`` due jobs for this worker.
+
+    Jobs are claimed with a compare-and-set UPDATE tagged with a fresh token,
+    so concurrent workers never run the same job even on databases without
+    ``SKIP LOCKED``; where it is available it keeps workers from queueing up
+    behind each other's row locks. Jobs whose worker died mid-run are put back
+    in the queue once their lease expires.
+    """
+    now = timezone.now()
+    PaymentJob.objects.filter(
+        status=PaymentJob.RUNNING, locked_at__lt=now - timedelta(seconds=settings.PAYMENT_JOB_LEASE)
+    ).update(status=PaymentJob.QUEUED, locked_by="")
+
+    token = uuid.uuid4().hex
+    due = PaymentJob.objects.filter(status=PaymentJob.QUEUED, run_after__lte=now).order_by("run_after", "id")
+    claim = dict(status=PaymentJob.RUNNING, locked_at=now, locked_by=token, attempts=F("attempts") + 1)
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(due.select_for_update(skip_locked=True).values_list("id", flat=True)[:limit])
+            PaymentJob.objects.filter(id__in=ids, status=PaymentJob.QUEUED).update(**claim)
+    else:
+        # A single statement: SQLite cannot upgrade a read transaction to a
+        # write under contention, but it serializes standalone writes.
+        ids = due.values_list("id", flat=True)[:limit]
+        PaymentJob.objects.filter(id__in=ids, status=PaymentJob.QUEUED).update(**claim)
+    return list(PaymentJob.objects.filter(locked_by=token, status=PaymentJob.RUNNING)
+                .select_related("transaction__cart", "user"))
+
+
+def _release(job, **fields):
+    # Scoped to our claim token: if the lease expired and another worker took
+    # the job over, its bookkeeping wins.
+    PaymentJob.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+        locked_by="", modified_at=timezone.now(), **fields
+    )
+
+
+def run_job(job):
+    try:
+        HANDLERS[job.kind](job)
+    except Exception as e:
+        if not isinstance(e, RetryableError):
+            logger.exception("Payment job %s crashed", job.pk)
+        if job.attempts < settings.PAYMENT_JOB_MAX_ATTEMPTS:
+            delay = min(settings.PAYMENT_JOB_BACKOFF * 2 ** (job.attempts - 1), settings.PAYMENT_JOB_MAX_BACKOFF)
+            _release(job, status=PaymentJob.QUEUED, run_after=timezone.now() + timedelta(seconds=delay),
+                     last_error=str(e))
+        else:
+            logger.error("Payment job %s moved to the dead-letter queue: %s", job.pk, e)
+            _release(job, status=PaymentJob.DEAD, last_error=str(e))
+        return False
+    _release(job, status=PaymentJob.DONE, last_error="")
+    return True
+
+
+def process_jobs(limit=100):
+    """Claim and run due jobs in the calling thread; return how many ran."""
+    jobs = claim_jobs(limit)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
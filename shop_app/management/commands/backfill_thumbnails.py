@@ -0,0 +1,44 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from shop_app.cache import invalidate_all
+from shop_app.models import Product
+from shop_app.thumbnails import build_thumbnails, needs_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Generate missing or stale thumbnails of product images with a process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument("--force", action="store_true", help="Rebuild thumbnails that look up to date.")
+
+    def handle(self, *args, **options):
+        pending = [
+            product for product in Product.objects.only("id", "image", "thumbnails").iterator(chunk_size=2000)
+            if product.image and (options["force"] or needs_thumbnails(product))
+        ]
+        self.stdout.write(f"{len(pending)} products need thumbnails.")
+        if not pending:
+            return
+
+        # Forked workers must not inherit open database sockets.
+        connections.close_all()
+        done = 0
+        with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+            for start in range(0, len(pending), options["batch_size"]):
+                batch = pending[start:start + options["batch_size"]]
+                names = [product.image.name for product in batch]
+                for product, thumbnails in zip(batch, pool.map(build_thumbnails, names, chunksize=8)):
+                    product.thumbnails = thumbnails
+                Product.objects.bulk_update(batch, ["thumbnails"])
+                done += len(batch)
+                self.stdout.write(f"{done}/{len(pending)}")
+
+        invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f"Generated thumbnails for {done} products."))
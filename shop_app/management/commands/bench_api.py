@@ -0,0 +1,394 @@
+import json
+import platform
+import random
+import re
+import subprocess
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from core.authentication import ClaimsTokenObtainPairSerializer
+from shop_app import urls
+from shop_app.benchmarks import (GARMENTS, MATERIALS, benchmark_database, seed_carts, seed_checkouts, seed_products,
+                                 seed_reviews, seed_users, summarize)
+from shop_app.models import Cart, CartItem, Product, Review, Transaction
+from shop_app.stub_gateway import StubGateway
+from shop_app.views import PRODUCT_ORDERINGS
+
+
+# (URL name in shop_app.urls, HTTP method), in the order they run: reads
+# first, so they see the data as seeded.
+ENDPOINTS = [
+    ("products", "get"),
+    ("product_facets", "get"),
+    ("search_products", "get"),
+    ("product_detail", "get"),
+    ("async_product_detail", "get"),
+    ("get_reviews", "get"),
+    ("product_in_cart", "get"),
+    ("get_cart_stat", "get"),
+    ("get_cart", "get"),
+    ("get_username", "get"),
+    ("user_info", "get"),
+    ("order_history", "get"),
+    ("payment_status", "get"),
+    ("async_payment_status", "get"),
+    ("catalog_cache_stats", "get"),
+    ("metrics", "get"),
+    ("add_item", "post"),
+    ("cart_batch", "post"),
+    ("update_quantity", "patch"),
+    ("delete_cartitem", "post"),
+    ("merge_cart", "post"),
+    ("add_review", "post"),
+    ("register_user", "post"),
+    ("initiate_payment", "post"),
+    ("async_initiate_payment", "post"),
+    ("initiate_paypal_payment", "post"),
+    ("async_initiate_paypal_payment", "post"),
+    ("payment_callback", "post"),
+    ("paypal_payment_callback", "post"),
+]
+ITEMS_PER_CART = 3
+# Latency differences below this are noise at the resolution of one run.
+LATENCY_SLACK_MS = 1.0
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def default_rows(scale):
+    return {"products": scale, "reviews": scale, "carts": max(scale // 10, 10), "users": max(scale // 100, 10)}
+
+
+def seed_rows(rows):
+    seed_products(rows["products"], reviews=rows["reviews"])
+    seed_reviews(rows["reviews"])
+    seed_carts(rows["carts"], seed_users(rows["users"]), ITEMS_PER_CART)
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE")
+
+
+def bearer(user):
+    # As issued by /token/, so the claims carry the username.
+    return {"Authorization": f"Bearer {ClaimsTokenObtainPairSerializer.get_token(user).access_token}"}
+
+
+class Workload:
+    """Request parameters for every endpoint, drawn from the seeded rows.
+
+    An endpoint's method returns ``(path, data, headers)`` for its ``i``-th
+    request. Requests that use up what they touch - deleting an item, merging
+    a cart, registering a user - get rows of their own, prepared here for
+    ``count`` requests. The same ``seed`` draws the same requests.
+    """
+
+    def __init__(self, count, seed=0):
+        User = get_user_model()
+        self.rng = random.Random(seed)
+        self.product_ids = list(Product.objects.order_by("id").values_list("id", flat=True))
+        self.reviews = Review.objects.count()
+        user_ids = list(User.objects.filter(username__startswith="bench-user-").order_by("id")
+                        .values_list("id", flat=True))
+        carts = Cart.objects.filter(cart_code__startswith="cart").count()
+        # See seed_carts.
+        self.open_carts = [i for i in range(carts) if i // len(user_ids) % 2 == 0]
+        users = User.objects.filter(pk__in=self.rng.sample(user_ids, min(count, len(user_ids)))).order_by("id")
+        self.user_headers = [bearer(user) for user in users]
+        self.admin_headers = bearer(User.objects.create(username="bench-admin", is_staff=True))
+
+        buyer = User.objects.create(username="bench-buyer", email="bench-buyer@example.com")
+        self.buyer_headers = bearer(buyer)
+        self.checkouts = seed_checkouts(count, buyer)
+        refs = dict(Transaction.objects.filter(cart__cart_code__in=self.checkouts, status="pending")
+                    .values_list("cart__cart_code", "ref"))
+        self.refs = [refs[cart_code] for cart_code in self.checkouts]
+
+        sampled = [f"cart{i:07d}" for i in self.rng.sample(self.open_carts, min(count, len(self.open_carts)))]
+        self.open_items = list(CartItem.objects.filter(cart__cart_code__in=sampled).order_by("id")
+                               .values_list("id", flat=True))
+        # cart_code holds 11 characters.
+        self.delete_items = self.own_carts("del", count, 1)
+        self.merge_codes = [f"mrg{i:08d}" for i in range(count)]
+        self.own_carts("mrg", count, 2)
+
+    def own_carts(self, prefix, count, items):
+        """Create ``count`` anonymous carts of ``items`` random products; return the item ids in cart order."""
+        carts = Cart.objects.bulk_create([Cart(cart_code=f"{prefix}{i:08d}") for i in range(count)])
+        carts = Cart.objects.filter(cart_code__in=[cart.cart_code for cart in carts]).order_by("cart_code")
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=product_id)
+            for cart in carts for product_id in self.rng.sample(self.product_ids, min(items, len(self.product_ids)))
+        ])
+        return list(CartItem.objects.filter(cart__cart_code__startswith=prefix).order_by("cart__cart_code", "id")
+                    .values_list("id", flat=True))
+
+    def product(self):
+        """``(slug, id)`` of a random product; see seed_products."""
+        index = self.rng.randrange(len(self.product_ids))
+        return f"bench-product-{index}", self.product_ids[index]
+
+    def open_cart(self):
+        """Code and product ids of a random open seeded cart; see seed_carts."""
+        i = self.rng.choice(self.open_carts)
+        return f"cart{i:07d}", [self.product_ids[(i * ITEMS_PER_CART + k) % len(self.product_ids)]
+                                for k in range(ITEMS_PER_CART)]
+
+    def user(self, i):
+        return self.user_headers[i % len(self.user_headers)]
+
+    def products(self, i):
+        return "/products", {"page_size": 20, "sort_by": self.rng.choice(list(PRODUCT_ORDERINGS))}, {}
+
+    def product_facets(self, i):
+        return "/products/facets", {"size": self.rng.choice(Product.SIZES)[0]}, {}
+
+    def search_products(self, i):
+        return "/products/search", {"q": self.rng.choice(MATERIALS + GARMENTS).lower()}, {}
+
+    def product_detail(self, i):
+        return f"/product_detail/{self.product()[0]}", {}, {}
+
+    def async_product_detail(self, i):
+        return f"/async/product_detail/{self.product()[0]}", {}, {}
+
+    def get_reviews(self, i):
+        # A product with a review; see review_targets.
+        index = self.rng.randrange(self.reviews) * 31 % len(self.product_ids) if self.reviews else 0
+        return f"/product_detail/bench-product-{index}/reviews/", {}, {}
+
+    def product_in_cart(self, i):
+        cart_code, product_ids = self.open_cart()
+        return "/product_in_cart", {"cart_code": cart_code, "product_id": self.rng.choice(product_ids)}, {}
+
+    def get_cart_stat(self, i):
+        return "/get_cart_stat", {"cart_code": self.open_cart()[0]}, {}
+
+    def get_cart(self, i):
+        return "/get_cart", {"cart_code": self.open_cart()[0]}, {}
+
+    def get_username(self, i):
+        return "/get_username", {}, self.user(i)
+
+    def user_info(self, i):
+        return "/user_info", {}, self.user(i)
+
+    def order_history(self, i):
+        return "/order_history", {}, self.user(i)
+
+    def payment_status(self, i):
+        return f"/payment_status/{self.refs[i]}", {}, {}
+
+    def async_payment_status(self, i):
+        return f"/async/payment_status/{self.refs[i]}", {}, {}
+
+    def catalog_cache_stats(self, i):
+        return "/catalog_cache_stats", {}, self.admin_headers
+
+    def metrics(self, i):
+        return "/metrics", {}, {"Authorization": f"Bearer {settings.METRICS_TOKEN}"}
+
+    def add_item(self, i):
+        return "/add_item/", {"cart_code": self.open_cart()[0], "product_id": self.product()[1]}, {}
+
+    def cart_batch(self, i):
+        cart_code, product_ids = self.open_cart()
+        operations = [{"op": "add", "product_id": self.product()[1], "quantity": 2},
+                      {"op": "update", "product_id": product_ids[0], "quantity": 3}]
+        return "/cart_batch/", {"cart_code": cart_code, "operations": operations}, {}
+
+    def update_quantity(self, i):
+        return "/update_quantity/", {"item_id": self.rng.choice(self.open_items), "delta": 1}, {}
+
+    def delete_cartitem(self, i):
+        return "/delete_cartitem/", {"item_id": self.delete_items[i]}, {}
+
+    def merge_cart(self, i):
+        return "/merge_cart/", {"cart_code": self.merge_codes[i]}, self.user(i)
+
+    def add_review(self, i):
+        slug, _ = self.product()
+        return (f"/product_detail/{slug}/add_review/", {"body": "Benchmark review.", "rating": self.rng.randint(1, 5)},
+                self.user(i))
+
+    def register_user(self, i):
+        return ("/register_user/", {"username": f"bench-new-{i}", "first_name": "Bench", "last_name": "User",
+                                    "password": "bench-password"}, {})
+
+    def initiate_payment(self, i):
+        return "/initiate_payment/", {"cart_code": self.checkouts[i]}, self.buyer_headers
+
+    def async_initiate_payment(self, i):
+        return "/async/initiate_payment/", {"cart_code": self.checkouts[i]}, self.buyer_headers
+
+    def initiate_paypal_payment(self, i):
+        return "/initiate_paypal_payment/", {"cart_code": self.checkouts[i]}, self.buyer_headers
+
+    def async_initiate_paypal_payment(self, i):
+        return "/async/initiate_paypal_payment/", {"cart_code": self.checkouts[i]}, self.buyer_headers
+
+    def payment_callback(self, i):
+        return f"/payment_callback/?status=successful&tx_ref={self.refs[i]}&transaction_id={i + 1}", {}, {}
+
+    def paypal_payment_callback(self, i):
+        return f"/paypal_payment_callback/?paymentId=PAYID-{i + 1}&PayerID=BENCH&ref={self.refs[i]}", {}, {}
+
+
+def run_endpoint(client, workload, name, method, repeat, warmup=0):
+    """Issue ``warmup + repeat`` requests to one endpoint; report on the last ``repeat``.
+
+    Query counts and database time come from the ``Server-Timing`` header, so
+    the metrics middleware must sample every request.
+    """
+    timings, db_timings, queries, statuses = [], [], [], {}
+    for i in range(warmup + repeat):
+        path, data, headers = getattr(workload, name)(i)
+        started = time.perf_counter()
+        if method == "get":
+            response = client.get(path, data, headers=headers)
+        else:
+            response = getattr(client, method)(path, data, content_type="application/json", headers=headers)
+        elapsed = time.perf_counter() - started
+        if i < warmup:
+            continue
+        timings.append(elapsed)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        timing = SERVER_TIMING.search(response.get("Server-Timing", ""))
+        if timing:
+            db_timings.append(float(timing[1]) / 1000)
+            queries.append(int(timing[2]))
+    return {
+        "method": method.upper(),
+        "path": urls_path(name),
+        "requests": repeat,
+        "errors": sum(count for status, count in statuses.items() if status >= 400),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "requests_per_s": round(repeat / sum(timings), 1) if timings else 0.0,
+        **summarize(timings),
+        "queries": max(queries, default=0),
+        "db_p50_ms": summarize(db_timings).get("p50_ms", 0.0),
+    }
+
+
+def urls_path(name):
+    return next(str(pattern.pattern) for pattern in urls.urlpatterns if pattern.name == name)
+
+
+def uncovered_endpoints():
+    """URL names of shop_app.urls without an entry in ``ENDPOINTS``."""
+    covered = {name for name, _ in ENDPOINTS}
+    return sorted({pattern.name for pattern in urls.urlpatterns} - covered)
+
+
+def compare_reports(baseline, report, tolerance):
+    """Regressions of ``report`` against ``baseline``: more queries, more errors or a slower p50.
+
+    p50 may grow by ``tolerance`` (a fraction) plus ``LATENCY_SLACK_MS``.
+    """
+    regressions = []
+    for name, current in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if before is None:
+            continue
+        if current["queries"] > before["queries"]:
+            regressions.append({"endpoint": name, "metric": "queries", "baseline": before["queries"],
+                                "current": current["queries"]})
+        if current["errors"] > before["errors"]:
+            regressions.append({"endpoint": name, "metric": "errors", "baseline": before["errors"],
+                                "current": current["errors"]})
+        if current["p50_ms"] > before["p50_ms"] * (1 + tolerance) + LATENCY_SLACK_MS:
+            regressions.append({"endpoint": name, "metric": "p50_ms", "baseline": before["p50_ms"],
+                                "current": current["p50_ms"]})
+    return regressions
+
+
+def revision():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR, capture_output=True,
+                                text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+class Command(BaseCommand):
+    help = ("Seed a throwaway database with a synthetic catalog, users, carts and reviews at a given scale, "
+            "drive every endpoint of shop_app.urls against it with a local stub payment gateway and report "
+            "throughput, latency percentiles and query counts per endpoint as JSON. With --baseline, exits "
+            "non-zero when an endpoint regressed against an earlier report.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", type=int, default=10_000,
+                            help="Products and reviews; carts are a tenth of it and users a hundredth.")
+        parser.add_argument("--reviews", type=int)
+        parser.add_argument("--carts", type=int)
+        parser.add_argument("--users", type=int)
+        parser.add_argument("--repeat", type=int, default=50, help="Measured requests per endpoint.")
+        parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests per endpoint first.")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the random request parameters.")
+        parser.add_argument("--endpoint", action="append", choices=[name for name, _ in ENDPOINTS],
+                            help="Repeatable; every endpoint by default.")
+        parser.add_argument("--response-cache", action="store_true", help="Keep the catalog response cache on.")
+        parser.add_argument("--output", help="Write the report to this file instead of stdout.")
+        parser.add_argument("--baseline", help="A report of an earlier run to compare against.")
+        parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="How much slower, as a fraction, an endpoint's p50 may get over the baseline.")
+
+    def handle(self, *args, **options):
+        rows = default_rows(options["scale"])
+        rows.update({name: options[name] for name in ("reviews", "carts", "users") if options[name] is not None})
+        if min(rows["products"], rows["carts"], rows["users"]) < 1:
+            raise CommandError("--scale, --carts and --users must be at least 1.")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                baseline = json.load(file)
+        selected = options["endpoint"] or [name for name, _ in ENDPOINTS]
+        count = options["warmup"] + options["repeat"]
+
+        with benchmark_database(response_cache=options["response_cache"]), StubGateway() as gateway, \
+                gateway.as_paypal(), override_settings(FLUTTERWAVE_BASE_URL=gateway.base_url, METRICS_SAMPLE_RATE=1,
+                                                   METRICS_TOKEN=settings.METRICS_TOKEN or "bench"):
+            self.stderr.write(f"Seeding {', '.join(f'{count} {name}' for name, count in rows.items())}...")
+            started = time.perf_counter()
+            seed_rows(rows)
+            workload = Workload(count, options["seed"])
+            report = {"meta": self.meta(rows, options, time.perf_counter() - started), "endpoints": {}}
+            client = Client(raise_request_exception=False)
+            for name, method in ENDPOINTS:
+                if name in selected:
+                    self.stderr.write(f"{method.upper()} {name}")
+                    report["endpoints"][name] = run_endpoint(client, workload, name, method, options["repeat"],
+                                                             options["warmup"])
+        report["uncovered"] = uncovered_endpoints()
+        if baseline is not None:
+            report["regressions"] = compare_reports(baseline, report, options["tolerance"])
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        else:
+            self.stdout.write(output)
+        if report["uncovered"]:
+            self.stderr.write(self.style.WARNING(f"No workload for {', '.join(report['uncovered'])}."))
+        if report.get("regressions"):
+            raise CommandError(f"{len(report['regressions'])} regressions against {options['baseline']}.")
+
+    def meta(self, rows, options, seed_s):
+        return {
+            "vendor": connection.vendor,
+            "revision": revision(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "rows": rows,
+            "seed_s": round(seed_s, 1),
+            "repeat": options["repeat"],
+            "warmup": options["warmup"],
+            "seed": options["seed"],
+            "response_cache": options["response_cache"],
+        }
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from shop_app.benchmarks import benchmark_database, seed_checkouts, summarize
+from shop_app.stub_gateway import StubGateway
+
+
+class Command(BaseCommand):
+    help = ("Compare checkout throughput of the sync view on a pool of WSGI worker threads against the "
+            "async view under ASGI, with a deliberately slow local stub gateway.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=300)
+        parser.add_argument("--threads", type=int, default=8,
+                            help="WSGI worker threads, e.g. gunicorn --threads.")
+        parser.add_argument("--concurrency", type=int, default=200,
+                            help="Requests in flight at once on the ASGI event loop.")
+        parser.add_argument("--delay", type=float, default=1.0, help="Gateway latency in seconds.")
+
+    def handle(self, *args, **options):
+        with benchmark_database(), StubGateway(delay=options["delay"]) as gateway, \
+                override_settings(FLUTTERWAVE_BASE_URL=gateway.base_url):
+            user = get_user_model().objects.create(username="bench-buyer", email="bench@example.com")
+            headers = {"Authorization": f"Bearer {AccessToken.for_user(user)}"}
+            cart_codes = seed_checkouts(options["requests"], user)
+            results = {
+                "requests": options["requests"],
+                "gateway_delay_s": options["delay"],
+                "wsgi": self.run_threads("/initiate_payment/", cart_codes, headers, options["threads"]),
+                "asgi": asyncio.run(self.run_async("/async/initiate_payment/", cart_codes, headers,
+                                                   options["concurrency"])),
+            }
+            results["wsgi"]["threads"] = options["threads"]
+            results["asgi"]["concurrency"] = options["concurrency"]
+        self.stdout.write(json.dumps(results, indent=2))
+
+    # Requests go through Django's real WSGI and ASGI handlers in-process; the
+    # test AsyncClient handles one request at a time and would hide exactly
+    # the concurrency this measures.
+
+    def run_threads(self, path, cart_codes, headers, threads):
+        pending = queue.SimpleQueue()
+        for cart_code in cart_codes:
+            pending.put(cart_code)
+        timings, statuses = [], []
+
+        def worker():
+            client = httpx.Client(transport=httpx.WSGITransport(app=WSGIHandler()), base_url="http://testserver")
+            try:
+                while True:
+                    try:
+                        cart_code = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    started = time.perf_counter()
+                    response = client.post(path, json={"cart_code": cart_code}, headers=headers)
+                    timings.append(time.perf_counter() - started)
+                    statuses.append(response.status_code)
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return self.report(time.perf_counter() - started, timings, statuses)
+
+    async def run_async(self, path, cart_codes, headers, concurrency):
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=ASGIHandler()), base_url="http://testserver",
+                                   timeout=None)
+        slots = asyncio.Semaphore(concurrency)
+        timings, statuses = [], []
+
+        async def checkout(cart_code):
+            async with slots:
+                started = time.perf_counter()
+                response = await client.post(path, json={"cart_code": cart_code}, headers=headers)
+                timings.append(time.perf_counter() - started)
+                statuses.append(response.status_code)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(checkout(cart_code) for cart_code in cart_codes))
+        elapsed = time.perf_counter() - started
+        await sync_to_async(connections.close_all)()
+        return self.report(elapsed, timings, statuses)
+
+    def report(self, elapsed, timings, statuses):
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "requests_per_s": round(len(timings) / elapsed, 1),
+            "errors": sum(status != 200 for status in statuses),
+            **summarize(timings),
+        }
@@ -0,0 +1,89 @@
+import json
+import queue
+import threading
+import time
+
+import httpx
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+from shop_app.benchmarks import benchmark_database, seed_products, summarize
+
+
+MODES = {
+    "per_request": {"CONN_MAX_AGE": 0},
+    "persistent": {"CONN_MAX_AGE": 60, "CONN_HEALTH_CHECKS": True},
+    "pool": {"CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": True},
+}
+
+
+class Command(BaseCommand):
+    help = ("Compare request latency with a database connection per request, persistent connections and a "
+            "psycopg pool, on a throwaway copy of the configured PostgreSQL database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--threads", type=int, default=4, help="WSGI worker threads.")
+        parser.add_argument("--mode", choices=MODES, action="append", help="Repeatable; all modes by default.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Connection handling only matters on PostgreSQL.")
+        opened = []
+        connection_created.connect(lambda **kwargs: opened.append(1), weak=False)
+        results = {"requests": options["requests"], "threads": options["threads"]}
+        with benchmark_database():
+            seed_products(200)
+            # Requests go through Django's real WSGI handler, which closes or
+            # keeps connections at the end of each request like a server would.
+            for mode in options["mode"] or MODES:
+                self.configure(mode, options["threads"])
+                opened.clear()
+                results[mode] = self.run(options["requests"], options["threads"])
+                # Django reports every checkout from the pool as a new connection.
+                results[mode]["connections_opened"] = (connection.pool.get_stats().get("connections_num", 0)
+                                                       if mode == "pool" else len(opened))
+            self.configure("per_request", options["threads"])
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def configure(self, mode, threads):
+        connections.close_all()
+        connection.close_pool()
+        settings_dict = connection.settings_dict
+        settings_dict.update(MODES[mode])
+        settings_dict["OPTIONS"] = {name: value for name, value in settings_dict["OPTIONS"].items() if name != "pool"}
+        if mode == "pool":
+            settings_dict["OPTIONS"]["pool"] = {"min_size": threads, "max_size": threads}
+
+    def run(self, count, threads):
+        pending = queue.SimpleQueue()
+        for i in range(count):
+            pending.put(f"/product_detail/bench-product-{i % 200}")
+        timings, errors = [], []
+
+        def worker():
+            client = httpx.Client(transport=httpx.WSGITransport(app=WSGIHandler()), base_url="http://testserver")
+            try:
+                while True:
+                    try:
+                        path = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    started = time.perf_counter()
+                    response = client.get(path)
+                    timings.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        errors.append(response.status_code)
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {"requests_per_s": round(count / elapsed, 1), "errors": len(errors), **summarize(timings)}
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from shop_app.benchmarks import benchmark_database, measure, seed_products, seed_reviews
+
+
+class Command(BaseCommand):
+    help = "Compare payload size and latency of the full /products listing against a paginated page."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=100_000)
+        parser.add_argument("--reviews", type=int, default=20_000)
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self.stderr.write(f"Seeding {options['products']} products and {options['reviews']} reviews...")
+            seed_products(options["products"])
+            seed_reviews(options["reviews"])
+
+            client = Client()
+            page = {"page_size": options["page_size"]}
+            results = {
+                "full_listing": measure(client, "/products", repeat=options["repeat"]),
+                "paginated": measure(client, "/products", page, repeat=options["repeat"]),
+                "paginated_slim": measure(client, "/products",
+                                          dict(page, fields="id,name,slug,image,price,average_rating"),
+                                          repeat=options["repeat"]),
+                "paginated_by_price": measure(client, "/products", dict(page, sort_by="price"),
+                                              repeat=options["repeat"]),
+            }
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,67 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from shop_app import search
+from shop_app.benchmarks import QueryCounter, benchmark_database, seed_products, summarize
+from shop_app.models import Product
+
+
+QUERIES = {
+    "word": "linen",
+    "two_words": "vintage jacket",
+    "prefix": "cashm",
+    "typo": "sandles",
+    "description": "green wool",
+}
+
+
+class Command(BaseCommand):
+    help = "Time ranked product search against an icontains scan on a synthetic catalog."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=100_000)
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        # The in-process index is versioned through the catalog cache, so
+        # that cache has to be a real one here.
+        with benchmark_database(response_cache=True):
+            self.stderr.write(f"Seeding {options['products']} products...")
+            seed_products(options["products"])
+            results = {"vendor": connection.vendor, "products": options["products"]}
+            if connection.vendor != "postgresql":
+                started = time.perf_counter()
+                search.get_index()
+                results["index_build_s"] = round(time.perf_counter() - started, 2)
+
+            for label, query in QUERIES.items():
+                results[label] = {
+                    "query": query,
+                    "search": self.measure(lambda: search.search_products(query, page_size=options["page_size"]),
+                                           options["repeat"]),
+                    "icontains": self.measure(lambda: self.scan(query, options["page_size"]), options["repeat"]),
+                }
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def scan(self, query, page_size):
+        # Ordered by popularity as a stand-in for relevance: like any ranked
+        # LIKE search it has to look at every row, not stop at the first page.
+        products = Product.objects.all()
+        for term in query.split():
+            products = products.filter(Q(name__icontains=term) | Q(description__icontains=term))
+        return list(products.order_by("-popularity", "id")[:page_size]), None
+
+    def measure(self, run, repeat):
+        timings = []
+        for _ in range(repeat):
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                started = time.perf_counter()
+                page, _ = run()
+                timings.append(time.perf_counter() - started)
+        return {"hits": len(page), "queries": counter.count, **summarize(timings)}
@@ -0,0 +1,120 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.test import APIClient
+from django.test.utils import CaptureQueriesContext
+
+from shop_app.benchmarks import benchmark_database, seed_checkouts, seed_products, seed_reviews
+from shop_app.explain import explain, sequential_scans
+from shop_app.models import Cart, Product, Transaction
+
+
+# (endpoint, table, vendor or None for all) of scans that are there by design.
+FULL_SCANS = {
+    # Facet counts group the whole filtered catalog.
+    ("/products/facets", "shop_app_product", None),
+    # SQLite reports walking the rowid in order as a scan, even though the
+    # page stops after page_size rows.
+    ("/products", "shop_app_product", "sqlite"),
+    # Outside PostgreSQL, search rebuilds its in-process index from the table.
+    ("/products/search", "shop_app_product", "sqlite"),
+}
+
+
+class Command(BaseCommand):
+    help = ("Run the hot read endpoints against a seeded throwaway database, EXPLAIN every query they issue "
+            "and flag the ones that scan a whole table. Exits non-zero when any does.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=20_000)
+        parser.add_argument("--reviews", type=int, default=50_000)
+        parser.add_argument("--carts", type=int, default=200)
+        parser.add_argument("--min-rows", type=int, default=1000,
+                            help="Ignore scans of tables smaller than this; reading them whole is cheaper.")
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        with benchmark_database():
+            self.stderr.write("Seeding...")
+            seed_products(options["products"])
+            seed_reviews(options["reviews"])
+            user = get_user_model().objects.create(username="explain-buyer", email="explain@example.com")
+            cart_codes = seed_checkouts(options["carts"], user)
+            Cart.objects.filter(cart_code__in=cart_codes[::2]).update(paid=True)
+            Transaction.objects.filter(cart__cart_code__in=cart_codes[::2]).update(status="completed")
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("VACUUM ANALYZE")
+            flagged = self.check_endpoints(self.endpoints(cart_codes[1], user), user, options["min_rows"])
+        if flagged:
+            raise CommandError(f"{flagged} queries scan a whole table.")
+        self.stdout.write(self.style.SUCCESS("No unexpected sequential scans."))
+
+    def endpoints(self, cart_code, user):
+        product = Product.objects.order_by("id")[Product.objects.count() // 2]
+        payment = Transaction.objects.filter(cart__cart_code=cart_code).first()
+        client = self.client_for(user)
+        reviews = f"/product_detail/{product.slug}/reviews/"
+        endpoints = [
+            ("/products", {"page_size": 20}),
+            ("/products", {"page_size": 20, "sort_by": "rating"}),
+            ("/products", {"page_size": 20, "size": "M", "color": "Red", "sort_by": "price"}),
+            ("/products/facets", {"size": "M"}),
+            ("/products/search", {"q": "linen"}),
+            (f"/product_detail/{product.slug}", {}),
+            (reviews, {"page_size": 20}),
+            (reviews, {"page_size": 20, "rating": 5}),
+            ("/get_cart", {"cart_code": cart_code}),
+            ("/get_cart_stat", {"cart_code": cart_code}),
+            ("/product_in_cart", {"cart_code": cart_code, "product_id": product.pk}),
+            (f"/payment_status/{payment.ref}", {}),
+            ("/user_info", {}),
+            ("/order_history", {}),
+        ]
+        # A single page of reviews or orders has no second page to probe.
+        next_reviews = client.get(reviews, {"page_size": 5}).json()["next"]
+        if next_reviews:
+            endpoints.append((reviews, {"page_size": 5, "cursor": next_reviews}))
+        next_orders = client.get("/order_history").json()["next"]
+        if next_orders:
+            endpoints.append(("/order_history", {"cursor": next_orders}))
+        return endpoints
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def check_endpoints(self, endpoints, user, min_rows):
+        client = self.client_for(user)
+        sizes = {}
+        flagged = 0
+        for path, params in endpoints:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(path, params)
+            self.stdout.write(f"{path} {params or ''} -> {response.status_code}, {len(queries)} queries")
+            for query in queries.captured_queries:
+                sql = query["sql"]
+                if not sql.lstrip().upper().startswith("SELECT"):
+                    continue
+                plan = explain(sql)
+                if self.verbosity > 1:
+                    self.stdout.write("\n".join(f"      {line}" for line in plan))
+                for table in sequential_scans(plan):
+                    if table not in sizes:
+                        sizes[table] = self.row_count(table)
+                    if sizes[table] < min_rows:
+                        continue
+                    if {(path, table, None), (path, table, connection.vendor)} & FULL_SCANS:
+                        self.stdout.write(f"    expected full scan of {table}")
+                        continue
+                    flagged += 1
+                    self.stdout.write(self.style.WARNING(f"    SEQ SCAN {table} ({sizes[table]} rows): {sql[:200]}"))
+        return flagged
+
+    def row_count(self, table):
+        if table not in connection.introspection.table_names():
+            return 0  # A system catalog.
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {connection.ops.quote_name(table)}")
+            return cursor.fetchone()[0]
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop_app.catalog_io import FORMATS, detect_format, export_catalog
+
+
+class Command(BaseCommand):
+    help = "Stream every product to a CSV or JSON Lines file that import_catalog reads back."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help='Output file, or "-" for standard output (with --format).')
+        parser.add_argument("--format", choices=FORMATS)
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            format = detect_format(options["path"], options["format"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options["path"] == "-":
+            export_catalog(self.stdout, format, chunk_size=options["chunk_size"])
+            return
+        with open(options["path"], "w", newline="", encoding="utf-8") as file:
+            count = export_catalog(file, format, chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} products to {options['path']}."))
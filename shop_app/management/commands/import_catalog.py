@@ -0,0 +1,48 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop_app.cache import invalidate_all
+from shop_app.catalog_io import FORMATS, detect_format, import_catalog, read_rows
+
+
+class Command(BaseCommand):
+    help = ("Stream a CSV or JSON Lines catalog into Product, creating new products and updating existing ones "
+            "by slug. Image URLs are downloaded in parallel.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help='Catalog file, or "-" for standard input (with --format).')
+        parser.add_argument("--format", choices=FORMATS)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--image-workers", type=int, default=8)
+
+    def handle(self, *args, **options):
+        try:
+            format = detect_format(options["path"], options["format"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        def report_error(line, message):
+            self.stderr.write(f"Line {line}: {message}")
+
+        file = sys.stdin if options["path"] == "-" else open(options["path"], newline="", encoding="utf-8")
+        stats = None
+        try:
+            for stats in import_catalog(read_rows(file, format), batch_size=options["batch_size"],
+                                        image_workers=options["image_workers"], on_error=report_error):
+                self.stdout.write(f"{stats.rows} rows: {stats.created} created, {stats.updated} updated, "
+                                  f"{stats.failed} failed ({stats.rate:.0f} rows/s)")
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            # bulk_create sends no signals, so the cached catalog is dropped here.
+            if stats and stats.created + stats.updated:
+                invalidate_all()
+
+        if stats is None:
+            self.stdout.write("The catalog is empty.")
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats.created + stats.updated} of {stats.rows} rows. "
+            "Run backfill_thumbnails for the thumbnails of new images."
+        ))
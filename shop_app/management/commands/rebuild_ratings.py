@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.cache import invalidate_all
+from shop_app.ratings import rebuild_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored rating aggregates of every product from its reviews."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        changed = rebuild_rating_aggregates(batch_size=options["batch_size"])
+        if changed:
+            invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f"Updated rating aggregates of {changed} products."))
@@ -0,0 +1,43 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from shop_app.jobs import claim_jobs, run_job
+
+
+def run_in_thread(job):
+    try:
+        return run_job(job)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Run queued payment verification jobs with bounded concurrency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+        parser.add_argument("--once", action="store_true", help="Drain the due jobs and exit.")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while True:
+                close_old_connections()
+                free = concurrency - len(in_flight)
+                jobs = claim_jobs(free) if free else []
+                for job in jobs:
+                    in_flight.add(pool.submit(run_in_thread, job))
+
+                if not in_flight:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+                    continue
+                done, in_flight = wait(in_flight, timeout=options["poll_interval"], return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.stdout.write("job succeeded" if future.result() else "job failed, see last_error")
@@ -0,0 +1,262 @@
+"""Per-endpoint latency and query instrumentation.
+
+``MetricsMiddleware`` measures ``METRICS_SAMPLE_RATE`` of the requests. For
+each one it records, under the name of the URL it resolved to, the wall time,
+the number and total duration of its SQL queries, and the time spent in
+serializers and waiting on the payment gateways. The values go into the
+response's ``Server-Timing`` header and into in-process histograms that
+``metrics_view`` serves in the Prometheus text format. Every worker process
+keeps and serves its own.
+
+Unsampled requests pay for a comparison in the middleware and a context
+variable lookup per query, serializer call and gateway call.
+"""
+import hmac
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+
+
+# (name, help, unit of the recorded integers, attribute of RequestMetrics)
+METRICS = [
+    ("shop_request_duration_seconds", "Wall time of sampled requests.", 1e-6, "duration"),
+    ("shop_db_queries", "SQL queries per sampled request.", 1, "queries"),
+    ("shop_db_duration_seconds", "Time spent in SQL queries per sampled request.", 1e-6, "db"),
+    ("shop_serializer_duration_seconds", "Time spent in serializers per sampled request.", 1e-6, "serializer"),
+    ("shop_gateway_duration_seconds", "Time spent waiting on payment gateways per sampled request.", 1e-6,
+     "gateway"),
+]
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+class Histogram:
+    """Log-linear buckets in the style of HdrHistogram.
+
+    Values are counted as integers of ``unit``. Those below ``2 **
+    sub_bucket_bits`` get a bucket each; above that every power of two is
+    split into ``2 ** (sub_bucket_bits - 1)`` buckets, so a quantile is off by
+    at most about 3% of its value however wide the range recorded.
+    """
+
+    def __init__(self, unit=1, sub_bucket_bits=6):
+        self.unit = unit
+        self.sub_bucket_bits = sub_bucket_bits
+        self.half = 1 << (sub_bucket_bits - 1)
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def index(self, n):
+        shift = n.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return n
+        return shift * self.half + (n >> shift)
+
+    def bounds(self, index):
+        """The integers ``[low, high)`` counted by a bucket."""
+        if index < 2 * self.half:
+            return index, index + 1
+        shift = index // self.half - 1
+        mantissa = index - shift * self.half
+        return mantissa << shift, (mantissa + 1) << shift
+
+    def record(self, value):
+        index = self.index(max(0, int(value / self.unit)))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        low, high = self.bounds(index)
+        return (low + high - 1) / 2 * self.unit
+
+
+class RequestMetrics:
+    __slots__ = ("duration", "queries", "db", "serializer", "gateway", "timing")
+
+    def __init__(self):
+        self.duration = self.db = self.serializer = self.gateway = 0.0
+        self.queries = 0
+        self.timing = set()
+
+
+_current = ContextVar("request_metrics", default=None)
+_histograms = {}
+_lock = threading.Lock()
+
+
+class _Timer:
+    __slots__ = ("metrics", "kind", "started")
+
+    def __init__(self, metrics, kind):
+        self.metrics = metrics
+        self.kind = kind
+        self.started = None
+
+    def __enter__(self):
+        # Nested serializers are timed by the outermost one.
+        if self.kind not in self.metrics.timing:
+            self.metrics.timing.add(self.kind)
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.started is not None:
+            self.metrics.timing.discard(self.kind)
+            setattr(self.metrics, self.kind, getattr(self.metrics, self.kind) + time.perf_counter() - self.started)
+
+
+class _NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_TIMER = _NoTimer()
+
+
+def timer(kind):
+    """Add the time spent in the block to the ``serializer`` or ``gateway`` time of a sampled request."""
+    metrics = _current.get()
+    return NO_TIMER if metrics is None else _Timer(metrics, kind)
+
+
+def record_query(execute, sql, params, many, context):
+    """``execute_wrapper`` counting the queries of sampled requests; see ``instrument``."""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db += time.perf_counter() - started
+
+
+def instrument(connection):
+    # Installed on the connection rather than per request, so queries run by
+    # sync_to_async threads under ASGI are counted too.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def sampled():
+    rate = settings.METRICS_SAMPLE_RATE
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def route_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.url_name or match.view_name
+
+
+def record(route, metrics):
+    with _lock:
+        for name, _, unit, attribute in METRICS:
+            histogram = _histograms.get((name, route))
+            if histogram is None:
+                histogram = _histograms[(name, route)] = Histogram(unit)
+            histogram.record(getattr(metrics, attribute))
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def server_timing(metrics):
+    entries = [
+        f"app;dur={metrics.duration * 1000:.2f}",
+        f'db;dur={metrics.db * 1000:.2f};desc="{metrics.queries} queries"',
+    ]
+    if metrics.serializer:
+        entries.append(f"serializer;dur={metrics.serializer * 1000:.2f}")
+    if metrics.gateway:
+        entries.append(f"gateway;dur={metrics.gateway * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not sampled():
+            return self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, started)
+
+    async def __acall__(self, request):
+        if not sampled():
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, started)
+
+    def finish(self, request, response, metrics, started):
+        metrics.duration = time.perf_counter() - started
+        record(route_name(request), metrics)
+        response["Server-Timing"] = server_timing(metrics)
+        return response
+
+
+def render():
+    with _lock:
+        histograms = sorted(_histograms.items())
+        lines = []
+        for name, description, _, _ in METRICS:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} summary"]
+            for (metric, route), histogram in histograms:
+                if metric != name:
+                    continue
+                for q in QUANTILES:
+                    lines.append(f'{name}{{route="{route}",quantile="{q}"}} {histogram.quantile(q):.6g}')
+                lines.append(f'{name}_sum{{route="{route}"}} {histogram.sum:.6g}')
+                lines.append(f'{name}_count{{route="{route}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """Serve the histograms to whoever presents ``METRICS_TOKEN``; nobody when it is unset."""
+    token = settings.METRICS_TOKEN
+    if not token:
+        return HttpResponse(status=403)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=401)
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
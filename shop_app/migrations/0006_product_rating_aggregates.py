@@ -0,0 +1,73 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:18
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('shop_app', 'Product')
+    Review = apps.get_model('shop_app', 'Review')
+    rows = Review.objects.order_by().values('product_id').annotate(
+        rating_count=Count('id'),
+        rating_sum=Sum('rating'),
+        **{f'rating_{star}': Count('id', filter=Q(rating=star)) for star in range(1, 6)},
+    )
+    for row in rows:
+        product_id = row.pop('product_id')
+        row['rating_average'] = row['rating_sum'] / row['rating_count']
+        Product.objects.filter(pk=product_id).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0005_transaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_average',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-rating_average', 'id'], name='product_rating_idx'),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0006_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
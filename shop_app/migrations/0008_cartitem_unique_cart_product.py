@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:24
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_items(apps, schema_editor):
+    CartItem = apps.get_model('shop_app', 'CartItem')
+    duplicates = (CartItem.objects.values('cart_id', 'product_id')
+                  .annotate(rows=Count('id'), keep=Min('id'), total=Sum('quantity'))
+                  .filter(rows__gt=1))
+    for row in duplicates:
+        CartItem.objects.filter(pk=row['keep']).update(quantity=row['total'])
+        CartItem.objects.filter(cart_id=row['cart_id'], product_id=row['product_id']).exclude(pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0007_product_thumbnails'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
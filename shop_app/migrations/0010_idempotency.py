@@ -0,0 +1,49 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:31
+
+import django.core.serializers.json
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def supersede_duplicate_pending(apps, schema_editor):
+    Transaction = apps.get_model('shop_app', 'Transaction')
+    duplicates = (Transaction.objects.filter(status='pending').values('cart_id')
+                  .annotate(rows=Count('id'), keep=Max('id')).filter(rows__gt=1))
+    for row in duplicates:
+        (Transaction.objects.filter(cart_id=row['cart_id'], status='pending')
+         .exclude(pk=row['keep']).update(status='superseded'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0009_paymentjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('scope', models.CharField(max_length=100)),
+                ('owner', models.CharField(max_length=50)),
+                ('request_hash', models.CharField(max_length=64)),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('response', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.RunPython(supersede_duplicate_pending, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('cart',), name='unique_pending_transaction_per_cart'),
+        ),
+        migrations.AddConstraint(
+            model_name='idempotencykey',
+            constraint=models.UniqueConstraint(fields=('scope', 'owner', 'key'), name='unique_idempotency_key'),
+        ),
+    ]
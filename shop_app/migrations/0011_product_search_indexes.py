@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+SEARCH_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    # PostgreSQL only: other databases search through the in-process index
+    # of shop_app.search.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'ALTER TABLE shop_app_product ADD COLUMN search_document tsvector '
+        f'GENERATED ALWAYS AS ({SEARCH_DOCUMENT}) STORED'
+    )
+    schema_editor.execute('CREATE INDEX product_search_idx ON shop_app_product USING gin (search_document)')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX product_name_trgm_idx ON shop_app_product USING gin (name gin_trgm_ops)')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS product_name_trgm_idx')
+    schema_editor.execute('ALTER TABLE shop_app_product DROP COLUMN IF EXISTS search_document')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0010_idempotency'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0011_product_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['size', 'color', 'price'], name='product_size_color_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['color', 'price'], name='product_color_price_idx'),
+        ),
+    ]
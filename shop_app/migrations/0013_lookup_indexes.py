@@ -0,0 +1,62 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe_slugs(apps, schema_editor):
+    """Give every product but the oldest of a duplicated slug a ``-<id>`` suffix."""
+    Product = apps.get_model('shop_app', 'Product')
+    taken = set(Product.objects.exclude(slug=None).values_list('slug', flat=True))
+    duplicates = (Product.objects.exclude(slug=None).values('slug')
+                  .annotate(rows=Count('id')).filter(rows__gt=1).values_list('slug', flat=True))
+    for slug in list(duplicates):
+        for product in Product.objects.filter(slug=slug).order_by('id')[1:]:
+            renamed = f'{slug}-{product.pk}' if slug else None
+            while renamed in taken:
+                renamed += '-1'
+            taken.add(renamed)
+            Product.objects.filter(pk=product.pk).update(slug=renamed)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0012_product_facet_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='slug',
+            field=models.SlugField(blank=True, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('paid', False)), fields=['user'], name='cart_unpaid_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('paid', True)), fields=['user', '-modified_at'], name='cart_paid_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', '-created', '-id'], name='review_product_created_idx'),
+        ),
+        # Both foreign keys lead a composite index now; drop their own indexes
+        # only after those exist.
+        migrations.AlterField(
+            model_name='cartitem',
+            name='cart',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='items', to='shop_app.cart'),
+        ),
+        migrations.AlterField(
+            model_name='review',
+            name='product',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='reviews', to='shop_app.product'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:13
+
+import re
+
+from django.db import migrations, models
+
+
+NUMBERED_SLUG_RE = re.compile(r'(.+)-(\d+)')
+
+
+def seed_counters(apps, schema_editor):
+    """Start every counter past the numbers the existing slugs already use."""
+    Product = apps.get_model('shop_app', 'Product')
+    SlugCounter = apps.get_model('shop_app', 'SlugCounter')
+    next_numbers = {}
+    for slug in Product.objects.exclude(slug=None).values_list('slug', flat=True).iterator(chunk_size=2000):
+        next_numbers[slug] = max(next_numbers.get(slug, 0), 1)
+        match = NUMBERED_SLUG_RE.fullmatch(slug)
+        if match:
+            base, number = match.group(1), int(match.group(2))
+            next_numbers[base] = max(next_numbers.get(base, 0), number + 1)
+    SlugCounter.objects.bulk_create(
+        [SlugCounter(base=base, next_number=number) for base, number in next_numbers.items()], batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0013_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlugCounter',
+            fields=[
+                ('base', models.SlugField(primary_key=True, serialize=False)),
+                ('next_number', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0014_slug_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', 'rating', '-created', '-id'], name='review_product_rating_idx'),
+        ),
+    ]
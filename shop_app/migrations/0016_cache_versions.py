@@ -0,0 +1,20 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0015_review_rating_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheVersion',
+            fields=[
+                ('key', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('stamp', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -1,10 +1,68 @@
-from django.db import models
+from collections import Counter
+
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Cast
+from django.utils import timezone
 from django.utils.text import slugify
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 
 # Create your models here.
 
 
+SLUG_MAX_LENGTH = 50
+# Leaves room for a "-<number>" suffix.
+SLUG_BASE_LENGTH = 40
+SLUG_ATTEMPTS = 3
+
+
+def base_slug(name):
+    return slugify(name)[:SLUG_BASE_LENGTH].strip("-") or "product"
+
+
+def numbered_slug(base, number):
+    return base if number == 0 else f"{base}-{number}"
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class ProductQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # save() is not called here, so allocate the missing slugs for the whole batch at once.
+        objs = list(objs)
+        unslugged = [product for product in objs if not product.slug]
+        slugs = SlugCounter.objects.db_manager(self.db).allocate([base_slug(product.name) for product in unslugged])
+        for product, slug in zip(unslugged, slugs):
+            product.slug = slug
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+def cart_items_prefetch():
+    return models.Prefetch("items", queryset=CartItem.objects.select_related("product"))
+
+
+ORDER_PRODUCT_FIELDS = ["id", "name", "slug", "image", "price"]
+
+
+class CartQuerySet(models.QuerySet):
+    def with_items(self):
+        return self.prefetch_related(cart_items_prefetch())
+
+    def orders(self, user):
+        """The paid carts of ``user`` with their items' products and completed payments."""
+        items = CartItem.objects.select_related("product").only(
+            "id", "quantity", "cart_id", *(f"product__{field}" for field in ORDER_PRODUCT_FIELDS))
+        return self.filter(user=user, paid=True).prefetch_related(
+            models.Prefetch("items", queryset=items.order_by("id")),
+            models.Prefetch("transactions", queryset=Transaction.objects.filter(status="completed").order_by("id"),
+                            to_attr="payments"),
+        )
+
+
 class Product(models.Model):
     SIZES = [
         ("S", "Small"),
@@ -20,29 +78,143 @@ class Product(models.Model):
         ("White", "White"),
     ]
     name = models.CharField(max_length=100)
-    slug = models.SlugField(blank=True, null=True)
+    slug = models.SlugField(max_length=SLUG_MAX_LENGTH, unique=True, blank=True, null=True)
     image = models.ImageField(upload_to="img")
     description = models.TextField(blank=True, null=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     size = models.CharField(max_length=10, choices=SIZES, blank=True, null=True)
     color = models.CharField(max_length=15, choices=COLORS, blank=True, null=True)
     popularity = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_average = models.FloatField(default=0)
+    rating_1 = models.IntegerField(default=0)
+    rating_2 = models.IntegerField(default=0)
+    rating_3 = models.IntegerField(default=0)
+    rating_4 = models.IntegerField(default=0)
+    rating_5 = models.IntegerField(default=0)
+    thumbnails = models.JSONField(default=dict, blank=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # On PostgreSQL the table also has a generated ``search_document``
+        # column for full-text search, see shop_app.search.
+        indexes = [
+            models.Index(fields=["-rating_average", "id"], name="product_rating_idx"),
+            # The facet filters of /products and /products/facets; the first
+            # also covers the grouped facet count query.
+            models.Index(fields=["size", "color", "price"], name="product_size_color_idx"),
+            models.Index(fields=["color", "price"], name="product_color_price_idx"),
+        ]
 
     def __str__(self):
         return self.name 
     
     def save(self, *args, **kwargs):
+        if self.slug:
+            return super().save(*args, **kwargs)
+
+        # The counters never hand out a slug twice; retrying only covers a
+        # slug set by hand on another product in the meantime.
+        for attempt in range(SLUG_ATTEMPTS):
+            self.slug = SlugCounter.objects.allocate([base_slug(self.name)])[0]
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == SLUG_ATTEMPTS - 1 or not Product.objects.filter(slug=self.slug).exists():
+                    self.slug = None
+                    raise
+
+    @property
+    def rating_histogram(self):
+        return {star: getattr(self, f"rating_{star}") for star in range(1, 6)}
+
+    def update_ratings(self, added=None, removed=None):
+        """Add the rating ``added`` and/or take ``removed`` out of the stored aggregates with one UPDATE.
+
+        Passing both moves a review from one rating to the other. The
+        arithmetic runs in the database, so concurrent reviews never overwrite
+        each other's counts.
+        """
+        if added == removed:
+            return
+        count = (added is not None) - (removed is not None)
+        total = (added or 0) - (removed or 0)
+        stars = {}
+        if added is not None:
+            stars[f"rating_{added}"] = models.F(f"rating_{added}") + 1
+        if removed is not None:
+            stars[f"rating_{removed}"] = models.F(f"rating_{removed}") - 1
+        Product.objects.filter(pk=self.pk).update(
+            rating_count=models.F("rating_count") + count,
+            rating_sum=models.F("rating_sum") + total,
+            rating_average=models.Case(
+                models.When(rating_count__lte=-count, then=models.Value(0.0)),
+                default=Cast(models.F("rating_sum") + total, models.FloatField())
+                / (models.F("rating_count") + count),
+            ),
+            **stars,
+        )
+
+class SlugCounterManager(models.Manager):
+    def allocate(self, bases):
+        """Return a product slug for each of ``bases``, in order, unique across products.
+
+        Each base has a counter row handing out ``base``, ``base-1``,
+        ``base-2``... The rows are locked while numbers are taken, so
+        concurrent allocations never get the same slug, and a batch costs a
+        few queries per 500 distinct bases however many products share them.
+        Numbers whose slug was already set by hand are skipped.
+        """
+        needed = Counter(bases)
+        if not needed:
+            return []
+        with transaction.atomic(using=self.db):
+            self.bulk_create([SlugCounter(base=base) for base in needed], ignore_conflicts=True)
+            counters = {}
+            for chunk in _chunks(sorted(needed)):
+                counters.update((counter.base, counter)
+                                for counter in self.select_for_update().filter(base__in=chunk).order_by("base"))
+
+            numbers = {base: [] for base in needed}
+            short = dict(needed)
+            while short:
+                candidates = {}
+                for base, count in short.items():
+                    counter = counters[base]
+                    for number in range(counter.next_number, counter.next_number + count):
+                        candidates[numbered_slug(base, number)] = (base, number)
+                    counter.next_number += count
+                taken = set()
+                for chunk in _chunks(candidates):
+                    taken.update(Product.objects.using(self.db).filter(slug__in=chunk).values_list("slug", flat=True))
+                short = Counter()
+                for slug, (base, number) in candidates.items():
+                    if slug in taken:
+                        short[base] += 1
+                    else:
+                        numbers[base].append(number)
+            # The rows are locked, so writing the new values back as an upsert
+            # is safe, and far cheaper to build than bulk_update's CASE.
+            self.bulk_create(counters.values(), update_conflicts=True, unique_fields=["base"],
+                             update_fields=["next_number"], batch_size=500)
+
+        numbers = {base: iter(allocated) for base, allocated in numbers.items()}
+        return [numbered_slug(base, next(numbers[base])) for base in bases]
+
+
+class SlugCounter(models.Model):
+    """The next number to suffix a product slug base with."""
+    base = models.SlugField(max_length=SLUG_MAX_LENGTH, primary_key=True)
+    next_number = models.PositiveIntegerField(default=0)
+
+    objects = SlugCounterManager()
+
+    def __str__(self):
+        return f"{self.base} ({self.next_number})"
 
-        if not self.slug:
-            self.slug = slugify(self.name)
-            unique_slug = self.slug
-            counter = 1
-            if Product.objects.filter(slug=unique_slug).exists():
-                unique_slug = f'{self.slug}-{counter}'
-                counter += 1
-            self.slug = unique_slug
-        
-        super().save(*args, **kwargs)
 
 class Cart(models.Model):
     cart_code = models.CharField(max_length=11, unique=True)
@@ -50,14 +222,29 @@ class Cart(models.Model):
     paid = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     modified_at = models.DateTimeField(auto_now=True, blank=True, null=True)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Cart merging looks up a user's open carts, order history their paid ones.
+            models.Index(fields=["user"], condition=models.Q(paid=False), name="cart_unpaid_user_idx"),
+            models.Index(fields=["user", "-modified_at"], condition=models.Q(paid=True), name="cart_paid_user_idx"),
+        ]
     
     def __str__(self):
         return self.cart_code
 
 class CartItem(models.Model):
-    cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE)
+    # unique_cart_product already indexes lookups by cart.
+    cart = models.ForeignKey(Cart, related_name='items', on_delete=models.CASCADE, db_index=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["cart", "product"], name="unique_cart_product"),
+        ]
     
     def __str__(self):
         return f"{self.quantity} x {self.product.name} in cart {self.cart.id}"
@@ -70,12 +257,19 @@ class Review(models.Model):
         (4, "⭐⭐⭐⭐"),
         (5, "⭐⭐⭐⭐⭐"),
     ]
-    product = models.ForeignKey(Product, related_name="reviews", on_delete=models.CASCADE)
+    # Indexed by review_product_created_idx and review_product_rating_idx.
+    product = models.ForeignKey(Product, related_name="reviews", on_delete=models.CASCADE, db_index=False)
     reviewer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     body = models.TextField()
     rating = models.IntegerField(choices=STAR_CHOICES)
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["product", "-created", "-id"], name="review_product_created_idx"),
+            models.Index(fields=["product", "rating", "-created", "-id"], name="review_product_rating_idx"),
+        ]
+
     def __str__(self):
         return f"{self.reviewer.username} - {self.product.name}"
 
@@ -89,5 +283,77 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["cart"], condition=models.Q(status="pending"),
+                                    name="unique_pending_transaction_per_cart"),
+        ]
+
+    def __str__(self):
+        return f"Transaction {self.ref} - {self.status}"
+
+class PaymentJob(models.Model):
+    FLUTTERWAVE = "flutterwave"
+    PAYPAL = "paypal"
+    KINDS = [
+        (FLUTTERWAVE, "Flutterwave"),
+        (PAYPAL, "PayPal"),
+    ]
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    DEAD = "dead"
+    STATUSES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (DEAD, "Dead"),
+    ]
+    kind = models.CharField(max_length=20, choices=KINDS)
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name="jobs")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    locked_by = models.CharField(max_length=32, blank=True, default="")
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="paymentjob_ready_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} job {self.id} for {self.transaction.ref} - {self.status}"
+
+
+class IdempotencyKey(models.Model):
+    key = models.CharField(max_length=255)
+    scope = models.CharField(max_length=100)
+    owner = models.CharField(max_length=50)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.IntegerField(blank=True, null=True)
+    response = models.JSONField(blank=True, null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "owner", "key"], name="unique_idempotency_key"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key}"
+
+
+class CacheVersion(models.Model):
+    """A catalog version stamp (see ``shop_app.cache``), shared by every process."""
+    key = models.CharField(max_length=100, primary_key=True)
+    stamp = models.BigIntegerField()
+
     def __str__(self):
-        return f"Transaction {self.ref} - {self.status}"
\ No newline at end of file
+        return f"{self.key} ({self.stamp})"
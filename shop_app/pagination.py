@@ -0,0 +1,94 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(key, values):
+    payload = json.dumps({"o": key, "v": values}, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(key, cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values = payload["v"]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor("Invalid cursor.")
+    if payload.get("o") != key or not isinstance(values, list):
+        raise InvalidCursor("Cursor does not match the requested ordering.")
+    return values
+
+
+def cursor_values(fields, values):
+    """Convert decoded cursor ``values`` with the model ``fields`` they sort on.
+
+    A cursor is client input: a value the column cannot hold must be rejected
+    here rather than fail inside the database query.
+    """
+    if len(values) != len(fields):
+        raise InvalidCursor("Invalid cursor.")
+    try:
+        values = [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValidationError, TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor.")
+    if any(value is None and not field.null for field, value in zip(fields, values)):
+        raise InvalidCursor("Invalid cursor.")
+    return values
+
+
+def get_page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def after_position(ordering, values):
+    """Build the filter selecting rows that sort strictly after ``values``.
+
+    ``ordering`` is a tuple of ``order_by`` terms ending in a unique column,
+    e.g. ``("-popularity", "id")``, so every position is unambiguous.
+    """
+    if len(values) != len(ordering):
+        raise InvalidCursor("Invalid cursor.")
+    condition = Q()
+    for index, term in enumerate(ordering):
+        field = term.lstrip("-")
+        lookup = "lt" if term.startswith("-") else "gt"
+        step = Q(**{f"{field}__{lookup}": values[index]})
+        for previous, value in zip(ordering[:index], values):
+            step &= Q(**{previous.lstrip("-"): value})
+        condition |= step
+    return condition
+
+
+def paginate_keyset(queryset, key, ordering, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """Return ``(rows, next_cursor)`` for one page of ``queryset``.
+
+    Pages are addressed by the sort values of the last row served instead of an
+    offset, so inserts ahead of the cursor never shift or repeat rows.
+    """
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        fields = [queryset.model._meta.get_field(term.lstrip("-")) for term in ordering]
+        values = cursor_values(fields, decode_cursor(key, cursor))
+        queryset = queryset.filter(after_position(ordering, values))
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor(key, [getattr(last, term.lstrip("-")) for term in ordering])
+    return rows, next_cursor
@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from .models import Product, Review
+
+
+RATING_FIELDS = ["rating_count", "rating_sum", "rating_average",
+                 "rating_1", "rating_2", "rating_3", "rating_4", "rating_5"]
+
+
+def rating_aggregates():
+    """Return ``{product_id: {field: value}}`` computed in one grouped query."""
+    rows = Review.objects.order_by().values("product_id").annotate(
+        rating_count=Count("id"),
+        rating_sum=Sum("rating"),
+        **{f"rating_{star}": Count("id", filter=Q(rating=star)) for star in range(1, 6)},
+    )
+    aggregates = {}
+    for row in rows:
+        product_id = row.pop("product_id")
+        row["rating_average"] = row["rating_sum"] / row["rating_count"]
+        aggregates[product_id] = row
+    return aggregates
+
+
+def rebuild_rating_aggregates(batch_size=1000):
+    """Recompute the stored rating columns of every product; return how many changed."""
+    empty = dict.fromkeys(RATING_FIELDS, 0)
+    changed = 0
+    with transaction.atomic():
+        aggregates = rating_aggregates()
+        batch = []
+        for product in Product.objects.only("id", *RATING_FIELDS).iterator(chunk_size=batch_size):
+            values = aggregates.get(product.id, empty)
+            if all(getattr(product, field) == values[field] for field in RATING_FIELDS):
+                continue
+            for field in RATING_FIELDS:
+                setattr(product, field, values[field])
+            batch.append(product)
+            if len(batch) >= batch_size:
+                Product.objects.bulk_update(batch, RATING_FIELDS)
+                changed += len(batch)
+                batch = []
+        if batch:
+            Product.objects.bulk_update(batch, RATING_FIELDS)
+            changed += len(batch)
+    return changed
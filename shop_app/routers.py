@@ -0,0 +1,84 @@
+"""Send catalog reads to read replicas.
+
+Views wrapped in ``replica_reads`` read products and reviews from one of
+``settings.DATABASE_REPLICAS``; every other read, and every write, goes to the
+primary. A replica may lag behind the primary, so a view also stays on the
+primary while the catalog version its response depends on is younger than
+``REPLICA_PIN_SECONDS``: whoever just wrote a review or edited a product reads
+their own write, and a response built from a stale replica is never cached
+under the version the write created.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .cache import request_versions
+
+
+REPLICATED_MODELS = {("shop_app", "product"), ("shop_app", "review")}
+
+_replica = ContextVar("replica", default=None)
+
+
+@contextmanager
+def use_replica(alias=None):
+    """Route catalog reads to ``alias``, or to a random replica.
+
+    One replica serves the whole block, so its queries see the same point of
+    the replication stream.
+    """
+    token = _replica.set(alias or random.choice(settings.DATABASE_REPLICAS))
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def recently_written(request, slug=None):
+    """Whether the product ``slug``, or the listings without one, changed within ``REPLICA_PIN_SECONDS``.
+
+    The stamps are read from the primary's shared table, so a write pins the
+    reads of every worker, not only of the one that handled it.
+    """
+    newest = max(request_versions(request, slug))
+    return time.time_ns() - newest < settings.REPLICA_PIN_SECONDS * 1e9
+
+
+def replica_reads(view):
+    """Read the catalog from a replica in a read-only view, unless it changed a moment ago.
+
+    Inside a transaction on the primary the view reads from the primary too,
+    which is the only place its uncommitted writes are visible.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if (not settings.DATABASE_REPLICAS or connections[DEFAULT_DB_ALIAS].in_atomic_block
+                or recently_written(request, kwargs.get("slug"))):
+            return view(request, *args, **kwargs)
+        with use_replica():
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replica = _replica.get()
+        if replica and (model._meta.app_label, model._meta.model_name) in REPLICATED_MODELS:
+            return replica
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Explicitly, so saving an instance read from a replica does not
+        # write to the replica.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,216 @@
+"""Ranked product search over ``name`` and ``description``.
+
+On PostgreSQL the match runs against ``search_document``, a weighted
+``tsvector`` column that the database generates from both fields and that
+the ``product_search_idx`` GIN index covers (see migration 0011; the column
+is not part of the model, so it only exists there). Every term is matched as
+a prefix. When the ``pg_trgm`` extension is installed, names that
+contain a word within a typo of the query match too, through the
+``product_name_trgm_idx`` trigram index.
+
+Other databases (SQLite in development and tests) use an in-process inverted
+index with the same prefix and typo tolerance. It is rebuilt whenever the
+catalog version in ``shop_app.cache`` changes.
+"""
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from functools import lru_cache
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField, TrigramWordSimilarity
+from django.db import connections
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+from .cache import CATALOG_KEY, EPOCH_KEY, get_versions
+from .models import Product
+from .pagination import cursor_values, decode_cursor, encode_cursor
+
+
+CONFIG = "english"
+# ts_rank's default weights of the A (name) and B (description) labels.
+NAME_WEIGHT = 1.0
+DESCRIPTION_WEIGHT = 0.4
+PREFIX_QUALITY = 0.8
+TYPO_QUALITY = 0.6
+TYPO_MIN_LENGTH = 4
+MAX_EXPANSIONS = 64
+MAX_TERMS = 8
+
+TOKEN_RE = re.compile(r"[0-9a-z]+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or "").lower())
+
+
+def query_terms(query):
+    return tokenize(query)[:MAX_TERMS]
+
+
+def search_document():
+    return RawSQL(f'"{Product._meta.db_table}"."search_document"', [], output_field=SearchVectorField())
+
+
+@lru_cache(maxsize=None)
+def trigram_available(alias):
+    with connections[alias].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def _deletions(token):
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+class InvertedIndex:
+    """Token -> ``{product_id: weight}`` postings with prefix and typo expansion.
+
+    Typos are found SymSpell style: every indexed word is reachable from the
+    words one deletion away, so a query term matches the words it shares a
+    deletion variant with, which covers one substitution, insertion,
+    deletion or transposition.
+    """
+
+    def __init__(self, rows):
+        self.postings = defaultdict(dict)
+        for product_id, name, description in rows:
+            for text, weight in ((description, DESCRIPTION_WEIGHT), (name, NAME_WEIGHT)):
+                for token in tokenize(text):
+                    postings = self.postings[token]
+                    postings[product_id] = max(postings.get(product_id, 0), weight)
+        self.vocabulary = sorted(self.postings)
+        self.variants = defaultdict(set)
+        for token in self.vocabulary:
+            if len(token) >= TYPO_MIN_LENGTH and token.isalpha():
+                for variant in _deletions(token) | {token}:
+                    self.variants[variant].add(token)
+
+    def expand(self, term):
+        """Return ``{token: quality}`` of the indexed words matching ``term``."""
+        matches = {}
+        if term in self.postings:
+            matches[term] = 1.0
+        start = bisect_left(self.vocabulary, term)
+        for token in self.vocabulary[start:start + MAX_EXPANSIONS]:
+            if not token.startswith(term):
+                break
+            matches.setdefault(token, PREFIX_QUALITY)
+        if len(term) >= TYPO_MIN_LENGTH and term.isalpha():
+            for variant in _deletions(term) | {term}:
+                for token in self.variants.get(variant, ()):
+                    matches.setdefault(token, TYPO_QUALITY)
+        return matches
+
+    def search(self, terms):
+        """Return ``[(score, product_id)]`` of products matching every term, best first."""
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for token, quality in self.expand(term).items():
+                for product_id, weight in self.postings[token].items():
+                    if weight * quality > term_scores.get(product_id, 0):
+                        term_scores[product_id] = weight * quality
+            if scores is not None:
+                term_scores = {product_id: scores[product_id] + score
+                               for product_id, score in term_scores.items() if product_id in scores}
+            scores = term_scores
+            if not scores:
+                return []
+        return sorted(((score, product_id) for product_id, score in scores.items()),
+                      key=lambda hit: (-hit[0], hit[1]))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    version = tuple(get_versions(EPOCH_KEY, CATALOG_KEY))
+    with _index_lock:
+        if _index is None or _index[0] != version:
+            rows = Product.objects.order_by().values_list("id", "name", "description").iterator(chunk_size=2000)
+            _index = (version, InvertedIndex(rows))
+        return _index[1]
+
+
+def _tsquery(terms):
+    # Terms are plain [0-9a-z] tokens, so the raw tsquery syntax is safe.
+    return SearchQuery(" & ".join(f"{term}:*" for term in terms), search_type="raw", config=CONFIG)
+
+
+def _postgres_filter(terms, query, alias):
+    condition = Q(search_document=_tsquery(terms))
+    if trigram_available(alias):
+        condition |= Q(name__trigram_word_similar=query)
+    return condition
+
+
+def matching_products(queryset, query):
+    """Filter ``queryset`` to the products matching ``query``, without ranking."""
+    terms = query_terms(query)
+    if not terms:
+        return queryset.none()
+    if connections[queryset.db].vendor == "postgresql":
+        return queryset.annotate(search_document=search_document()).filter(_postgres_filter(terms, query, queryset.db))
+    return queryset.filter(pk__in=[product_id for _, product_id in get_index().search(terms)])
+
+
+def search_products(query, queryset=None, cursor=None, page_size=20):
+    """Return ``(products, next_cursor)`` for one page of ranked matches of ``query``.
+
+    Each product carries its ``search_rank``. Pages are keyed on ``(rank, id)``
+    like the keyset pagination of ``/products``; cursors only fit the query
+    they were issued for.
+    """
+    queryset = Product.objects.all() if queryset is None else queryset
+    terms = query_terms(query)
+    if not terms:
+        return [], None
+    key = "search:" + " ".join(terms)
+    after = cursor_values([FloatField(), Product._meta.pk], decode_cursor(key, cursor)) if cursor else None
+
+    if connections[queryset.db].vendor == "postgresql":
+        products = _postgres_page(queryset, terms, query, after, page_size)
+    else:
+        products = _index_page(queryset, terms, after, page_size)
+
+    next_cursor = None
+    if len(products) > page_size:
+        products = products[:page_size]
+        next_cursor = encode_cursor(key, [products[-1].search_rank, products[-1].pk])
+    return products, next_cursor
+
+
+def _postgres_page(queryset, terms, query, after, page_size):
+    vector = search_document()
+    rank = SearchRank(vector, _tsquery(terms))
+    if trigram_available(queryset.db):
+        rank = rank + TrigramWordSimilarity(query, "name")
+    # ts_rank returns a real; compared against the float from a cursor it
+    # would never match exactly and the page would repeat.
+    rank = Cast(rank, FloatField())
+    queryset = (queryset.annotate(search_document=vector, search_rank=rank)
+                .filter(_postgres_filter(terms, query, queryset.db)).order_by("-search_rank", "id"))
+    if after is not None:
+        queryset = queryset.filter(Q(search_rank__lt=after[0]) | Q(search_rank=after[0], id__gt=after[1]))
+    return list(queryset[:page_size + 1])
+
+
+def _index_page(queryset, terms, after, page_size):
+    hits = get_index().search(terms)
+    start = 0
+    if after is not None:
+        start = bisect_right([(-score, product_id) for score, product_id in hits], (-after[0], after[1]))
+    page = hits[start:start + page_size + 1]
+    products = queryset.in_bulk([product_id for _, product_id in page])
+    ranked = []
+    for score, product_id in page:
+        # The index may briefly list a product another worker just deleted.
+        if product_id in products:
+            products[product_id].search_rank = score
+            ranked.append(products[product_id])
+    return ranked
@@ -1,30 +1,59 @@
 from rest_framework import serializers 
-from .models import Product, Cart, CartItem, Review
+from .models import ORDER_PRODUCT_FIELDS, Product, Cart, CartItem, Review
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
 from core.models import CustomUser
+from .carts import cart_totals
+from . import metrics
 
-class ReviewSerializer(serializers.ModelSerializer):
+
+class TimedModelSerializer(serializers.ModelSerializer):
+    """Counts the time it takes towards the serializer time of ``shop_app.metrics``."""
+
+    def to_representation(self, instance):
+        with metrics.timer("serializer"):
+            return super().to_representation(instance)
+
+class DynamicFieldsModelSerializer(TimedModelSerializer):
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+
+class ReviewSerializer(TimedModelSerializer):
     reviewer_name = serializers.CharField(source="reviewer.username", read_only=True)
 
     class Meta:
         model = Review
         fields = ["id", "reviewer_name", "body", "rating", "created"]
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(DynamicFieldsModelSerializer):
     average_rating = serializers.SerializerMethodField()
-    reviews = ReviewSerializer(many=True, read_only=True)
-    
+    thumbnails = serializers.SerializerMethodField()
+
     class Meta:
         model = Product 
-        fields = ["id", "name", "slug", "image", "description", "price", "size","color","popularity","average_rating","reviews",]
+        fields = ["id", "name", "slug", "image", "description", "price", "size","color","popularity","average_rating","rating_count","thumbnails",]
         
     def get_average_rating(self, product):
-        reviews = product.reviews.all()
-        if reviews.exists():
-            return round(sum(review.rating for review in reviews) / reviews.count(), 1)
-        return 0
-
-class DetailedProductSerializer(serializers.ModelSerializer):
+        return round(product.rating_average, 1)
+
+    def get_thumbnails(self, product):
+        request = self.context.get("request")
+        thumbnails = {}
+        for width, variants in product.thumbnails.items():
+            if width == "source":
+                continue
+            thumbnails[width] = {}
+            for extension, name in variants.items():
+                url = default_storage.url(name)
+                thumbnails[width][extension] = request.build_absolute_uri(url) if request else url
+        return thumbnails
+
+class DetailedProductSerializer(TimedModelSerializer):
     similar_products = serializers.SerializerMethodField()
     class Meta:
         model = Product
@@ -36,7 +65,7 @@ class DetailedProductSerializer(serializers.ModelSerializer):
         return serializer.data
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedModelSerializer):
     product = ProductSerializer(read_only=True)
     total = serializers.SerializerMethodField()
     class Meta:
@@ -49,7 +78,7 @@ class CartItemSerializer(serializers.ModelSerializer):
         return price
     
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TimedModelSerializer):
     items = CartItemSerializer(read_only=True, many=True)
     sum_total = serializers.SerializerMethodField()
     num_of_items = serializers.SerializerMethodField()
@@ -59,66 +88,63 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ["id", "cart_code", "items", "sum_total", "num_of_product", "num_of_items", "created_at", "modified_at"]
 
     def get_sum_total(self, cart):
-        items = cart.items.all()
-        total = sum([item.product.price * item.quantity for item in items])
-        return total
+        return cart_totals(cart)["sum_total"]
 
     def get_num_of_items(self, cart):
-        items = cart.items.all()
-        total = sum([item.quantity for item in items])
-        return total
+        return cart_totals(cart)["num_of_items"]
 
     def get_num_of_product(self, cart):
-        product_ids = CartItem.objects.filter(cart=cart).values_list("product_id", flat=True)
-        product_count = product_ids.distinct().count()
-        return product_count
+        return cart_totals(cart)["num_of_product"]
 
 
-class SimpleCartSerializer(serializers.ModelSerializer):
+class SimpleCartSerializer(TimedModelSerializer):
     num_of_items = serializers.SerializerMethodField()
     class Meta:
         model = Cart 
         fields = ["id", "cart_code", "num_of_items"]
 
     def get_num_of_items(self, cart):
-        num_of_items = sum([item.quantity for item in cart.items.all()])
-        return num_of_items
+        return cart_totals(cart)["num_of_items"]
 
 
-class NewCartItemSerializer(serializers.ModelSerializer):
-    product = ProductSerializer(read_only=True)
-    order_id = serializers.SerializerMethodField()
-    order_date = serializers.SerializerMethodField()
+class OrderProductSerializer(TimedModelSerializer):
+    class Meta:
+        model = Product
+        fields = ORDER_PRODUCT_FIELDS
+
+
+class OrderItemSerializer(TimedModelSerializer):
+    product = OrderProductSerializer(read_only=True)
+
     class Meta:
         model = CartItem
-        fields = ["id", "product", "quantity", "order_id", "order_date"]
+        fields = ["id", "quantity", "product"]
 
-    def get_order_id(self, cartitem):
-        order_id = cartitem.cart.cart_code
-        return order_id
-    
-    def get_order_date(self, cartitem):
-        order_date = cartitem.cart.modified_at
-        return order_date
 
+class OrderSerializer(TimedModelSerializer):
+    """A paid cart from ``Cart.objects.orders``."""
+    items = OrderItemSerializer(read_only=True, many=True)
+    order_date = serializers.DateTimeField(source="modified_at", read_only=True)
+    payment = serializers.SerializerMethodField()
 
-class UserSerializer(serializers.ModelSerializer):
-    items = serializers.SerializerMethodField()
     class Meta:
-        model = CustomUser
-        fields = ["id", "username", "first_name", "last_name", "email", "city", "state", "address", "phone", "items"]
+        model = Cart
+        fields = ["id", "cart_code", "order_date", "items", "payment"]
 
-    def get_items(self, user):
-        cartitems = CartItem.objects.filter(cart__user=user, cart__paid=True)[:10]
-        if not cartitems.exists():
-            return [] 
-        serializer = NewCartItemSerializer(cartitems, many=True)
-        return serializer.data
+    def get_payment(self, cart):
+        if not cart.payments:
+            return None
+        payment = cart.payments[-1]
+        return {"ref": payment.ref, "amount": str(payment.amount), "currency": payment.currency}
 
 
+class UserSerializer(TimedModelSerializer):
+    class Meta:
+        model = CustomUser
+        fields = ["id", "username", "first_name", "last_name", "email", "city", "address", "phone"]
 
 
-class UserRegistrationSerializer(serializers.ModelSerializer):
+class UserRegistrationSerializer(TimedModelSerializer):
     class Meta:
         model = CustomUser
         fields = ["id", "username", "first_name", "last_name", "password"]
@@ -0,0 +1,75 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import cache, metrics
+from .thumbnails import build_thumbnails, needs_thumbnails
+from .carts import touch_cart
+from .models import CartItem, Product, Review
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    transaction.on_commit(partial(cache.invalidate_product, instance.slug))
+
+
+@receiver(post_save, sender=Product)
+def product_thumbnails(sender, instance, raw=False, **kwargs):
+    if raw or not needs_thumbnails(instance):
+        return
+    instance.thumbnails = build_thumbnails(instance.image.name)
+    Product.objects.filter(pk=instance.pk).update(thumbnails=instance.thumbnails)
+
+
+@receiver([post_save, post_delete], sender=Review)
+def review_changed(sender, instance, **kwargs):
+    if Review.product.is_cached(instance):
+        slug = instance.product.slug
+    else:
+        slug = Product.objects.filter(pk=instance.product_id).values_list("slug", flat=True).first()
+    transaction.on_commit(partial(cache.invalidate_product, slug))
+
+
+# Saves and deletes of single reviews keep the product's rating aggregates in
+# step; bulk operations and queryset updates bypass this, see rebuild_ratings.
+
+@receiver(pre_save, sender=Review)
+def review_stored_rating(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding:
+        return
+    instance._stored_rating = Review.objects.filter(pk=instance.pk).values_list("product_id", "rating").first()
+
+
+@receiver(post_save, sender=Review)
+def review_rating_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    stored = instance.__dict__.pop("_stored_rating", None)
+    if stored is None:
+        Product(pk=instance.product_id).update_ratings(added=instance.rating)
+    elif stored[0] == instance.product_id:
+        Product(pk=instance.product_id).update_ratings(added=instance.rating, removed=stored[1])
+    else:
+        Product(pk=stored[0]).update_ratings(removed=stored[1])
+        Product(pk=instance.product_id).update_ratings(added=instance.rating)
+        # review_changed invalidates the product the review moved to.
+        slug = Product.objects.filter(pk=stored[0]).values_list("slug", flat=True).first()
+        transaction.on_commit(partial(cache.invalidate_product, slug))
+
+
+@receiver(post_delete, sender=Review)
+def review_rating_deleted(sender, instance, **kwargs):
+    Product(pk=instance.product_id).update_ratings(removed=instance.rating)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    metrics.instrument(connection)
+
+
+@receiver([post_save, post_delete], sender=CartItem)
+def cart_item_changed(sender, instance, **kwargs):
+    touch_cart(instance.cart_id)
@@ -0,0 +1,142 @@
+import itertools
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paypalrestsdk
+
+
+class StubGateway:
+    """A local stand-in for the Flutterwave v3 API, for tests and benchmarks.
+
+    ``delay`` slows every response down to model a sluggish gateway, and
+    ``fail_next`` makes that many upcoming requests answer 503. Payments
+    created through ``POST /v3/payments`` can be verified through
+    ``GET /v3/transactions/<id>/verify``.
+
+        with StubGateway(delay=0.2) as gateway:
+            client = FlutterwaveClient(gateway.base_url, "test-key")
+
+    It also answers the PayPal v1 token and payment creation calls at
+    ``paypal_url``; see ``as_paypal``.
+    """
+
+    def __init__(self, delay=0.0, fail_next=0):
+        self.delay = delay
+        self.fail_next = fail_next
+        self.requests = []
+        self.transactions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v3"
+
+    @property
+    def paypal_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @contextmanager
+    def as_paypal(self):
+        """Point the default ``paypalrestsdk`` API, which the views use, at this stub for the block."""
+        previous = paypalrestsdk.api.__api__
+        paypalrestsdk.api.__api__ = paypalrestsdk.Api(mode="sandbox", endpoint=self.paypal_url, client_id="stub",
+                                                      client_secret="stub")
+        try:
+            yield
+        finally:
+            paypalrestsdk.api.__api__ = previous
+
+    def add_transaction(self, tx_ref, amount, currency="NGN", status="successful"):
+        transaction_id = next(self._ids)
+        self.transactions[transaction_id] = {
+            "id": transaction_id, "tx_ref": tx_ref, "amount": float(amount), "currency": currency, "status": status,
+        }
+        return transaction_id
+
+    def handle(self, method, path, body):
+        with self._lock:
+            self.requests.append((method, path))
+            failing = self.fail_next > 0
+            self.fail_next -= failing
+        if self.delay:
+            time.sleep(self.delay)
+        if failing:
+            return 503, {"status": "error", "message": "Service unavailable"}
+
+        if method == "POST" and path == "/v3/payments":
+            transaction_id = self.add_transaction(body["tx_ref"], body["amount"], body.get("currency", "NGN"))
+            return 200, {"status": "success", "message": "Hosted Link",
+                         "data": {"link": f"{self.base_url}/hosted/pay/{transaction_id}"}}
+
+        match = re.fullmatch(r"/v3/transactions/(\d+)/verify", path)
+        if method == "GET" and match:
+            transaction = self.transactions.get(int(match.group(1)))
+            if transaction is None:
+                return 400, {"status": "error", "message": "No transaction was found for this id"}
+            return 200, {"status": "success", "message": "Transaction fetched successfully", "data": transaction}
+
+        if method == "POST" and path == "/v1/oauth2/token":
+            return 200, {"access_token": "stub-token", "token_type": "Bearer", "expires_in": 32400}
+        if method == "POST" and path == "/v1/payments/payment":
+            payment_id = f"PAYID-{next(self._ids)}"
+            return 201, {"id": payment_id, "intent": body.get("intent"), "state": "created",
+                         "links": [{"href": f"{self.paypal_url}/checkoutnow?token={payment_id}",
+                                    "rel": "approval_url", "method": "REDIRECT"}]}
+        return 404, {"status": "error", "message": "Not found"}
+
+    def start(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = {}  # PayPal's form-encoded token request.
+                status, payload = gateway.handle(self.command, self.path, body)
+                content = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting, e.g. a read timeout test.
+                    self.close_connection = True
+
+            do_GET = do_POST = respond
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # The default backlog of 5 drops connections once a few hundred
+            # concurrent clients dial in at once.
+            request_queue_size = 1024
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
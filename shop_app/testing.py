@@ -0,0 +1,35 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin:
+    """Assertions that pin the number of SQL queries an endpoint may run.
+
+    Mix into a ``django.test.TestCase``. ``assertQueryBudget`` fails when a
+    request exceeds its budget; ``assertConstantQueries`` additionally grows
+    the data set between two identical requests and fails when the query count
+    follows the row count (an N+1 regression).
+    """
+
+    def capture_request(self, path, data=None, method="get", **extra):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, data, **extra)
+        return response, queries
+
+    def assertQueryBudget(self, budget, path, data=None, method="get", **extra):
+        response, queries = self.capture_request(path, data, method, **extra)
+        self.checkBudget(budget, queries, f"{method.upper()} {path}")
+        return response
+
+    def assertConstantQueries(self, budget, grow, path, data=None, method="get", **extra):
+        _, before = self.capture_request(path, data, method, **extra)
+        grow()
+        response, after = self.capture_request(path, data, method, **extra)
+        self.checkBudget(budget, after, f"{method.upper()} {path}")
+        self.assertEqual(len(before), len(after), f"{method.upper()} {path} query count grew with the data set")
+        return response
+
+    def checkBudget(self, budget, queries, label):
+        if len(queries) > budget:
+            executed = "\n".join(query["sql"] for query in queries.captured_queries)
+            self.fail(f"{label} ran {len(queries)} queries, budget is {budget}:\n{executed}")
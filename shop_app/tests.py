@@ -1,3 +1,1449 @@
-from django.test import TestCase
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from functools import partial
+from unittest import mock, skipUnless
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.db import IntegrityError, connection, connections, router, transaction
+from django.db.models import F, QuerySet
+from django.test import (Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings, skipUnlessDBFeature)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .idempotency import _claim, purge_expired
+from .gateways import CircuitBreaker, CircuitOpenError, FlutterwaveClient, GatewayError
+from .jobs import claim_jobs, enqueue_verification, payment_state, process_jobs
+from .management.commands.bench_api import (ENDPOINTS, Workload, compare_reports, run_endpoint,
+                                             uncovered_endpoints)
+from .pagination import encode_cursor
+from .models import (Product, Cart, CartItem, Review, Transaction, PaymentJob, IdempotencyKey, CacheVersion,
+                     SlugCounter, SlugCounterManager)
+from .benchmarks import seed_carts, seed_products, seed_reviews, seed_users, without_response_cache
+from .cache import CATALOG_KEY, EPOCH_KEY, cache_stats, get_cache, invalidate_product, product_key
+from .catalog_io import FIELDS
+from .carts import add_to_cart, cart_totals, checkout_amount, pending_transaction
+from . import metrics
+from .ratings import rebuild_rating_aggregates
+from .routers import replica_reads, use_replica
+from .explain import explain, sequential_scans
+from .search import trigram_available
+from .serializers import ProductSerializer
+from .stub_gateway import StubGateway
+from .testing import QueryBudgetMixin
+
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def make_product(name, **kwargs):
+    kwargs.setdefault("price", Decimal("10.00"))
+    kwargs.setdefault("image", "img/test.jpg")
+    return Product.objects.create(name=name, **kwargs)
+
+
+@without_response_cache()
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reviewer = get_user_model().objects.create(username="reviewer")
+        cls.cart = Cart.objects.create(cart_code="budget")
+        cls.product = make_product("Budget tee")
+        cls.add_products(3)
+        age_catalog_versions(*Product.objects.values_list("slug", flat=True))
+
+    @classmethod
+    def add_products(cls, count):
+        for i in range(count):
+            product = make_product(f"Tee {Product.objects.count()}", size="M", color="Red")
+            Review.objects.create(product=product, reviewer=cls.reviewer, body="Nice", rating=4)
+            Review.objects.create(product=product, reviewer=cls.reviewer, body="Okay", rating=3)
+            CartItem.objects.create(cart=cls.cart, product=product, quantity=2)
+
+    def test_products(self):
+        response = self.assertConstantQueries(2, lambda: self.add_products(5), "/products")
+        self.assertNotIn("reviews", response.json()[0])
+
+    def test_products_page(self):
+        self.assertConstantQueries(2, lambda: self.add_products(5), "/products",
+                                   {"page_size": 50, "sort_by": "price"})
+
+    def test_products_with_fields(self):
+        self.assertConstantQueries(2, lambda: self.add_products(5), "/products", {"fields": "id,name,price"})
+
+    def test_product_detail(self):
+        self.assertQueryBudget(2, f"/product_detail/{self.product.slug}")
+
+    def test_get_reviews(self):
+        self.assertConstantQueries(3, lambda: self.add_products(5),
+                                   f"/product_detail/{Product.objects.last().slug}/reviews/")
+
+    def test_get_cart(self):
+        response = self.assertConstantQueries(3, lambda: self.add_products(5), "/get_cart",
+                                              {"cart_code": self.cart.cart_code})
+        self.assertEqual(response.json()["num_of_items"], 16)
+        self.assertEqual(response.json()["num_of_product"], 8)
+
+    def test_get_cart_stat(self):
+        self.assertConstantQueries(3, lambda: self.add_products(5), "/get_cart_stat",
+                                   {"cart_code": self.cart.cart_code})
+
+
+class RatingAggregateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reviewer = get_user_model().objects.create(username="critic")
+        cls.good = make_product("Good tee")
+        cls.poor = make_product("Poor tee")
+
+    def review(self, product, rating):
+        client = APIClient()
+        client.force_authenticate(self.reviewer)
+        response = client.post(f"/product_detail/{product.slug}/add_review/",
+                               {"body": "Review", "rating": rating}, format="json")
+        self.assertEqual(response.status_code, 201)
+
+    def test_add_review_updates_aggregates(self):
+        self.review(self.good, 5)
+        self.review(self.good, 4)
+        self.good.refresh_from_db()
+        self.assertEqual((self.good.rating_count, self.good.rating_sum), (2, 9))
+        self.assertEqual(self.good.rating_average, 4.5)
+        self.assertEqual(self.good.rating_histogram, {1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+    def test_remove_last_rating(self):
+        self.review(self.good, 3)
+        Review.objects.get().delete()
+        self.good.refresh_from_db()
+        self.assertEqual((self.good.rating_count, self.good.rating_sum, self.good.rating_average), (0, 0, 0))
+        self.assertEqual(self.good.rating_histogram, {1: 0, 2: 0, 3: 0, 4: 0, 5: 0})
+
+    def test_delete_and_edit_reviews(self):
+        self.review(self.good, 5)
+        self.review(self.good, 2)
+        Review.objects.get(rating=5).delete()
+        review = Review.objects.get()
+        review.rating = 4
+        review.save()
+        self.good.refresh_from_db()
+        self.assertEqual((self.good.rating_count, self.good.rating_sum, self.good.rating_average), (1, 4, 4.0))
+        self.assertEqual(self.good.rating_histogram, {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        review.product = self.poor
+        review.save()
+        self.good.refresh_from_db()
+        self.poor.refresh_from_db()
+        self.assertEqual((self.good.rating_count, self.poor.rating_count, self.poor.rating_4), (0, 1, 1))
+        self.assertEqual(rebuild_rating_aggregates(), 0)
+
+    def test_sort_and_filter_by_rating(self):
+        self.review(self.poor, 2)
+        self.review(self.good, 5)
+        ids = [product["id"] for product in self.client.get("/products", {"sort_by": "rating"}).json()]
+        self.assertEqual(ids[:2], [self.good.id, self.poor.id])
+        ids = [product["id"] for product in self.client.get("/products", {"min_rating": 4}).json()]
+        self.assertEqual(ids, [self.good.id])
+
+    def test_rebuild(self):
+        # Bulk inserts skip the signals that keep the aggregates current.
+        Review.objects.bulk_create([Review(product=self.poor, reviewer=self.reviewer, body="Bad", rating=1)])
+        self.assertEqual(rebuild_rating_aggregates(), 1)
+        self.poor.refresh_from_db()
+        self.assertEqual((self.poor.rating_count, self.poor.rating_1), (1, 1))
+        self.assertEqual(rebuild_rating_aggregates(), 0)
+
+
+class CatalogCacheTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reviewer = get_user_model().objects.create(username="shopper")
+        cls.product = make_product("Cached tee", color="Blue")
+        cls.other = make_product("Other tee", color="Red")
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_listing_served_from_cache(self):
+        first = self.client.get("/products", {"color": "Blue", "utm": "a"})
+        self.assertEqual(first["X-Cache"], "MISS")
+        second = self.assertQueryBudget(1, "/products", {"utm": "b", "color": "Blue"})
+        self.assertEqual(second["X-Cache"], "HIT")
+        self.assertEqual(first.json(), second.json())
+        self.assertGreaterEqual(cache_stats()["products"]["hits"], 1)
+
+    def test_product_change_invalidates_listing_and_detail(self):
+        self.client.get("/products")
+        self.client.get(f"/product_detail/{self.product.slug}")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = Decimal("99.00")
+            self.product.save()
+        self.assertEqual(self.client.get("/products")["X-Cache"], "MISS")
+        response = self.client.get(f"/product_detail/{self.product.slug}")
+        self.assertEqual(response.json()["price"], "99.00")
+
+    def test_write_in_another_process_invalidates_listing(self):
+        self.assertEqual(self.client.get("/products")["X-Cache"], "MISS")
+        self.assertEqual(self.client.get("/products")["X-Cache"], "HIT")
+        # Another worker's invalidation only reaches this one through the database.
+        CacheVersion.objects.filter(key=CATALOG_KEY).update(stamp=F("stamp") + 1)
+        self.assertEqual(self.client.get("/products")["X-Cache"], "MISS")
+
+    def test_review_invalidates_only_its_product(self):
+        self.client.get(f"/product_detail/{self.product.slug}")
+        self.client.get(f"/product_detail/{self.other.slug}")
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=self.product, reviewer=self.reviewer, body="Great", rating=5)
+        self.assertEqual(self.client.get(f"/product_detail/{self.product.slug}")["X-Cache"], "MISS")
+        self.assertEqual(self.client.get(f"/product_detail/{self.other.slug}")["X-Cache"], "HIT")
+
+    def test_errors_are_not_cached(self):
+        self.client.get("/product_detail/missing")
+        response = self.client.get("/product_detail/missing")
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("X-Cache", response)
+
+
+class ConditionalGetTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_product("Polled tee")
+        cls.cart = Cart.objects.create(cart_code="polled")
+        CartItem.objects.create(cart=cls.cart, product=cls.product, quantity=1)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_cart_not_modified(self):
+        for path in ["/get_cart", "/get_cart_stat"]:
+            first = self.client.get(path, {"cart_code": "polled"})
+            self.assertTrue(first["ETag"])
+            self.assertTrue(first["Last-Modified"])
+            response = self.assertQueryBudget(2, path, {"cart_code": "polled"}, HTTP_IF_NONE_MATCH=first["ETag"])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+
+    def test_cart_change_changes_etag(self):
+        etag = self.client.get("/get_cart", {"cart_code": "polled"})["ETag"]
+        CartItem.objects.filter(cart=self.cart).get().delete()
+        response = self.client.get("/get_cart", {"cart_code": "polled"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["num_of_items"], 0)
+
+    def test_price_change_changes_cart_etag(self):
+        first = self.client.get("/get_cart", {"cart_code": "polled"})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = Decimal("194.00")
+            self.product.save()
+        response = self.client.get("/get_cart", {"cart_code": "polled"}, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(str(response.json()["sum_total"])), Decimal("194.00"))
+
+    def test_missing_cart(self):
+        self.assertEqual(self.client.get("/get_cart", {"cart_code": "nope"}).status_code, 404)
+
+    def test_catalog_not_modified(self):
+        etag = self.client.get("/products", {"color": "Red"})["ETag"]
+        response = self.assertQueryBudget(1, "/products", {"color": "Red"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get("/products", {"color": "Blue"}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_catalog_change_changes_etag(self):
+        path = f"/product_detail/{self.product.slug}/reviews/"
+        etag = self.client.get(path)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_write_in_another_process_changes_etag(self):
+        path = f"/product_detail/{self.product.slug}"
+        first = self.client.get(path)
+        # Another worker saves the product; nothing of it is in this process's cache.
+        Product.objects.filter(pk=self.product.pk).update(price=Decimal("12.50"))
+        invalidate_product(self.product.slug)
+        get_cache().clear()
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["price"], "12.50")
+        self.assertNotEqual(response["ETag"], first["ETag"])
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, name, size):
+        buffer = BytesIO()
+        Image.new("RGB", size, "red").save(buffer, format="JPEG")
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/jpeg")
+
+    def test_thumbnails_built_on_save(self):
+        product = Product.objects.create(name="Photo tee", price=Decimal("5.00"), image=self.upload("tee.jpg", (500, 250)))
+        product.refresh_from_db()
+        self.assertEqual(product.thumbnails["source"], product.image.name)
+        self.assertEqual(sorted(product.thumbnails), ["160", "320", "source"])
+        with default_storage.open(product.thumbnails["320"]["webp"]) as thumbnail:
+            self.assertEqual(Image.open(thumbnail).size, (320, 160))
+        data = ProductSerializer(product).data["thumbnails"]
+        self.assertTrue(data["160"]["jpeg"].endswith("-160.jpeg"))
+
+    def test_same_content_reuses_files(self):
+        first = Product.objects.create(name="A", price=Decimal("5.00"), image=self.upload("a.jpg", (200, 200)))
+        second = Product.objects.create(name="B", price=Decimal("5.00"), image=self.upload("b.jpg", (200, 200)))
+        self.assertEqual(first.thumbnails["160"], second.thumbnails["160"])
+
+
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        override = override_settings(MEDIA_ROOT=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def write(self, name, content):
+        path = f"{self.directory}/{name}"
+        with open(path, "w") as file:
+            file.write(content)
+        return path
+
+    def run_import(self, path, **options):
+        stdout, stderr = StringIO(), StringIO()
+        call_command("import_catalog", path, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_csv_upserts_by_slug(self):
+        make_product("Old tee", slug="old-tee", description="Keep me")
+        path = self.write("catalog.csv", "slug,name,price,size\n"
+                                         "old-tee,Renamed tee,12.50,M\n"
+                                         ",Fresh tee,3,S\n"
+                                         ",Broken tee,cheap,S\n"
+                                         "missing,,1,\n")
+        stdout, stderr = self.run_import(path, batch_size=2)
+        self.assertIn("1 created, 1 updated, 2 failed", stdout.splitlines()[-2])
+        self.assertIn("Line 4: Invalid price 'cheap'.", stderr)
+        self.assertIn("Line 5: name must be", stderr)
+        old = Product.objects.get(slug="old-tee")
+        self.assertEqual((old.name, old.price, old.size, old.description), ("Renamed tee", Decimal("12.50"), "M", "Keep me"))
+        self.assertEqual(Product.objects.get(slug="fresh-tee").price, Decimal("3.00"))
+
+    def test_non_finite_prices_fail_their_rows(self):
+        path = self.write("catalog.csv", "name,price\nNaN tee,NaN\nInfinite tee,Infinity\nSignal tee,-sNaN\nFine tee,4\n")
+        stdout, stderr = self.run_import(path)
+        self.assertIn("1 created, 0 updated, 3 failed", stdout)
+        for line, price in [(2, "NaN"), (3, "Infinity"), (4, "-sNaN")]:
+            self.assertIn(f"Line {line}: Invalid price '{price}'.", stderr)
+
+    def test_partial_columns_update_existing_products(self):
+        make_product("Partial tee", slug="partial-tee", description="Keep me", price=Decimal("7.00"))
+        path = self.write("names.csv", "slug,name\npartial-tee,Renamed tee\nunknown-tee,Nobody\n")
+        stdout, stderr = self.run_import(path)
+        self.assertIn("0 created, 1 updated, 1 failed", stdout)
+        self.assertIn("Line 3: New products need a name and a price.", stderr)
+        product = Product.objects.get(slug="partial-tee")
+        self.assertEqual((product.name, product.price, product.description), ("Renamed tee", Decimal("7.00"), "Keep me"))
+
+    def test_export_round_trip(self):
+        make_product("Round tee", size="L", color="Blue", description="Trip")
+        make_product("Round tee")
+        path = f"{self.directory}/catalog.jsonl"
+        call_command("export_catalog", path, stdout=StringIO())
+        before = list(Product.objects.order_by("id").values(*FIELDS))
+        stdout, _ = self.run_import(path)
+        self.assertIn("0 created, 2 updated, 0 failed", stdout)
+        self.assertEqual(list(Product.objects.order_by("id").values(*FIELDS)), before)
+
+    def test_image_urls_are_downloaded(self):
+        buffer = BytesIO()
+        Image.new("RGB", (20, 20), "blue").save(buffer, format="PNG")
+        os.mkdir(f"{self.directory}/remote")
+        with open(f"{self.directory}/remote/tee.png", "wb") as file:
+            file.write(buffer.getvalue())
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietFileHandler, directory=self.directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = f"http://127.0.0.1:{server.server_address[1]}/remote"
+        path = self.write("catalog.jsonl", json.dumps({"name": "Pictured tee", "price": 4, "image": f"{base}/tee.png"})
+                          + "\n" + json.dumps({"name": "Lost tee", "price": 4, "image": f"{base}/lost.png"}) + "\n")
+        _, stderr = self.run_import(path)
+        self.assertIn("Line 2: Could not fetch image", stderr)
+        product = Product.objects.get()
+        self.assertTrue(product.image.name.startswith("img/imports/"))
+        self.assertEqual(default_storage.open(product.image.name).read(), buffer.getvalue())
+
+
+@without_response_cache()
+class ProductPaginationTests(TestCase):
+    orderings = {
+        None: ("id",),
+        "price": ("price", "id"),
+        "popularity": ("-popularity", "id"),
+        "rating": ("-rating_average", "id"),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        # Few distinct values, so pages end in the middle of ties.
+        for i in range(10):
+            make_product(f"Paged tee {i}", price=Decimal(10 + i % 3), popularity=i % 4, rating_average=i % 2 * 4.5)
+
+    def pages(self, sort_by=None, page_size=3, between=None):
+        params = {"page_size": page_size, **({"sort_by": sort_by} if sort_by else {})}
+        seen, cursor = [], None
+        while True:
+            response = self.client.get("/products", {**params, **({"cursor": cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            seen += [product["id"] for product in response.json()["results"]]
+            cursor = response.json()["next"]
+            if cursor is None:
+                return seen
+            if between:
+                between()
+                between = None
+
+    def test_every_ordering_walks_all_pages(self):
+        for sort_by, ordering in self.orderings.items():
+            expected = list(Product.objects.order_by(*ordering).values_list("id", flat=True))
+            self.assertEqual(self.pages(sort_by), expected, sort_by)
+            self.assertEqual(self.pages(sort_by, page_size=100), expected, sort_by)
+
+    def test_inserts_between_pages_do_not_shift_rows(self):
+        before = list(Product.objects.order_by("price", "id").values_list("id", flat=True))
+        inserted = []
+
+        def insert():
+            inserted.append(make_product("Cheap tee", price=Decimal("1.00")).id)
+            inserted.append(make_product("Dear tee", price=Decimal("99.00")).id)
+
+        seen = self.pages("price", between=insert)
+        self.assertEqual(seen, before + inserted[1:])
+
+    def test_bad_cursors_are_rejected(self):
+        valid = self.client.get("/products", {"page_size": 3, "sort_by": "price"}).json()["next"]
+        self.assertEqual(self.client.get("/products", {"sort_by": "price", "cursor": valid}).status_code, 200)
+        cases = [
+            ("price", "junk"),
+            ("popularity", valid),
+            ("price", encode_cursor("price", ["cheap", 1])),
+            ("price", encode_cursor("price", ["10.00"])),
+            ("price", encode_cursor("price", ["10.00", None])),
+            ("rating", encode_cursor("rating", [{"gt": 1}, 1])),
+            (None, encode_cursor("default", ["1; DROP TABLE"])),
+        ]
+        for sort_by, cursor in cases:
+            response = self.client.get("/products", {"cursor": cursor, **({"sort_by": sort_by} if sort_by else {})})
+            self.assertEqual(response.status_code, 400, (sort_by, cursor))
+
+
+class ReviewPaginationTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_product("Reviewed tee", slug="reviewed-tee")
+        reviewer = get_user_model().objects.create(username="regular")
+        created = timezone.now()
+        cls.reviews = Review.objects.bulk_create([
+            Review(product=cls.product, reviewer=reviewer, body=f"Review {i}", rating=i % 5 + 1)
+            for i in range(12)
+        ])
+        # Some share a timestamp, so the id has to break ties.
+        for i, review in enumerate(cls.reviews):
+            Review.objects.filter(pk=review.pk).update(created=created - timedelta(minutes=i // 3))
+        Review.objects.create(product=make_product("Other tee"), reviewer=reviewer, body="Elsewhere", rating=5)
+
+    def pages(self, **params):
+        seen, cursor = [], None
+        while True:
+            body = self.client.get(f"/product_detail/{self.product.slug}/reviews/",
+                                   {**params, **({"cursor": cursor} if cursor else {})}).json()
+            seen += [review["body"] for review in body["results"]]
+            cursor = body["next"]
+            if cursor is None:
+                return seen
+
+    def test_newest_first(self):
+        expected = list(Review.objects.filter(product=self.product).order_by("-created", "-id")
+                        .values_list("body", flat=True))
+        self.assertEqual(self.pages(page_size=5), expected)
+        unpaginated = self.client.get(f"/product_detail/{self.product.slug}/reviews/").json()
+        self.assertEqual([review["body"] for review in unpaginated], expected)
+        self.assertEqual(set(unpaginated[0]), {"id", "reviewer_name", "body", "rating", "created"})
+        self.assertEqual(unpaginated[0]["reviewer_name"], "regular")
+
+    def test_rating_filter(self):
+        self.assertEqual(sorted(self.pages(rating=5, page_size=1)), ["Review 4", "Review 9"])
+        for rating in ("6", "five", "4.0"):
+            self.assertEqual(self.client.get(f"/product_detail/{self.product.slug}/reviews/",
+                                             {"rating": rating}).status_code, 400)
+
+    def test_fixed_number_of_queries(self):
+        age_catalog_versions(self.product.slug)
+        self.assertQueryBudget(3, f"/product_detail/{self.product.slug}/reviews/", {"page_size": 5})
+        self.assertEqual(self.client.get("/product_detail/missing/reviews/").status_code, 404)
+
+
+class CartBatchTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [make_product(f"Batch tee {i}", price=Decimal("2.50")) for i in range(6)]
+
+    def batch(self, operations, cart_code="offline"):
+        return self.client.post("/cart_batch/", {"cart_code": cart_code, "operations": operations},
+                                content_type="application/json")
+
+    def test_applies_operations_in_order(self):
+        first, second, third = self.products[:3]
+        self.batch([{"op": "add", "product_id": first.id}, {"op": "add", "product_id": second.id}])
+        response = self.batch([
+            {"op": "add", "product_id": first.id, "quantity": 2},
+            {"op": "update", "product_id": second.id, "quantity": 5},
+            {"op": "add", "product_id": third.id},
+            {"op": "remove", "product_id": third.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        quantities = {item["product"]["id"]: item["quantity"] for item in response.json()["items"]}
+        self.assertEqual(quantities, {first.id: 3, second.id: 5})
+        self.assertEqual(response.json()["sum_total"], 20.0)
+
+    def test_invalid_operation_rolls_back(self):
+        response = self.batch([{"op": "add", "product_id": self.products[0].id},
+                               {"op": "add", "product_id": 0}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["operation"], 1)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_query_count_independent_of_batch_size(self):
+        operations = [{"op": "add", "product_id": product.id, "quantity": 2} for product in self.products]
+        self.assertQueryBudget(13, "/cart_batch/", {"cart_code": "big", "operations": operations},
+                               method="post", content_type="application/json")
+        operations = [{"op": "update", "product_id": product.id, "quantity": 1} for product in self.products]
+        self.assertQueryBudget(13, "/cart_batch/", {"cart_code": "big", "operations": operations},
+                               method="post", content_type="application/json")
+
+
+@skipUnlessDBFeature("test_db_allows_multiple_connections")
+class CartConcurrencyTests(TransactionTestCase):
+    threads = 8
+    repeats = 25
+
+    def hammer(self, request):
+        errors = []
+
+        def worker():
+            client = Client()
+            try:
+                for _ in range(self.repeats):
+                    response = request(client)
+                    if response.status_code >= 400:
+                        errors.append(response.content)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_adds_and_increments(self):
+        product = make_product("Contended tee")
+        self.hammer(lambda client: client.post("/add_item/", {"cart_code": "shared", "product_id": product.id}))
+        item = CartItem.objects.get(cart__cart_code="shared", product=product)
+        self.assertEqual(item.quantity, self.threads * self.repeats)
+
+        self.hammer(lambda client: client.patch("/update_quantity/", {"item_id": item.id, "delta": -1},
+                                                content_type="application/json"))
+        self.assertFalse(CartItem.objects.filter(pk=item.pk).exists())
+
+
+class CartRaceTests(TestCase):
+    """The races of CartConcurrencyTests, replayed deterministically on one connection."""
+
+    def test_first_add_racing_another_falls_back_to_increment(self):
+        product = make_product("Raced tee")
+        cart = Cart.objects.create(cart_code="raced")
+        lookup = QuerySet.get
+
+        def racing_get(queryset, *args, **kwargs):
+            if queryset.model is CartItem and not CartItem.objects.exists():
+                # Another request adds the item between this lookup and the insert.
+                CartItem.objects.create(cart=cart, product=product, quantity=2)
+                raise CartItem.DoesNotExist
+            return lookup(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, "get", racing_get):
+            item = add_to_cart("raced", product.id, quantity=3)
+        self.assertEqual(item.quantity, 5)
+        self.assertEqual(CartItem.objects.get().quantity, 5)
+        self.assertEqual(add_to_cart("raced", product.id).quantity, 6)
+
+
+@skipUnlessDBFeature("test_db_allows_multiple_connections")
+class SlugConcurrencyTests(TransactionTestCase):
+    def test_concurrent_saves_get_distinct_slugs(self):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(10):
+                    make_product("Crowded Tee")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(6)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        slugs = set(Product.objects.values_list("slug", flat=True))
+        self.assertEqual(slugs, {"crowded-tee"} | {f"crowded-tee-{i}" for i in range(1, 60)})
+
+
+class SlugTests(TestCase):
+    def test_duplicate_names_are_numbered(self):
+        make_product("Tee", slug="tee-1")
+        slugs = [make_product("Tee").slug for _ in range(3)]
+        self.assertEqual(slugs, ["tee", "tee-2", "tee-3"])
+        self.assertEqual(make_product("!!!").slug, "product")
+
+    def test_bulk_create_allocates_per_batch(self):
+        def create(count):
+            with CaptureQueriesContext(connection) as queries:
+                Product.objects.bulk_create([Product(name=f"Bulk {i % 3}", price=1, image="img/test.jpg")
+                                             for i in range(count)])
+            # The INSERTs themselves are batched by the backend's parameter limit.
+            return len([query for query in queries.captured_queries
+                        if not query["sql"].startswith('INSERT INTO "shop_app_product"')])
+
+        self.assertEqual(create(10), create(200))
+        slugs = list(Product.objects.filter(name="Bulk 0").order_by("id").values_list("slug", flat=True))
+        self.assertEqual(len(slugs), len(set(slugs)))
+        self.assertEqual(slugs[:3], ["bulk-0", "bulk-0-1", "bulk-0-2"])
+
+
+class SlugRaceTests(TestCase):
+    """SlugConcurrencyTests' race, replayed deterministically on one connection."""
+
+    def test_allocation_overtaken_before_it_locks(self):
+        # Another allocation runs to completion after this one created its
+        # counter row but before it locked and read it. Neither saves a
+        # product, so only the counter keeps their slugs apart.
+        lock = SlugCounterManager.select_for_update
+        overtaken = None
+
+        def racing_lock(manager):
+            nonlocal overtaken
+            if overtaken is None:
+                overtaken = []
+                overtaken.extend(SlugCounter.objects.allocate(["crowded-tee"] * 3))
+            return lock(manager)
+
+        with mock.patch.object(SlugCounterManager, "select_for_update", racing_lock):
+            allocated = SlugCounter.objects.allocate(["crowded-tee", "crowded-tee"])
+        self.assertEqual(overtaken, ["crowded-tee", "crowded-tee-1", "crowded-tee-2"])
+        self.assertEqual(allocated, ["crowded-tee-3", "crowded-tee-4"])
+        self.assertEqual(SlugCounter.objects.get(base="crowded-tee").next_number, 5)
+
+
+class CartMergeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="buyer")
+        cls.tee, cls.cap, cls.hat = (make_product(name) for name in ["Tee", "Cap", "Hat"])
+
+    def test_merge_folds_previous_carts(self):
+        old = Cart.objects.create(cart_code="old", user=self.user)
+        CartItem.objects.create(cart=old, product=self.tee, quantity=2)
+        CartItem.objects.create(cart=old, product=self.cap, quantity=1)
+        anonymous = Cart.objects.create(cart_code="anon")
+        CartItem.objects.create(cart=anonymous, product=self.tee, quantity=1)
+        CartItem.objects.create(cart=anonymous, product=self.hat, quantity=4)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post("/merge_cart/", {"cart_code": "anon"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["cart_code"], "anon")
+        quantities = dict(CartItem.objects.filter(cart=anonymous).values_list("product__name", "quantity"))
+        self.assertEqual(quantities, {"Tee": 3, "Cap": 1, "Hat": 4})
+        self.assertFalse(Cart.objects.filter(cart_code="old").exists())
+        anonymous.refresh_from_db()
+        self.assertEqual(anonymous.user, self.user)
+
+    def test_carts_in_checkout_are_kept(self):
+        checkout = Cart.objects.create(cart_code="paying", user=self.user)
+        CartItem.objects.create(cart=checkout, product=self.cap, quantity=1)
+        payment = pending_transaction(checkout, checkout_amount(checkout), self.user)
+        job = enqueue_verification(PaymentJob.FLUTTERWAVE, payment, {"transaction_id": 1}, self.user)
+        Cart.objects.create(cart_code="anon")
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.post("/merge_cart/", {"cart_code": "anon"}, format="json").status_code, 200)
+        self.assertFalse(CartItem.objects.filter(cart__cart_code="anon").exists())
+        self.assertEqual(CartItem.objects.get(cart=checkout).quantity, 1)
+        self.assertTrue(Transaction.objects.filter(pk=payment.pk, cart=checkout, status="pending").exists())
+        self.assertTrue(PaymentJob.objects.filter(pk=job.pk).exists())
+
+    def test_cannot_take_over_another_users_cart(self):
+        other = get_user_model().objects.create(username="other")
+        Cart.objects.create(cart_code="theirs", user=other)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.post("/merge_cart/", {"cart_code": "theirs"}, format="json").status_code, 403)
+
+    def test_add_item_increments(self):
+        for _ in range(2):
+            self.client.post("/add_item/", {"cart_code": "inc", "product_id": self.tee.id, "quantity": 2})
+        self.assertEqual(CartItem.objects.get(cart__cart_code="inc").quantity, 4)
+
+
+class OrderHistoryTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="customer", email="customer@example.com", city="Lagos")
+        cls.other = get_user_model().objects.create(username="someone-else")
+        cls.tee = make_product("Order tee")
+        cls.cap = make_product("Order cap")
+        cls.add_orders(2)
+        Cart.objects.create(cart_code="open", user=cls.user)
+        CartItem.objects.create(cart=Cart.objects.create(cart_code="theirs", user=cls.other, paid=True), product=cls.tee)
+
+    @classmethod
+    def add_orders(cls, count):
+        for _ in range(count):
+            cart = Cart.objects.create(cart_code=f"order{Cart.objects.count()}", user=cls.user, paid=True)
+            CartItem.objects.create(cart=cart, product=cls.tee, quantity=2)
+            CartItem.objects.create(cart=cart, product=cls.cap, quantity=1)
+            Transaction.objects.create(ref=f"ref-{cart.cart_code}", cart=cart, amount=Decimal("30.00"),
+                                       status="completed", user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_fixed_number_of_queries(self):
+        response = self.assertConstantQueries(3, lambda: self.add_orders(3), "/order_history")
+        order = response.json()["results"][0]
+        self.assertEqual(order["payment"], {"ref": f"ref-{order['cart_code']}", "amount": "30.00", "currency": "NGN"})
+        self.assertEqual([(item["product"]["name"], item["quantity"]) for item in order["items"]],
+                         [("Order tee", 2), ("Order cap", 1)])
+        self.assertEqual(set(order["items"][0]["product"]), {"id", "name", "slug", "image", "price"})
+
+    def test_pages_follow_cursor(self):
+        self.add_orders(5)
+        expected = list(Cart.objects.filter(user=self.user, paid=True).order_by("-modified_at", "-id")
+                        .values_list("cart_code", flat=True))
+        seen, cursor = [], None
+        while True:
+            body = self.client.get("/order_history", {"page_size": 3, **({"cursor": cursor} if cursor else {})}).json()
+            seen += [order["cart_code"] for order in body["results"]]
+            cursor = body["next"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(self.client.get("/order_history", {"cursor": "junk"}).status_code, 400)
+        for values in (["yesterday", 1], [str(timezone.now()), "one"], [str(timezone.now()), None]):
+            cursor = encode_cursor("orders", values)
+            self.assertEqual(self.client.get("/order_history", {"cursor": cursor}).status_code, 400, values)
+
+    def test_requires_login(self):
+        self.assertEqual(APIClient().get("/order_history").status_code, 401)
+
+    def test_user_info_returns_profile_only(self):
+        response = self.assertQueryBudget(0, "/user_info")
+        self.assertEqual(response.json(), {"id": self.user.id, "username": "customer", "first_name": "",
+                                           "last_name": "", "email": "customer@example.com", "city": "Lagos",
+                                           "address": None, "phone": None})
+
+
+class CartTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cart = Cart.objects.create(cart_code="totals")
+        for price, quantity in [("19.99", 3), ("0.10", 7), ("5.00", 1)]:
+            CartItem.objects.create(cart=cls.cart, product=make_product(f"Tee {price}", price=Decimal(price)),
+                                    quantity=quantity)
+
+    def test_aggregate_and_prefetched_totals_agree(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            aggregated = cart_totals(cart)
+            cart_totals(cart)
+        prefetched = cart_totals(Cart.objects.with_items().get(pk=self.cart.pk))
+        self.assertEqual(aggregated, prefetched)
+        self.assertEqual(aggregated, {"sum_total": Decimal("65.67"), "num_of_items": 11, "num_of_product": 3})
+        self.assertEqual(checkout_amount(cart), Decimal("69.67"))
+
+    def test_empty_cart(self):
+        cart = Cart.objects.create(cart_code="empty")
+        self.assertEqual(cart_totals(cart), {"sum_total": Decimal("0.00"), "num_of_items": 0, "num_of_product": 0})
+
+
+class FlutterwaveClientTests(TestCase):
+    def setUp(self):
+        self.gateway = StubGateway().start()
+        self.addCleanup(self.gateway.stop)
+
+    def client_for(self, **kwargs):
+        kwargs.setdefault("backoff_factor", 0)
+        return FlutterwaveClient(self.gateway.base_url, "test-key", **kwargs)
+
+    def test_verify_is_retried(self):
+        transaction_id = self.gateway.add_transaction("ref-1", "12.00")
+        self.gateway.fail_next = 2
+        data = self.client_for().verify_transaction(transaction_id)
+        self.assertEqual(data["data"]["tx_ref"], "ref-1")
+        self.assertEqual(len(self.gateway.requests), 3)
+
+    def test_payment_creation_is_not_retried(self):
+        self.gateway.fail_next = 1
+        response = self.client_for().initiate_payment({"tx_ref": "ref-2", "amount": "5.00"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    def test_read_timeout(self):
+        self.gateway.delay = 0.5
+        with self.assertRaises(GatewayError):
+            self.client_for(read_timeout=0.1, max_retries=0).initiate_payment({"tx_ref": "slow", "amount": "1"})
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        client = self.client_for(max_retries=0, breaker=breaker)
+        self.gateway.fail_next = 2
+        for _ in range(2):
+            client.verify_transaction(1)
+        with self.assertRaises(CircuitOpenError):
+            client.verify_transaction(1)
+        self.assertEqual(len(self.gateway.requests), 2)
+        time.sleep(0.25)
+        transaction_id = self.gateway.add_transaction("ref-3", "1.00")
+        self.assertEqual(client.verify_transaction(transaction_id)["status"], "success")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_failed_trial_releases_half_open_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.2)
+        client = self.client_for(max_retries=0, breaker=breaker)
+        self.gateway.fail_next = 1
+        client.verify_transaction(1)
+        time.sleep(0.25)
+
+        def broken(response, **kwargs):
+            raise ValueError("undecodable")
+
+        with self.assertRaises(ValueError):
+            client.request("GET", "/transactions/1/verify", hooks={"response": broken})
+        self.assertEqual(breaker.state, "half-open")
+        transaction_id = self.gateway.add_transaction("ref-5", "1.00")
+        self.assertEqual(client.verify_transaction(transaction_id)["status"], "success")
+        self.assertEqual(breaker.state, "closed")
+
+    def test_payment_callback_verifies_through_client(self):
+        user = get_user_model().objects.create(username="payer")
+        cart = Cart.objects.create(cart_code="paying")
+        Transaction.objects.create(ref="ref-4", cart=cart, amount=Decimal("14.00"), user=user)
+        transaction_id = self.gateway.add_transaction("ref-4", "14.00")
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(f"/payment_callback/?status=successful&tx_ref=ref-4&transaction_id={transaction_id}")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.gateway.requests, [])
+        self.assertEqual(client.get("/payment_status/ref-4").json()["status"], "pending")
+
+        with override_settings(FLUTTERWAVE_BASE_URL=self.gateway.base_url):
+            self.assertEqual(process_jobs(), 1)
+        cart.refresh_from_db()
+        self.assertTrue(cart.paid)
+        self.assertEqual(cart.user, user)
+        self.assertEqual(client.get("/payment_status/ref-4").json()["status"], "completed")
+
+
+@override_settings(PAYMENT_JOB_MAX_ATTEMPTS=2, PAYMENT_JOB_BACKOFF=0)
+class PaymentJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.cart = Cart.objects.create(cart_code="queued")
+        cls.payment = Transaction.objects.create(ref="job-ref", cart=cls.cart, amount=Decimal("9.00"))
+
+    def setUp(self):
+        self.gateway = StubGateway().start()
+        self.addCleanup(self.gateway.stop)
+        override = override_settings(FLUTTERWAVE_BASE_URL=self.gateway.base_url, FLUTTERWAVE_MAX_RETRIES=0)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_gateway_failure_is_retried_then_dead_lettered(self):
+        job = enqueue_verification(PaymentJob.FLUTTERWAVE, self.payment, {"transaction_id": 1})
+        self.gateway.fail_next = 5
+        self.assertEqual(process_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (PaymentJob.QUEUED, 1))
+        self.assertEqual(process_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.DEAD)
+        self.assertEqual(job.last_error, "Service unavailable")
+        self.assertEqual(payment_state(self.payment), "failed")
+        self.assertFalse(Cart.objects.get(pk=self.cart.pk).paid)
+
+    def test_amount_mismatch_fails_transaction(self):
+        transaction_id = self.gateway.add_transaction("job-ref", "1.00")
+        job = enqueue_verification(PaymentJob.FLUTTERWAVE, self.payment, {"transaction_id": transaction_id})
+        process_jobs()
+        job.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.assertEqual((job.status, self.payment.status), (PaymentJob.DONE, "failed"))
+
+    def test_jobs_are_claimed_once(self):
+        enqueue_verification(PaymentJob.FLUTTERWAVE, self.payment, {"transaction_id": 1})
+        self.assertEqual(len(claim_jobs(10)), 1)
+        self.assertEqual(claim_jobs(10), [])
+
+    def test_expired_lease_is_reclaimed(self):
+        job = enqueue_verification(PaymentJob.FLUTTERWAVE, self.payment, {"transaction_id": 1})
+        claim_jobs(1)
+        PaymentJob.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual([claimed.pk for claimed in claim_jobs(1)], [job.pk])
+
+
+class IdempotencyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="buyer", email="buyer@example.com")
+        cls.cart = Cart.objects.create(cart_code="checkout")
+        CartItem.objects.create(cart=cls.cart, product=make_product("Scarf"), quantity=2)
+
+    def setUp(self):
+        self.gateway = StubGateway().start()
+        self.addCleanup(self.gateway.stop)
+        override = override_settings(FLUTTERWAVE_BASE_URL=self.gateway.base_url)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def initiate(self, key=None, cart_code="checkout"):
+        headers = {"Idempotency-Key": key} if key else {}
+        return self.client.post("/initiate_payment/", {"cart_code": cart_code}, format="json", headers=headers)
+
+    def test_repeated_key_replays_response(self):
+        first = self.initiate("key-1")
+        second = self.initiate("key-1")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    def test_key_reused_for_other_payload_is_rejected(self):
+        Cart.objects.create(cart_code="other")
+        self.initiate("key-2")
+        self.assertEqual(self.initiate("key-2", cart_code="other").status_code, 422)
+
+    def test_expired_key_runs_again(self):
+        self.initiate("key-3")
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertFalse(self.initiate("key-3").has_header("Idempotent-Replayed"))
+        self.assertEqual(len(self.gateway.requests), 2)
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(purge_expired(), 1)
+
+    def test_abandoned_claim_is_taken_over_after_lease(self):
+        self.initiate("key-5")
+        record = IdempotencyKey.objects.get()
+        self.assertGreater(record.expires_at, timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_LEASE))
+        # As if the worker handling the first request died before storing a response.
+        IdempotencyKey.objects.update(status_code=None, response=None,
+                                      expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_LEASE))
+        self.assertEqual(self.initiate("key-5").status_code, 409)
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        retried = self.initiate("key-5")
+        self.assertEqual(retried.status_code, 200)
+        self.assertFalse(retried.has_header("Idempotent-Replayed"))
+        self.assertEqual(self.initiate("key-5")["Idempotent-Replayed"], "true")
+        self.assertEqual(len(self.gateway.requests), 2)
+        placeholder, created = _claim("test", "anonymous", "key-6", "hash")
+        self.assertTrue(created)
+        self.assertLessEqual(placeholder.expires_at, timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_LEASE))
+
+    def test_server_errors_are_not_stored(self):
+        self.gateway.fail_next = 1
+        self.assertEqual(self.initiate("key-4").status_code, 503)
+        self.assertEqual(self.initiate("key-4").status_code, 200)
+
+    def test_checkout_reuses_pending_transaction(self):
+        self.initiate()
+        self.initiate()
+        refs = [created["tx_ref"] for created in self.gateway.transactions.values()]
+        self.assertEqual(len(set(refs)), 1)
+        self.assertEqual(Transaction.objects.filter(cart=self.cart).count(), 1)
+
+    def test_changed_amount_supersedes_pending_transaction(self):
+        stale = pending_transaction(self.cart, Decimal("1.00"), self.user)
+        payment = pending_transaction(self.cart, checkout_amount(self.cart), self.user)
+        self.assertNotEqual(payment.ref, stale.ref)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, "superseded")
+
+    def test_callback_for_completed_payment_is_not_requeued(self):
+        payment = pending_transaction(self.cart, checkout_amount(self.cart), self.user)
+        path = f"/payment_callback/?status=successful&tx_ref={payment.ref}&transaction_id=1"
+        self.assertEqual(self.client.post(path).status_code, 202)
+        self.assertEqual(self.client.post(path).status_code, 202)
+        self.assertEqual(payment.jobs.count(), 1)
+
+        Transaction.objects.filter(pk=payment.pk).update(status="completed")
+        response = self.client.post(path)
+        self.assertEqual((response.status_code, response.json()["status"]), (200, "completed"))
+        self.assertEqual(payment.jobs.count(), 1)
+
+
+class AsyncViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="async-buyer", email="async@example.com")
+        cls.product = make_product("Sandals", slug="sandals")
+        cls.cart = Cart.objects.create(cart_code="async-cart")
+        CartItem.objects.create(cart=cls.cart, product=cls.product, quantity=3)
+
+    def setUp(self):
+        self.gateway = StubGateway().start()
+        self.addCleanup(self.gateway.stop)
+        override = override_settings(FLUTTERWAVE_BASE_URL=self.gateway.base_url)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.auth = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+
+    async def test_initiate_payment_matches_sync_view(self):
+        response = await self.async_client.post("/async/initiate_payment/", {"cart_code": "async-cart"},
+                                                content_type="application/json", headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/hosted/pay/", response.json()["data"]["link"])
+        payment = await Transaction.objects.aget(cart=self.cart, status="pending")
+        self.assertEqual(payment.amount, Decimal("34.00"))
+
+        status_response = await self.async_client.get(f"/async/payment_status/{payment.ref}")
+        self.assertEqual(status_response.json()["status"], "pending")
+
+    async def test_idempotency_keys_are_shared_with_sync_view(self):
+        headers = dict(self.auth, **{"Idempotency-Key": "shared"})
+        sync_response = await sync_to_async(self.client.post)(
+            "/initiate_payment/", {"cart_code": "async-cart"}, content_type="application/json", headers=headers)
+        async_response = await self.async_client.post("/async/initiate_payment/", {"cart_code": "async-cart"},
+                                                      content_type="application/json", headers=headers)
+        self.assertEqual(async_response.json(), sync_response.json())
+        self.assertEqual(async_response["Idempotent-Replayed"], "true")
+        self.assertEqual(len(self.gateway.requests), 1)
+
+    async def test_initiate_payment_requires_token(self):
+        response = await self.async_client.post("/async/initiate_payment/", {"cart_code": "async-cart"},
+                                                content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+        bad = await self.async_client.post("/async/initiate_payment/", {"cart_code": "async-cart"},
+                                           content_type="application/json", headers={"Authorization": "Bearer nope"})
+        self.assertEqual(bad.status_code, 401)
+
+    @without_response_cache()
+    async def test_product_detail_matches_sync_view(self):
+        expected = (await sync_to_async(self.client.get)("/product_detail/sandals")).json()
+        response = await self.async_client.get("/async/product_detail/sandals")
+        self.assertEqual(response.json(), expected)
+        missing = await self.async_client.get("/async/product_detail/nothing")
+        self.assertEqual(missing.status_code, 404)
+
+
+class IndexPlanTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_product("Indexed tee", slug="indexed-tee")
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # Tiny tables are cheaper to read whole; ask whether an index could serve the query.
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def test_hot_lookups_use_indexes(self):
+        for path in (f"/product_detail/{self.product.slug}", f"/product_detail/{self.product.slug}/reviews/"):
+            _, queries = self.capture_request(path)
+            for query in queries.captured_queries:
+                self.assertEqual(sequential_scans(explain(query["sql"])), [], query["sql"])
+
+    def test_unindexed_filter_is_flagged(self):
+        plan = explain("SELECT id FROM shop_app_product WHERE description = 'x'")
+        self.assertEqual(sequential_scans(plan), ["shop_app_product"])
+
+    def test_slug_is_unique(self):
+        with self.assertRaises(IntegrityError):
+            make_product("Another tee", slug="indexed-tee")
+
+
+class FacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        make_product("Red S", size="S", color="Red", price=Decimal("20.00"))
+        make_product("Red M", size="M", color="Red", price=Decimal("60.00"))
+        make_product("Blue M", size="M", color="Blue", price=Decimal("30.00"))
+        make_product("Blue L", size="L", color="Blue", price=Decimal("250.00"), rating_average=4.5)
+        make_product("Plain", price=Decimal("25.00"))
+
+    def setUp(self):
+        get_cache().clear()
+
+    def facets(self, **params):
+        response = self.client.get("/products/facets", params)
+        self.assertEqual(response.status_code, 200)
+        return {facet: {entry["value"]: entry["count"] for entry in response.json()[facet]}
+                for facet in ("size", "color", "price")} | {"total": response.json()["total"]}
+
+    def test_counts_in_one_query(self):
+        age_catalog_versions()
+        # The other query reads the catalog version.
+        with self.assertNumQueries(2):
+            counts = self.facets()
+        self.assertEqual(counts["total"], 5)
+        self.assertEqual(counts["size"], {"S": 1, "M": 2, "L": 1, "XL": 0})
+        self.assertEqual(counts["color"], {"Red": 2, "Blue": 2, "Green": 0, "Black": 0, "White": 0})
+        self.assertEqual(counts["price"], {"0-25": 1, "25-50": 2, "50-100": 1, "100-200": 0, "200+": 1})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get("/products/facets")["X-Cache"], "HIT")
+
+    def test_selection_leaves_own_facet_open(self):
+        counts = self.facets(color="Blue", size="M")
+        self.assertEqual(counts["total"], 1)
+        self.assertEqual(counts["size"], {"S": 0, "M": 1, "L": 1, "XL": 0})
+        self.assertEqual(counts["color"], {"Red": 1, "Blue": 1, "Green": 0, "Black": 0, "White": 0})
+        self.assertEqual(counts["price"]["25-50"], 1)
+        self.assertEqual(self.facets(min_rating=4)["total"], 1)
+
+    def test_price_filters_products(self):
+        response = self.client.get("/products", {"price": "25-50"})
+        self.assertEqual(sorted(product["name"] for product in response.json()), ["Blue M", "Plain"])
+        self.assertEqual(self.client.get("/products", {"price": "cheap"}).status_code, 400)
+        self.assertEqual(self.client.get("/products/facets", {"min_rating": "x"}).status_code, 400)
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.shirt = make_product("Linen Shirt", slug="linen-shirt", description="A light summer shirt.")
+        cls.dress = make_product("Summer Dress", slug="summer-dress", description="Made of pure linen.")
+        cls.sandals = make_product("Leather Sandals", slug="leather-sandals", description="Hand stitched.")
+        cls.coat = make_product("Wool Coat", slug="wool-coat", description="Warm and heavy.")
+
+    def setUp(self):
+        get_cache().clear()
+
+    def search(self, q, **params):
+        return self.client.get("/products/search", dict(params, q=q))
+
+    def test_name_matches_rank_above_description_matches(self):
+        response = self.search("linen")
+        self.assertEqual([product["slug"] for product in response.json()["results"]], ["linen-shirt", "summer-dress"])
+        self.assertNotIn("reviews", response.json()["results"][0])
+
+    def test_prefix_and_all_terms(self):
+        self.assertEqual([product["slug"] for product in self.search("leath sand").json()["results"]],
+                         ["leather-sandals"])
+        self.assertEqual(self.search("leather coat").json()["results"], [])
+
+    def test_typo_tolerance(self):
+        if connection.vendor == "postgresql" and not trigram_available(connection.alias):
+            self.skipTest("pg_trgm is not installed")
+        self.assertEqual([product["slug"] for product in self.search("sandles").json()["results"]],
+                         ["leather-sandals"])
+
+    def test_pages_follow_cursor(self):
+        seen, cursor = [], None
+        while True:
+            body = self.search("summer", page_size=1, **({"cursor": cursor} if cursor else {})).json()
+            seen += [product["slug"] for product in body["results"]]
+            cursor = body["next"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, ["summer-dress", "linen-shirt"])
+        self.assertEqual(self.search("coat", cursor=self.search("summer", page_size=1).json()["next"]).status_code,
+                         400)
+        for values in (["high", 1], [0.5, [1]], [0.5, None]):
+            self.assertEqual(self.search("summer", cursor=encode_cursor("search:summer", values)).status_code, 400,
+                             values)
+
+    def test_new_products_are_found(self):
+        self.assertEqual(self.search("velvet").json()["results"], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product("Velvet Blazer", slug="velvet-blazer")
+        self.assertEqual([product["slug"] for product in self.search("velvet").json()["results"]], ["velvet-blazer"])
+
+    def test_query_is_required(self):
+        self.assertEqual(self.search(" !? ").status_code, 400)
+
+
+def age_catalog_versions(*slugs, seconds=3600):
+    then = time.time_ns() - seconds * 10**9
+    CacheVersion.objects.bulk_create(
+        [CacheVersion(key=key, stamp=then) for key in [EPOCH_KEY, CATALOG_KEY, *map(product_key, slugs)]],
+        update_conflicts=True, unique_fields=["key"], update_fields=["stamp"],
+    )
+
+
+@override_settings(DATABASE_REPLICAS=["replica_a", "replica_b"])
+class ReplicaRouterTests(TransactionTestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_only_catalog_reads_go_to_the_replica(self):
+        self.assertEqual(Product.objects.all().db, "default")
+        with use_replica():
+            self.assertIn(Product.objects.all().db, settings.DATABASE_REPLICAS)
+            self.assertIn(Review.objects.all().db, settings.DATABASE_REPLICAS)
+            self.assertEqual(Cart.objects.all().db, "default")
+            self.assertEqual(get_user_model().objects.all().db, "default")
+            self.assertEqual(router.db_for_write(Product), "default")
+
+    def test_one_replica_per_block(self):
+        with use_replica("replica_b"):
+            self.assertEqual({Product.objects.all().db for _ in range(10)}, {"replica_b"})
+
+    def view(self, **kwargs):
+        view = replica_reads(lambda request, slug=None: Product.objects.all().db)
+        return view(RequestFactory().get("/products"), **kwargs)
+
+    def test_views_stay_on_the_primary_after_a_catalog_write(self):
+        age_catalog_versions("tee")
+        self.assertIn(self.view(), settings.DATABASE_REPLICAS)
+        self.assertIn(self.view(slug="tee"), settings.DATABASE_REPLICAS)
+
+        make_product("Tee", slug="tee")
+        self.assertEqual(self.view(), "default")
+        self.assertEqual(self.view(slug="tee"), "default")
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.assertIn(self.view(), settings.DATABASE_REPLICAS)
+
+    def test_write_in_another_process_pins_reads(self):
+        age_catalog_versions("tee")
+        self.assertIn(self.view(slug="tee"), settings.DATABASE_REPLICAS)
+        # Another worker's write leaves this process's cache alone.
+        CacheVersion.objects.filter(key=product_key("tee")).update(stamp=time.time_ns())
+        get_cache().clear()
+        self.assertEqual(self.view(slug="tee"), "default")
+        self.assertIn(self.view(), settings.DATABASE_REPLICAS)
+
+    def test_views_in_a_transaction_stay_on_the_primary(self):
+        view = replica_reads(lambda request: Product.objects.all().db)
+        age_catalog_versions()
+        with transaction.atomic():
+            self.assertEqual(view(RequestFactory().get("/products")), "default")
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "No read replica is configured.")
+class ReplicaReadTests(TransactionTestCase):
+    """Reads through a replica alias; give the test settings one that mirrors "default"."""
+    databases = "__all__"
+
+    def setUp(self):
+        get_cache().clear()
+        self.product = make_product("Replica tee", slug="replica-tee")
+        self.reviewer = get_user_model().objects.create(username="replica-reviewer")
+        age_catalog_versions(self.product.slug)
+
+    def queries_by_alias(self, path):
+        contexts = {alias: CaptureQueriesContext(connections[alias])
+                    for alias in ["default", *settings.DATABASE_REPLICAS]}
+        for context in contexts.values():
+            context.__enter__()
+        try:
+            response = self.client.get(path)
+        finally:
+            for context in contexts.values():
+                context.__exit__(None, None, None)
+        self.assertEqual(response.status_code, 200)
+        return {alias: len(context) for alias, context in contexts.items()}
+
+    def test_catalog_reads_use_a_replica(self):
+        for path in ["/products", f"/product_detail/{self.product.slug}", f"/product_detail/{self.product.slug}/reviews/"]:
+            counts = self.queries_by_alias(path)
+            # Only the version stamps are read from the primary.
+            self.assertEqual(counts["default"], 1, path)
+            self.assertGreater(sum(counts.values()), 0, path)
+
+    def test_writer_reads_from_the_primary(self):
+        client = APIClient()
+        client.force_authenticate(self.reviewer)
+        response = client.post(f"/product_detail/{self.product.slug}/add_review/",
+                               {"body": "Fresh", "rating": 4}, format="json")
+        self.assertEqual(response.status_code, 201)
+        counts = self.queries_by_alias(f"/product_detail/{self.product.slug}/reviews/")
+        self.assertEqual(counts, {**dict.fromkeys(counts, 0), "default": counts["default"]})
+        self.assertGreater(counts["default"], 0)
+
+
+class DatabaseSettingsTests(SimpleTestCase):
+    def load(self, *argv, **environ):
+        """Evaluate backend/settings.py afresh for a command line and environment."""
+        with mock.patch.dict(os.environ, environ, clear=True), \
+                mock.patch.object(sys, "argv", ["manage.py", *(argv or ["runserver"])]), \
+                mock.patch("dotenv.load_dotenv"):
+            return runpy.run_path(settings.BASE_DIR / "backend" / "settings.py")["DATABASES"]["default"]
+
+    def test_sqlite_without_a_url(self):
+        database = self.load()
+        self.assertEqual(database["ENGINE"], "django.db.backends.sqlite3")
+        self.assertEqual(self.load("test", DATABASE_URL="postgres://shop@db.example.com:6543/shop"), database)
+        self.assertEqual(self.load(DB_POOL_MAX_SIZE="8", DB_PGBOUNCER="true"), database)
+        self.assertNotIn("OPTIONS", database)
+        self.assertNotIn("DISABLE_SERVER_SIDE_CURSORS", database)
+
+    def test_test_runs_use_their_own_url(self):
+        database = self.load("test", DATABASE_URL="postgres://shop@deployed.example.com/shop",
+                             TEST_DATABASE_URL="postgres://shop@localhost/shop")
+        self.assertEqual(database["HOST"], "localhost")
+
+    def test_pool_only_when_sized(self):
+        direct = self.load(DATABASE_URL="postgres://shop@db.example.com:5432/shop")
+        self.assertEqual(direct["CONN_MAX_AGE"], 60)
+        self.assertNotIn("pool", direct.get("OPTIONS", {}))
+        pooled = self.load(DATABASE_URL="postgres://shop@db.example.com:5432/shop", DB_POOL_MAX_SIZE="8")
+        self.assertEqual(pooled["CONN_MAX_AGE"], 0)
+        self.assertEqual(pooled["OPTIONS"]["pool"], {"min_size": 1, "max_size": 8, "timeout": 10.0})
+
+    def test_pgbouncer_only_on_its_port(self):
+        for port, environ, expected in [("6543", {}, True), ("5432", {}, False),
+                                        ("6543", {"DB_PGBOUNCER": "false"}, False),
+                                        ("5432", {"DB_PGBOUNCER": "true"}, True)]:
+            database = self.load(DATABASE_URL=f"postgres://shop@db.example.com:{port}/shop", **environ)
+            self.assertEqual(database.get("DISABLE_SERVER_SIDE_CURSORS", False), expected, (port, environ))
+            self.assertEqual("prepare_threshold" in database.get("OPTIONS", {}), expected, (port, environ))
+
+
+@override_settings(METRICS_SAMPLE_RATE=1, METRICS_TOKEN="scrape")
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username="metered", email="metered@example.com")
+        cls.product = make_product("Metered tee", slug="metered-tee")
+        cls.cart = Cart.objects.create(cart_code="metered")
+        CartItem.objects.create(cart=cls.cart, product=cls.product, quantity=1)
+
+    def setUp(self):
+        metrics.reset()
+        get_cache().clear()
+
+    def timings(self, response):
+        return {entry.split(";")[0]: entry for entry in response["Server-Timing"].split(", ")}
+
+    def scrape(self):
+        return self.client.get("/metrics", headers={"Authorization": "Bearer scrape"}).content.decode()
+
+    def test_server_timing_and_metrics(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/products", {"fields": "id,name"})
+        count = len(queries)
+        timings = self.timings(response)
+        self.assertEqual(set(timings), {"app", "db", "serializer"})
+        self.assertIn(f'desc="{count} queries"', timings["db"])
+
+        body = self.scrape()
+        self.assertIn('shop_request_duration_seconds_count{route="products"} 1', body)
+        self.assertIn(f'shop_db_queries{{route="products",quantile="0.5"}} {count}', body)
+        self.assertIn('shop_serializer_duration_seconds_sum{route="products"}', body)
+
+    def test_gateway_time(self):
+        gateway = StubGateway().start()
+        self.addCleanup(gateway.stop)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with override_settings(FLUTTERWAVE_BASE_URL=gateway.base_url):
+            response = client.post("/initiate_payment/", {"cart_code": "metered"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("gateway", self.timings(response))
+
+    async def test_async_views_are_measured(self):
+        await sync_to_async(age_catalog_versions)(self.product.slug)
+        response = await self.async_client.get(f"/async/product_detail/{self.product.slug}")
+        self.assertIn('desc="2 queries"', self.timings(response)["db"])
+
+    def test_unsampled_requests_are_not_measured(self):
+        with override_settings(METRICS_SAMPLE_RATE=0):
+            self.assertNotIn("Server-Timing", self.client.get("/products"))
+        self.assertNotIn('route="products"', self.scrape())
+
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer other"}).status_code, 401)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer scrape"}).status_code, 200)
+
+    def test_metrics_closed_without_token(self):
+        with override_settings(METRICS_TOKEN=""):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer "}).status_code, 403)
+
+    def test_histogram_quantiles(self):
+        histogram = metrics.Histogram(unit=1e-6)
+        for micros in range(1, 100_001):
+            histogram.record(micros / 1e6)
+        for q in metrics.QUANTILES:
+            self.assertAlmostEqual(histogram.quantile(q), q * 0.1, delta=q * 0.1 * 0.03)
+        self.assertEqual(histogram.count, 100_000)
+
+
+class BenchApiTests(TestCase):
+    def test_every_endpoint_has_a_workload(self):
+        self.assertEqual(uncovered_endpoints(), [])
+        for name, _ in ENDPOINTS:
+            self.assertTrue(callable(getattr(Workload, name, None)), name)
+
+    def test_seeded_ratings_match_a_rebuild(self):
+        seed_products(40, reviews=100)
+        seed_reviews(100)
+        self.assertEqual(rebuild_rating_aggregates(), 0)
+
+    def test_every_endpoint_answers(self):
+        seed_products(50, reviews=100)
+        seed_reviews(100)
+        seed_carts(20, seed_users(5))
+        workload = Workload(count=2)
+        gateway = StubGateway().start()
+        self.addCleanup(gateway.stop)
+        client = Client(raise_request_exception=False)
+        with gateway.as_paypal(), override_settings(FLUTTERWAVE_BASE_URL=gateway.base_url, METRICS_SAMPLE_RATE=1,
+                                                    METRICS_TOKEN="bench"):
+            for name, method in ENDPOINTS:
+                report = run_endpoint(client, workload, name, method, repeat=1, warmup=1)
+                self.assertEqual(report["errors"], 0, f"{name}: {report['statuses']}")
+                self.assertEqual(report["requests"], 1)
+
+    def test_compare_reports(self):
+        def report(p50_ms, queries, errors=0):
+            return {"endpoints": {"products": {"p50_ms": p50_ms, "queries": queries, "errors": errors}}}
+
+        baseline = report(10.0, 2)
+        self.assertEqual(compare_reports(baseline, report(12.0, 2), tolerance=0.25), [])
+        self.assertEqual([regression["metric"] for regression in compare_reports(baseline, report(20.0, 3, 1), 0.25)],
+                         ["queries", "errors", "p50_ms"])
+        self.assertEqual(compare_reports({"endpoints": {}}, report(20.0, 3), 0.25), [])
@@ -0,0 +1,72 @@
+import hashlib
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "webp": ("WEBP", {"method": 4}),
+    "jpeg": ("JPEG", {"optimize": True, "progressive": True}),
+}
+
+
+def thumbnail_name(digest, width, extension):
+    return f"{settings.THUMBNAIL_DIR}/{digest[:2]}/{digest}-{width}.{extension}"
+
+
+def render_thumbnails(source):
+    """Yield ``(width, extension, bytes)`` for every size bucket of an image file.
+
+    Buckets wider than the original are skipped, except the smallest one, so
+    every image gets at least one derivative.
+    """
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        widths = sorted(settings.THUMBNAIL_WIDTHS)
+        for width in widths:
+            if width > image.width and width != widths[0]:
+                break
+            height = max(1, round(image.height * min(width, image.width) / image.width))
+            resized = image.resize((min(width, image.width), height), Image.LANCZOS)
+            for extension, (image_format, options) in FORMATS.items():
+                frame = resized.convert("RGB") if image_format == "JPEG" else resized
+                buffer = BytesIO()
+                frame.save(buffer, format=image_format, quality=settings.THUMBNAIL_QUALITY, **options)
+                yield width, extension, buffer.getvalue()
+
+
+def build_thumbnails(image_name, storage=default_storage):
+    """Create the derivatives of ``image_name`` and return the ``Product.thumbnails`` mapping.
+
+    Files are named after the hash of the source content, so re-uploads of the
+    same picture reuse existing files and changed pictures never collide with
+    cached URLs of the old ones.
+    """
+    if not image_name or not storage.exists(image_name):
+        return {}
+    try:
+        with storage.open(image_name, "rb") as source:
+            content = source.read()
+        digest = hashlib.sha256(content).hexdigest()[:20]
+        thumbnails = {"source": image_name}
+        for width, extension, data in render_thumbnails(BytesIO(content)):
+            name = thumbnail_name(digest, width, extension)
+            if not storage.exists(name):
+                name = storage.save(name, ContentFile(data))
+            thumbnails.setdefault(str(width), {})[extension] = name
+        return thumbnails
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning("Could not build thumbnails for %s", image_name, exc_info=True)
+        return {}
+
+
+def needs_thumbnails(product):
+    return bool(product.image) and product.thumbnails.get("source") != product.image.name
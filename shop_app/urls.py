@@ -1,26 +1,38 @@
 from django.urls import path
-from . import views 
+from . import async_views, metrics, views 
 
 
 urlpatterns = [
      path("products", views.products, name="products"),
+     path("products/facets", views.product_facets, name="product_facets"),
+     path("products/search", views.search_products, name="search_products"),
      path("product_detail/<slug:slug>", views.product_detail, name="product_detail"),
+     path("catalog_cache_stats", views.catalog_cache_stats, name="catalog_cache_stats"),
+     path("metrics", metrics.metrics_view, name="metrics"),
      path("product_detail/<slug:slug>/add_review/", views.add_review, name="add_review"),
      path('product_detail/<slug:slug>/reviews/', views.get_reviews, name='get_reviews'),
      path('get_username/', views.get_username, name='get_username'),
      path("add_item/", views.add_item, name="add_item"),
      path("product_in_cart", views.product_in_cart, name="product_in_cart"),
+     path("cart_batch/", views.cart_batch, name="cart_batch"),
      path("get_cart_stat", views.get_cart_stat, name="get_cart_stat"),
      path("get_cart", views.get_cart, name="get_cart"),
      path("update_quantity/", views.update_quantity, name="update_quantity"),
      path("delete_cartitem/", views.delete_cartitem, name="delete_cartitem"),
+     path("merge_cart/", views.merge_cart, name="merge_cart"),
      path("get_username", views.get_username, name="get_username"),
      path("user_info", views.user_info, name="user_info"),
+     path("order_history", views.order_history, name="order_history"),
      path("register_user/", views.register_user, name="register_user"),
      path("initiate_payment/", views.initiate_payment, name="initiate_payment"),
      path("payment_callback/", views.payment_callback, name="payment_callback"),
+     path("payment_status/<str:ref>", views.payment_status, name="payment_status"),
      path("initiate_paypal_payment/", views.initiate_paypal_payment, name="initiate_paypal_payment"),
-     path("paypal_payment_callback/", views.paypal_payment_callback, name="paypal_payment_callback")
+     path("paypal_payment_callback/", views.paypal_payment_callback, name="paypal_payment_callback"),
+     path("async/product_detail/<slug:slug>", async_views.product_detail, name="async_product_detail"),
+     path("async/initiate_payment/", async_views.initiate_payment, name="async_initiate_payment"),
+     path("async/initiate_paypal_payment/", async_views.initiate_paypal_payment, name="async_initiate_paypal_payment"),
+     path("async/payment_status/<str:ref>", async_views.payment_status, name="async_payment_status"),
 
 ]
 
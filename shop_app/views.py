@@ -1,18 +1,45 @@
 from django.shortcuts import render
-from .models import Product, Review, Cart, CartItem, Transaction
-from .serializers import ProductSerializer,ReviewSerializer, DetailedProductSerializer, UserRegistrationSerializer, UserSerializer, CartItemSerializer, SimpleCartSerializer, CartSerializer
+from .models import Product, Review, Cart, CartItem, Transaction, PaymentJob, cart_items_prefetch
+from .serializers import ProductSerializer,ReviewSerializer, DetailedProductSerializer, UserRegistrationSerializer, UserSerializer, CartItemSerializer, OrderSerializer, SimpleCartSerializer, CartSerializer
+from .pagination import InvalidCursor, get_page_size, paginate_keyset
+from .cache import cache_response, cache_stats
+from .carts import (CartOperationError, add_to_cart, apply_cart_operations, change_quantity, checkout_amount,
+                    merge_carts, pending_transaction, set_quantity)
+from .gateways import (CircuitOpenError, GatewayError, flutterwave_payment_payload, get_flutterwave_client,
+                       paypal_payment_payload)
+from .jobs import enqueue_verification, payment_state
+from .idempotency import idempotent
+from .conditional import cart_condition, catalog_condition, unpaid_cart
+from .facets import facet_counts, filter_facets, selected_facets
+from .routers import replica_reads
+from . import metrics, search
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
-from decimal import Decimal
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django.conf import settings
-import uuid
-import requests
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 import paypalrestsdk
 
 BASE_URL = settings.REACT_BASE_URL
 
+PAYMENT_MESSAGES = {
+    'pending': {'message': 'Verifying your payment...'},
+    'completed': {'message': 'Payment successful!', 'subMessage': 'You have successfully made payment for the items you purchased 😍'},
+    'failed': {'message': 'Payment verification failed.', 'subMessage': 'Your payment verification failed, kindly try again. ✌️'},
+}
+
+# Newest first, following review_product_created_idx.
+REVIEW_ORDERING = ("-created", "-id")
+
+PRODUCT_ORDERINGS = {
+    "default": ("id",),
+    "price": ("price", "id"),
+    "popularity": ("-popularity", "id"),
+    "rating": ("-rating_average", "id"),
+}
+
 
 paypalrestsdk.configure({
     "mode": settings.PAYPAL_MODE, 
@@ -37,29 +64,89 @@ def get_username(request):
 
 
 
+def requested_fields(request):
+    fields = request.query_params.get("fields")
+    return [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+
+
+@catalog_condition
 @api_view(["GET"])
+@cache_response("products", params=("size", "color", "price", "sort_by", "min_rating", "fields", "cursor",
+                                     "page_size"))
+@replica_reads
 def products(request):
-    size = request.query_params.get("size")
-    color = request.query_params.get("color")
     sort_by = request.query_params.get("sort_by")
 
-    products = Product.objects.all()
-    
-    if size:
-        products = products.filter(size=size)
-    if color:
-        products = products.filter(color=color)
+    try:
+        products = filter_facets(rated_products(request), selected_facets(request.query_params))
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    fields = requested_fields(request)
+    ordering_key = sort_by if sort_by in PRODUCT_ORDERINGS else "default"
+    ordering = PRODUCT_ORDERINGS[ordering_key]
+
+    cursor = request.query_params.get("cursor")
+    page_size = request.query_params.get("page_size")
+    if cursor is None and page_size is None:
+        serializer = ProductSerializer(products.order_by(*ordering), many=True, fields=fields)
+        return Response(serializer.data)
 
-    if sort_by == "price":
-        products = products.order_by("price")
-    elif sort_by == "popularity":
-        products = products.order_by("-popularity")
+    try:
+        page, next_cursor = paginate_keyset(products, ordering_key, ordering, cursor=cursor,
+                                            page_size=get_page_size(page_size))
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    serializer = ProductSerializer(products, many=True)
-    return Response(serializer.data)
+    serializer = ProductSerializer(page, many=True, fields=fields)
+    return Response({"results": serializer.data, "next": next_cursor})
+
+
+def rated_products(request):
+    min_rating = request.query_params.get("min_rating")
+    if not min_rating:
+        return Product.objects.all()
+    try:
+        return Product.objects.filter(rating_average__gte=float(min_rating))
+    except ValueError:
+        raise ValueError("min_rating must be a number.") from None
+
+
+@catalog_condition
+@api_view(["GET"])
+@cache_response("product_facets", params=("size", "color", "price", "min_rating"))
+@replica_reads
+def product_facets(request):
+    try:
+        counts = facet_counts(rated_products(request), selected_facets(request.query_params))
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(counts)
+
+
+@catalog_condition
+@api_view(["GET"])
+@cache_response("product_search", params=("q", "fields", "cursor", "page_size"))
+@replica_reads
+def search_products(request):
+    query = request.query_params.get("q", "").strip()
+    if not search.query_terms(query):
+        return Response({"error": "q must contain at least one letter or digit."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        page, next_cursor = search.search_products(query, Product.objects.all(), cursor=request.query_params.get("cursor"),
+                                                   page_size=get_page_size(request.query_params.get("page_size")))
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+    serializer = ProductSerializer(page, many=True, fields=requested_fields(request))
+    return Response({"results": serializer.data, "next": next_cursor})
 
+
+@catalog_condition
 @api_view(["GET"])
+@cache_response("product_detail")
+@replica_reads
 def product_detail(request, slug):
     try:
         product = Product.objects.get(slug=slug)
@@ -69,6 +156,12 @@ def product_detail(request, slug):
         return Response({"error": "Product not found."}, status=status.HTTP_404_NOT_FOUND)
 
 
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def catalog_cache_stats(request):
+    return Response(cache_stats())
+
+
 @api_view(["POST"])
 def add_review(request, slug):
     try:
@@ -77,34 +170,53 @@ def add_review(request, slug):
         data["product"] = product.id
         serializer = ReviewSerializer(data=data)
         if serializer.is_valid():
-            serializer.save(reviewer=request.user, product=product)
+            # The rating aggregates are updated by a post_save receiver.
+            with transaction.atomic():
+                serializer.save(reviewer=request.user, product=product)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     except Product.DoesNotExist:
         return Response({"error": "Product not found."}, status=status.HTTP_404_NOT_FOUND)
 
+@catalog_condition
 @api_view(['GET'])
+@replica_reads
 def get_reviews(request, slug):
-    try:
-        product = Product.objects.get(slug=slug)
-        reviews = Review.objects.filter(product=product)
-        serializer = ReviewSerializer(reviews, many=True)
-        return Response(serializer.data)
-    except Product.DoesNotExist:
+    product_id = Product.objects.filter(slug=slug).values_list("id", flat=True).first()
+    if product_id is None:
         return Response({"error": "Product not found"}, status=404)
 
+    reviews = Review.objects.filter(product_id=product_id).select_related("reviewer").only(
+        "id", "body", "rating", "created", "reviewer__username")
+    rating = request.query_params.get("rating")
+    if rating:
+        if rating not in {str(value) for value, _ in Review.STAR_CHOICES}:
+            return Response({"error": "rating must be a whole number from 1 to 5."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        reviews = reviews.filter(rating=rating)
+
+    cursor = request.query_params.get("cursor")
+    page_size = request.query_params.get("page_size")
+    if cursor is None and page_size is None:
+        serializer = ReviewSerializer(reviews.order_by(*REVIEW_ORDERING), many=True)
+        return Response(serializer.data)
+
+    try:
+        page, next_cursor = paginate_keyset(reviews, "reviews", REVIEW_ORDERING, cursor=cursor,
+                                            page_size=get_page_size(page_size))
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = ReviewSerializer(page, many=True)
+    return Response({"results": serializer.data, "next": next_cursor})
+
 @api_view(["POST"])
 def add_item(request):
     try:
         cart_code = request.data.get("cart_code")
         product_id = request.data.get("product_id")
+        quantity = int(request.data.get("quantity", 1))
 
-        cart, created =Cart.objects.get_or_create(cart_code = cart_code)
-        product = Product.objects.get(id=product_id)
-
-        cartitem, created  = CartItem.objects.get_or_create(cart=cart, product=product)
-        cartitem.quantity = 1 
-        cartitem.save()
+        cartitem = add_to_cart(cart_code, product_id, quantity)
 
         serializer = CartItemSerializer(cartitem)
         return Response({"datat": serializer.data, "message": "Cartitem created successfully"}, status=201)
@@ -125,18 +237,34 @@ def product_in_cart(request):
     return Response({'product_in_cart': product_exists_in_cart})
 
 
+@api_view(['POST'])
+def cart_batch(request):
+    try:
+        cart = apply_cart_operations(request.data.get("cart_code"), request.data.get("operations"))
+    except CartOperationError as e:
+        return Response({"error": str(e), "operation": e.index}, status=status.HTTP_400_BAD_REQUEST)
+    cart = Cart.objects.with_items().get(pk=cart.pk)
+    serializer = CartSerializer(cart)
+    return Response(serializer.data)
+
+
+@cart_condition
 @api_view(['GET'])
 def get_cart_stat(request):
-    cart_code = request.query_params.get("cart_code")
-    cart = Cart.objects.get(cart_code=cart_code, paid=False)
+    cart = unpaid_cart(request)
+    if cart is None:
+        return Response({"error": "Cart not found."}, status=status.HTTP_404_NOT_FOUND)
     serializer = SimpleCartSerializer(cart)
     return Response(serializer.data)
 
 
+@cart_condition
 @api_view(['GET'])
 def get_cart(request):
-    cart_code = request.query_params.get("cart_code")
-    cart = Cart.objects.get(cart_code=cart_code, paid=False)
+    cart = unpaid_cart(request)
+    if cart is None:
+        return Response({"error": "Cart not found."}, status=status.HTTP_404_NOT_FOUND)
+    prefetch_related_objects([cart], cart_items_prefetch())
     serializer = CartSerializer(cart)
     return Response(serializer.data)
 
@@ -146,11 +274,13 @@ def get_cart(request):
 def update_quantity(request):
     try:
         cartitem_id =  request.data.get("item_id")
-        quantity = request.data.get("quantity")
-        quantity = int(quantity)
-        cartitem = CartItem.objects.get(id=cartitem_id)
-        cartitem.quantity = quantity
-        cartitem.save()
+        delta = request.data.get("delta")
+        if delta is not None:
+            cartitem = change_quantity(cartitem_id, int(delta))
+        else:
+            cartitem = set_quantity(cartitem_id, int(request.data.get("quantity")))
+        if cartitem is None:
+            return Response({"data": None, "message": "Cartitem removed"}, status=200)
         serializer = CartItemSerializer(cartitem)
         return Response({ "data":serializer.data, "message": "Cartitem updated successfully!"}, status=200)
     
@@ -158,6 +288,20 @@ def update_quantity(request):
         return Response({'error': str(e)}, status=400)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def merge_cart(request):
+    try:
+        cart = merge_carts(request.data.get("cart_code"), request.user)
+    except Cart.DoesNotExist:
+        return Response({"error": "Cart not found."}, status=status.HTTP_404_NOT_FOUND)
+    except CartOperationError as e:
+        return Response({"error": str(e)}, status=status.HTTP_403_FORBIDDEN)
+    cart = Cart.objects.with_items().get(pk=cart.pk)
+    serializer = CartSerializer(cart)
+    return Response(serializer.data)
+
+
 @api_view(['POST'])
 def delete_cartitem(request):
     cartitem_id = request.data.get("item_id")
@@ -184,159 +328,106 @@ def user_info(request):
     return Response(serializer.data)
 
 
+ORDER_HISTORY_ORDERING = ("-modified_at", "-id")
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def order_history(request):
+    try:
+        page, next_cursor = paginate_keyset(Cart.objects.orders(request.user), "orders", ORDER_HISTORY_ORDERING,
+                                            cursor=request.query_params.get("cursor"),
+                                            page_size=get_page_size(request.query_params.get("page_size"), 10))
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = OrderSerializer(page, many=True)
+    return Response({"results": serializer.data, "next": next_cursor})
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@idempotent("initiate_payment")
 def initiate_payment(request):
     if request.user:
         try:
-            tx_ref = str(uuid.uuid4())
             cart_code = request.data.get("cart_code")
             cart = Cart.objects.get(cart_code=cart_code)
             user = request.user 
 
-            amount = sum([item.quantity * item.product.price for item in cart.items.all()])
-            tax = Decimal("4.00")
-            total_amount = amount + tax
+            total_amount = checkout_amount(cart)
             currency = "NGN"
             redirect_url = f"{BASE_URL}/payment-status/"
 
-            transaction = Transaction.objects.create(
-                ref=tx_ref,
-                cart=cart,
-                amount=total_amount,
-                currency=currency,
-                user=user,
-                status='pending'
-            )
-
-            flutterwave_payload = {
-                "tx_ref": tx_ref,
-                "amount": str(total_amount), 
-                "currency": currency,
-                "redirect_url": redirect_url,
-                "customer": {
-                    "email": user.email,
-                    "name": user.username,
-                    "phonenumber": user.phone
-                },
-                "customizations": {
-                    "title": "Ventura Payment"
-                }
-            }
-
-
-            headers = {
-                "Authorization": f"Bearer {settings.FLUTTERWAVE_SECRET_KEY}",
-                "Content-Type": "application/json"
-            }
-
-
-            response = requests.post(
-                'https://api.flutterwave.com/v3/payments',
-                json=flutterwave_payload,
-                headers=headers
-            )
+            payment = pending_transaction(cart, total_amount, user, currency)
+            flutterwave_payload = flutterwave_payment_payload(payment, user, redirect_url)
+            response = get_flutterwave_client().initiate_payment(flutterwave_payload)
 
             if response.status_code == 200:
                 return Response(response.json(), status=status.HTTP_200_OK)
             else:
                  return Response(response.json(), status=response.status_code)
             
-        except requests.exceptions.RequestException as e:
-                return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except CircuitOpenError as e:
+                return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except (GatewayError, ValueError) as e:
+                return Response({'error': str(e)}, status=status.HTTP_502_BAD_GATEWAY)
 
 
 
 
 @api_view(['POST'])
+@idempotent("payment_callback")
 def payment_callback(request):
     status = request.GET.get('status')
     tx_ref = request.GET.get('tx_ref')
     transaction_id = request.GET.get('transaction_id')
 
-    user = request.user
+    user = request.user if request.user.is_authenticated else None
 
     if status == 'successful':
-        headers = {
-            "Authorization": f"Bearer {settings.FLUTTERWAVE_SECRET_KEY}"
-        }
-
-        response = requests.get(f"https://api.flutterwave.com/v3/transactions/{transaction_id}/verify", headers=headers)
-        response_data = response.json()
-        
-        if response_data['status'] == 'success':
-            transaction = Transaction.objects.get(ref=tx_ref)
-
-            if (response_data['data']['status'] == "successful"
-                    and float(response_data['data']['amount']) == float(transaction.amount)
-                    and response_data['data']['currency'] == transaction.currency):
-                transaction.status = 'completed'
-                transaction.save()
-
-                cart = transaction.cart
-                cart.paid = True
-                cart.user = user
-                cart.save()
-
-                return Response({'message': 'Payment successful!', 'subMessage': 'You have successfully made payment for the items you purchased 😍'})
-            else:
-                return Response({'message': 'Payment verification failed.', "subMessage": "Your payment verification failed, kindly try again. ✌️"}, status=400)
-        else:
-            return Response({'message': 'Failed to verify transaction with Flutterwave.', "subMessgae": "We couldn't verify your payment, use a different payment method 👍"}, status=400)
+        try:
+            payment = Transaction.objects.get(ref=tx_ref)
+        except Transaction.DoesNotExist:
+            return Response({'message': 'Transaction not found.'}, status=404)
+
+        if payment.status == 'completed':
+            return Response({'ref': tx_ref, 'status': 'completed', **PAYMENT_MESSAGES['completed']})
+        enqueue_verification(PaymentJob.FLUTTERWAVE, payment, {"transaction_id": transaction_id}, user)
+        return Response({'status': 'pending', 'ref': tx_ref, 'message': 'Verifying your payment...',
+                         'subMessage': 'We are confirming your payment with Flutterwave, this only takes a moment.'},
+                        status=202)
     else:
         return Response({'message': 'Payment was not successful.'}, status=400)
 
 
 
+@api_view(['GET'])
+def payment_status(request, ref):
+    try:
+        payment = Transaction.objects.get(ref=ref)
+    except Transaction.DoesNotExist:
+        return Response({'error': 'Transaction not found.'}, status=404)
+
+    state = payment_state(payment)
+    return Response({'ref': ref, 'status': state, **PAYMENT_MESSAGES[state]})
+
+
+
 @api_view(['POST'])
+@idempotent("initiate_paypal_payment")
 def initiate_paypal_payment(request):
     if request.method == 'POST' and request.user.is_authenticated:
-        tx_ref = str(uuid.uuid4())
         user = request.user
         cart_code = request.data.get("cart_code")
         cart = Cart.objects.get(cart_code=cart_code)
-        amount = sum(item.product.price * item.quantity for item in cart.items.all())
-        tax = Decimal("4.00")
-        total_amount = amount + tax
-
-        payment = paypalrestsdk.Payment({
-            "intent": "sale",
-            "payer": {
-                "payment_method": "paypal"
-            },
-             "redirect_urls": {
-                "return_url": f"{BASE_URL}/payment-status?paymentStatus=success&ref={tx_ref}",
-                "cancel_url": f"{BASE_URL}/payment-status?paymentStatus=cancel"
-            },
-            "transactions": [{
-                "item_list": {
-                    "items": [{
-                        "name": "Cart Items",
-                        "sku": "cart",
-                        "price": str(total_amount),
-                        "currency": "USD",
-                        "quantity": 1
-                    }]
-                },
-                "amount": {
-                    "total": str(total_amount),
-                    "currency": "USD"
-                },
-                "description": "Payment for cart items."
-            }]
-        })
-
-        print("pay_id", payment)
-
-        transaction, created = Transaction.objects.get_or_create(
-                ref=tx_ref,
-                cart=cart,
-                amount=total_amount,
-                user=user,
-                status='pending'
-            )
-
-        if payment.create():
+        total_amount = checkout_amount(cart)
+        tx_ref = pending_transaction(cart, total_amount, user).ref
+
+        payment = paypalrestsdk.Payment(paypal_payment_payload(tx_ref, total_amount, BASE_URL))
+
+        with metrics.timer("gateway"):
+            created = payment.create()
+        if created:
            
             for link in payment.links:
                 if link.rel == "approval_url":
@@ -350,29 +441,27 @@ def initiate_paypal_payment(request):
 
 
 @api_view(['POST'])
+@idempotent("paypal_payment_callback")
 def paypal_payment_callback(request):
     payment_id = request.query_params.get('paymentId')
     payer_id = request.query_params.get('PayerID')
     ref = request.query_params.get('ref')
 
-    user = request.user
+    user = request.user if request.user.is_authenticated else None
 
-    print("refff", ref)
-
-    transaction = Transaction.objects.get(ref=ref)
+    try:
+        payment = Transaction.objects.get(ref=ref)
+    except Transaction.DoesNotExist:
+        return Response({"error": "Transaction not found."}, status=404)
 
+    if payment.status == 'completed':
+        return Response({'ref': ref, 'status': 'completed', **PAYMENT_MESSAGES['completed']})
     if payment_id and payer_id:
-        payment = paypalrestsdk.Payment.find(payment_id)
-
-        transaction.status = 'completed'
-        transaction.save()
-        cart = transaction.cart
-        cart.paid = True
-        cart.user = user
-        cart.save()
-
-        return Response({'message': 'Payment successful!', 'subMessage': 'You have successfully made payment for the items you purchased 😍'})
+        enqueue_verification(PaymentJob.PAYPAL, payment, {"payment_id": payment_id, "payer_id": payer_id}, user)
+        return Response({'status': 'pending', 'ref': ref, 'message': 'Verifying your payment...',
+                         'subMessage': 'We are confirming your payment with PayPal, this only takes a moment.'},
+                        status=202)
     
     
     else:
-        return Response({"error": "Invalid payment details."}, status=400)
\ No newline at end of file
+        return Response({"error": "Invalid payment details."}, status=400)